@@ -22,6 +22,9 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from datetime import timedelta
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from bt_kernel import run_kernel, shift_array
+
 # ------------------------------ utils ------------------------------
 
 def ensure_dir(p: str):
@@ -113,91 +116,42 @@ def backtest_pair(df: pd.DataFrame, args: argparse.Namespace) -> tuple[pd.DataFr
         spread_scale = float(args.spread_scale)
 
     # zscore
-    df["z"] = zscore(df[spread_col].astype(float), args.z_window)
+    s = df[spread_col].astype(float).to_numpy()
+    z = zscore(df[spread_col].astype(float), args.z_window).to_numpy()
 
     # latency
-    if args.latency_days > 0:
-        df["z_lag"] = df["z"].shift(args.latency_days)
-        df["spread_lag"] = df[spread_col].shift(args.latency_days)
-    else:
-        df["z_lag"] = df["z"]
-        df["spread_lag"] = df[spread_col]
-
-    rows = []  # trades
-    in_pos = False
-    dir_now: str | None = None
-    entry_idx = None
-
-    def try_open(i):
-        nonlocal in_pos, dir_now, entry_idx
-        z = df.at[i, "z_lag"]
-        if np.isnan(z):
-            return
-        if args.side in ("short", "both") and z >= args.z_enter and not in_pos:
-            in_pos = True; dir_now = "SHORT_SPREAD"; entry_idx = i
-        elif args.side in ("long", "both") and z <= -args.z_enter and not in_pos:
-            in_pos = True; dir_now = "LONG_SPREAD"; entry_idx = i
-
-    def must_exit(i) -> tuple[bool, str]:
-        # condizioni di uscita
-        if not in_pos:
-            return False, ""
-        z_now = df.at[i, "z_lag"]
-        if np.isnan(z_now):
-            return False, ""
-        # exit per mean_revert
-        if dir_now == "SHORT_SPREAD" and z_now <= args.z_exit:
-            return True, "MEAN_REVERT"
-        if dir_now == "LONG_SPREAD" and z_now >= -args.z_exit:
-            return True, "MEAN_REVERT"
-        # stop
-        if dir_now == "SHORT_SPREAD" and z_now >= args.z_stop:
-            return True, "STOP"
-        if dir_now == "LONG_SPREAD" and z_now <= -args.z_stop:
-            return True, "STOP"
-        # max hold
-        if entry_idx is not None and (i - entry_idx) >= args.max_hold:
-            return True, "TIMEOUT"
-        return False, ""
-
-    n = len(df)
-    for i in range(n):
-        if not in_pos:
-            try_open(i)
-        if in_pos:
-            exit_now, reason = must_exit(i)
-            if exit_now and entry_idx is not None:
-                # chiusura trade
-                entry_row = df.loc[entry_idx]
-                exit_row  = df.loc[i]
-                direction = dir_now
-                entry_spread = float(entry_row["spread_lag"]) if not is_pct else float(entry_row[spread_col])
-                exit_spread  = float(exit_row["spread_lag"])  if not is_pct else float(exit_row[spread_col])
-                net = compute_pnl(direction, entry_spread, exit_spread,
-                                  is_pct=is_pct, spread_scale=spread_scale,
-                                  notional=args.notional, fee_bps=args.fee_bps,
-                                  slippage_bps=args.slippage_bps)
-                rows.append({
-                    "pair": df.loc[i, "pair"] if "pair" in df.columns else "UNKNOWN",
-                    "direction": direction,
-                    "entry_idx": int(entry_idx),
-                    "exit_idx": int(i),
-                    "entry_date": pd.to_datetime(entry_row[date_col]).date(),
-                    "exit_date":  pd.to_datetime(exit_row[date_col]).date(),
-                    "entry_z": float(entry_row["z_lag"]),
-                    "exit_z":  float(exit_row["z_lag"]),
-                    "reason_exit": reason,
-                    "entry_spread_raw": float(entry_row[spread_col]) if not is_pct else np.nan,
-                    "exit_spread_raw":  float(exit_row[spread_col])  if not is_pct else np.nan,
-                    "entry_spread_pct": float(entry_row[spread_col]) if is_pct else np.nan,
-                    "exit_spread_pct":  float(exit_row[spread_col])  if is_pct else np.nan,
-                    "spread_scale": spread_scale,
-                    "net_pnl": float(net),
-                    "fold": None,  # compilato da WF, qui resta None
-                })
-                in_pos = False; dir_now = None; entry_idx = None
-
-    trades = pd.DataFrame(rows)
+    z_lag = shift_array(z, args.latency_days)
+    s_lag = shift_array(s, args.latency_days)
+
+    kt = run_kernel(z_lag, side=args.side, z_enter=args.z_enter, z_exit=args.z_exit,
+                    z_stop=args.z_stop, max_hold=args.max_hold)
+    ei, xi = kt.entry_i, kt.exit_i
+
+    # chiusura trade: spread laggato (pct: spread corrente)
+    px = s if is_pct else s_lag
+    gross = kt.direction * (px[xi] - px[ei])
+    gross = gross * args.notional if is_pct else gross * spread_scale * args.notional
+    net = gross - (args.fee_bps + args.slippage_bps) * 1e-4 * args.notional
+
+    dts = pd.DatetimeIndex(df[date_col])
+    trades = pd.DataFrame({
+        "pair": df["pair"].to_numpy()[xi] if "pair" in df.columns else "UNKNOWN",
+        "direction": kt.direction_names(),
+        "entry_idx": ei,
+        "exit_idx": xi,
+        "entry_date": dts[ei].date,
+        "exit_date":  dts[xi].date,
+        "entry_z": z_lag[ei],
+        "exit_z":  z_lag[xi],
+        "reason_exit": kt.reason_names(),
+        "entry_spread_raw": s[ei] if not is_pct else np.nan,
+        "exit_spread_raw":  s[xi] if not is_pct else np.nan,
+        "entry_spread_pct": s[ei] if is_pct else np.nan,
+        "exit_spread_pct":  s[xi] if is_pct else np.nan,
+        "spread_scale": spread_scale,
+        "net_pnl": net,
+        "fold": None,  # compilato da WF, qui resta None
+    }) if len(kt) else pd.DataFrame()
 
     # metriche semplici
     if trades.empty:
@@ -20,7 +20,8 @@ python3 scripts/walkforward_backtest_v2.py \
   --latency-days "0,1" \
   --min-trades-train 2 --min-trades-test 1 \
   --notional 250000 --spread-scale auto --z-window 40 \
-  --fee-bps 2 --slippage-bps 2
+  --fee-bps 2 --slippage-bps 2 \
+  --incremental
 
 # Se non ci sono trade, esci subito
 if ! awk -F, -v p="$PAIR" 'NR>1 && $1==p{found=1} END{exit !(found)}' reports/wf_trades.csv; then
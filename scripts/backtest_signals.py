@@ -7,6 +7,8 @@ Compatibile con:
   --z-enter/--z-exit/--z-stop, --latency-days, --max-hold,
   --fee-bps/--slippage-bps, --notional, --start/--end, --z-window,
   --spread-scale (auto|float)
+Barre intraday: --z-window e --max-hold anche come durate (es. 120min, 2h);
+entry/exit con orario e days_held in giorni trascorsi.
 
 Output:
   reports/backtest_trades.csv
@@ -19,12 +21,14 @@ LONG_SPREAD   guadagna se exit_spread > entry_spread.
 """
 from __future__ import annotations
 import argparse, os, sys, math
-from typing import List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import numpy as np
 import pandas as pd
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+
+from feature_cache import rolling_features
+from bt_kernel import run_kernel, shift_array, mtm_pnl, daily_pnl, mtm_metrics
+from bar_clock import parse_duration, is_time, is_intraday, hold_deadline
+from trade_records import TradeBlock, TradeLog, trade_block, decode_when, SIGNALS_COLUMNS
 
 
 # ------------------ argparse ------------------
@@ -42,13 +46,13 @@ def parse_args():
     ap.add_argument("--z-exit", type=float, default=2.0)
     ap.add_argument("--z-stop", type=float, default=99.0)
     ap.add_argument("--latency-days", type=int, default=0)
-    ap.add_argument("--max-hold", type=int, default=5)
+    ap.add_argument("--max-hold", type=parse_duration, default=5, help="barre o durata (es. 2h)")
     ap.add_argument("--fee-bps", type=float, default=0.0)
     ap.add_argument("--slippage-bps", type=float, default=0.0)
     ap.add_argument("--notional", type=float, default=250000.0)
     ap.add_argument("--start", default=None, help="YYYY-MM-DD inclusiva")
     ap.add_argument("--end", default=None, help="YYYY-MM-DD inclusiva")
-    ap.add_argument("--z-window", type=int, default=60)
+    ap.add_argument("--z-window", type=parse_duration, default=60, help="barre o durata (es. 120min)")
     ap.add_argument("--spread-scale", default="auto", help="auto oppure numero (fattore)")
     ap.add_argument("--outdir", default="reports")
     return ap.parse_args()
@@ -111,7 +115,19 @@ def compute_pnl(direction: str, entry_spread: float, exit_spread: float, *,
 
 # ------------------ core ------------------
 
-def backtest_pair(df: pd.DataFrame, pair: str, args) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def empty_metrics(pair: str, args) -> pd.DataFrame:
+    return pd.DataFrame([{ "pair": pair, "start": args.start, "end": args.end,
+                           "trades": 0, "net_pnl_total": 0.0,
+                           "CAGR": 0.0, "vol_annualized": 0.0,
+                           "Sharpe": 0.0, "MaxDD": 0.0, "hit_rate": 0.0 }])
+
+
+def prepare_pair(df: pd.DataFrame, args) -> Optional[Dict[str, Any]]:
+    """
+    Parte del backtest che non dipende dalle soglie: date UTC ordinate e
+    filtrate, spread, scala e z-score. Ritorna None se non restano righe.
+    Chiavi: s, z (float64), d_ns (date int64 ns UTC), is_pct, spread_scale.
+    """
     # --- NORMALIZZA DATE A UTC TZ-AWARE, POI FILTRA RANGE ---
     date_col = infer_date_col(df)
     dts = pd.to_datetime(df[date_col], utc=True, errors="coerce")
@@ -124,10 +140,7 @@ def backtest_pair(df: pd.DataFrame, pair: str, args) -> Tuple[pd.DataFrame, pd.D
     if end_ts is not None:
         df = df[df[date_col] <= end_ts]
     if df.empty:
-        return pd.DataFrame(), pd.DataFrame([{ "pair": pair, "start": args.start, "end": args.end,
-                                               "trades": 0, "net_pnl_total": 0.0,
-                                               "CAGR": 0.0, "vol_annualized": 0.0,
-                                               "Sharpe": 0.0, "MaxDD": 0.0, "hit_rate": 0.0 }])
+        return None
 
     spread_col, is_pct = pick_spread_col(df)
 
@@ -140,111 +153,77 @@ def backtest_pair(df: pd.DataFrame, pair: str, args) -> Tuple[pd.DataFrame, pd.D
     else:
         spread_scale = float(args.spread_scale)
 
-    # z e latency
-    z = zscore(df[spread_col].astype(float), args.z_window)
-    z_lag = z.shift(args.latency_days) if args.latency_days > 0 else z
-    s_lag = df[spread_col].shift(args.latency_days) if args.latency_days > 0 else df[spread_col]
-
-    in_pos = False
-    direction = None
-    entry_i = None
-    rows = []
-
-    def try_open(i):
-        nonlocal in_pos, direction, entry_i
-        zi = z_lag.iat[i]
-        if np.isnan(zi):
-            return
-        if not in_pos and args.side in ("short","both") and zi >= args.z_enter:
-            in_pos, direction, entry_i = True, "SHORT_SPREAD", i
-        elif not in_pos and args.side in ("long","both") and zi <= -args.z_enter:
-            in_pos, direction, entry_i = True, "LONG_SPREAD", i
-
-    def must_exit(i) -> Tuple[bool,str]:
-        if not in_pos:
-            return False, ""
-        zi = z_lag.iat[i]
-        if np.isnan(zi):
-            return False, ""
-        # mean-revert
-        if direction == "SHORT_SPREAD" and zi <= args.z_exit:
-            return True, "MEAN_REVERT"
-        if direction == "LONG_SPREAD" and zi >= -args.z_exit:
-            return True, "MEAN_REVERT"
-        # stop
-        if direction == "SHORT_SPREAD" and zi >= args.z_stop:
-            return True, "STOP"
-        if direction == "LONG_SPREAD" and zi <= -args.z_stop:
-            return True, "STOP"
-        # timeout
-        if entry_i is not None and (i - entry_i) >= args.max_hold:
-            return True, "TIMEOUT"
-        return False, ""
-
-    n = len(df)
-    for i in range(n):
-        if not in_pos:
-            try_open(i)
-        if in_pos:
-            exit_now, reason = must_exit(i)
-            if exit_now:
-                ent = df.iloc[entry_i]
-                exi = df.iloc[i]
-                entry_spread = float(s_lag.iloc[entry_i]) if not is_pct else float(df[spread_col].iloc[entry_i])
-                exit_spread  = float(s_lag.iloc[i])      if not is_pct else float(df[spread_col].iloc[i])
-                gross, cost, net = compute_pnl(direction, entry_spread, exit_spread,
-                                               is_pct=is_pct, spread_scale=spread_scale,
-                                               notional=args.notional, fee_bps=args.fee_bps,
-                                               slippage_bps=args.slippage_bps)
-                rows.append({
-                    "pair": pair,
-                    "entry_date": pd.to_datetime(ent[date_col]).date(),
-                    "exit_date":  pd.to_datetime(exi[date_col]).date(),
-                    "entry_spread_raw": float(df[spread_col].iloc[entry_i]) if not is_pct else np.nan,
-                    "exit_spread_raw":  float(df[spread_col].iloc[i])      if not is_pct else np.nan,
-                    "entry_spread_eff": float(entry_spread),
-                    "exit_spread_eff":  float(exit_spread),
-                    "direction": direction,
-                    "days_held": int(i - entry_i),
-                    "gross_pnl": float(gross),
-                    "cost": float(cost),
-                    "net_pnl": float(net),
-                    "entry_z": float(z_lag.iloc[entry_i]),
-                    "exit_z":  float(z_lag.iloc[i]),
-                    "reason_exit": reason,
-                    "spread_scale": float(spread_scale),
-                })
-                in_pos, direction, entry_i = False, None, None
-
-    trades = pd.DataFrame(rows)
-
-    if trades.empty:
-        metrics = pd.DataFrame([{ "pair": pair, "start": args.start, "end": args.end,
-                                  "trades": 0, "net_pnl_total": 0.0,
-                                  "CAGR": 0.0, "vol_annualized": 0.0,
-                                  "Sharpe": 0.0, "MaxDD": 0.0, "hit_rate": 0.0 }])
+    d_ns = pd.DatetimeIndex(df[date_col]).as_unit("ns").asi8
+    if is_time(args.z_window):
+        z = rolling_features(df[spread_col].astype(float), args.z_window, ts=d_ns).z
     else:
-        eq = trades["net_pnl"].cumsum()
-        ret = trades["net_pnl"]
-        vol_ann = ret.std(ddof=0) * np.sqrt(252/max(1,args.max_hold)) if len(ret) > 1 else 0.0
-        sharpe = (ret.mean()/ret.std(ddof=0)) * np.sqrt(252/max(1,args.max_hold)) if ret.std(ddof=0)>0 else 0.0
-        roll_max = eq.cummax(); dd = (eq - roll_max); maxdd = float(dd.min() if len(dd) else 0.0)
-        hit = float((trades["net_pnl"] > 0).mean())
-        start_eff = trades["entry_date"].min(); end_eff = trades["exit_date"].max()
+        z = zscore(df[spread_col].astype(float), args.z_window).to_numpy()
+    return dict(
+        s=df[spread_col].astype(float).to_numpy(),
+        z=z,
+        d_ns=d_ns,
+        is_pct=is_pct,
+        spread_scale=spread_scale,
+    )
+
+
+def backtest_prepared(pair: str, s: np.ndarray, z: np.ndarray, d_ns: np.ndarray, is_pct: bool,
+                      spread_scale: float, args) -> Tuple[TradeBlock, pd.DataFrame]:
+    """
+    Backtest su una serie già preparata (prepare_pair): soglie, latency e costi da args.
+    Ritorna (trade colonnari, metriche); i trade diventano DataFrame solo in scrittura.
+    """
+    # latency
+    z_lag = shift_array(z, args.latency_days)
+    s_lag = shift_array(s, args.latency_days)
+
+    timed = is_time(args.max_hold)
+    kt = run_kernel(z_lag, side=args.side, z_enter=args.z_enter, z_exit=args.z_exit,
+                    z_stop=args.z_stop, max_hold=0 if timed else args.max_hold,
+                    hold_until=hold_deadline(d_ns, args.max_hold) if timed else None)
+    ei, xi = kt.entry_i, kt.exit_i
+    intraday = is_intraday(d_ns)
+
+    px = s if is_pct else s_lag
+    entry_spread, exit_spread = px[ei], px[xi]
+    mult = args.notional if is_pct else (spread_scale * args.notional)
+    gross = kt.direction * (exit_spread - entry_spread) * mult
+    cost = (args.fee_bps + args.slippage_bps) * 1e-4 * args.notional
+    net = gross - cost
+
+    # intraday: timestamp completo e giorni trascorsi invece di date e barre
+    trades = trade_block(kt, d_ns, entry_spread, exit_spread, gross, float(cost), net, z_lag,
+                         raw=np.full_like(s, np.nan) if is_pct else s, intraday=intraday, path_px=px, pnl_mult=mult,
+                         const={"pair": pair, "spread_scale": float(spread_scale),
+                                "notional": float(args.notional), "cost_legs": 1})
+
+    if not len(trades):
+        metrics = empty_metrics(pair, args)
+    else:
+        # vol/Sharpe/MaxDD/CAGR dal PnL mark-to-market giornaliero sull'intera serie
+        days, pnl = daily_pnl(mtm_pnl(kt, px, pnl_mult=mult, cost=cost), d_ns)
+        mtm = mtm_metrics(pnl, days, capital=args.notional)
+        hit = float((trades.net > 0).mean())
+        when = "timestamp" if intraday else "date"
+        start_eff = decode_when(trades.rec["entry_ns"].min(keepdims=True), when)[0]
+        end_eff = decode_when(trades.rec["exit_ns"].max(keepdims=True), when)[0]
         metrics = pd.DataFrame([{ "pair": pair, "start": str(start_eff), "end": str(end_eff),
-                                  "trades": len(trades), "net_pnl_total": float(trades["net_pnl"].sum()),
-                                  "CAGR": 0.0, "vol_annualized": float(vol_ann),
-                                  "Sharpe": float(sharpe), "MaxDD": maxdd, "hit_rate": hit }])
+                                  "trades": len(trades), "net_pnl_total": float(trades.net.sum()),
+                                  "CAGR": mtm["CAGR"], "vol_annualized": mtm["vol_annualized"],
+                                  "Sharpe": mtm["Sharpe"], "MaxDD": mtm["MaxDD"], "hit_rate": hit }])
 
     return trades, metrics
 
 
-# ------------------ main ------------------
+def backtest_pair(df: pd.DataFrame, pair: str, args) -> Tuple[Optional[TradeBlock], pd.DataFrame]:
+    p = prepare_pair(df, args)
+    if p is None:
+        return None, empty_metrics(pair, args)
+    return backtest_prepared(pair, args=args, **p)
 
-def main():
-    args = parse_args()
-    ensure_dir(args.outdir)
 
+def load_pairs(args) -> List[Tuple[str, pd.DataFrame]]:
+    """Legge l'input e ritorna [(pair, righe)] delle coppie richieste (ordinate per pair)."""
     df = pd.read_csv(args.input)
 
     # filtra le coppie richieste
@@ -267,22 +246,26 @@ def main():
         if df.empty:
             sys.exit("Nessuna riga per le coppie richieste")
 
-    trades_all = []
+    if "pair" in df.columns:
+        return [(pair, g.copy()) for pair, g in df.groupby("pair")]
+    return [("UNKNOWN", df.copy())]
+
+
+# ------------------ main ------------------
+
+def main():
+    args = parse_args()
+    ensure_dir(args.outdir)
+
+    trades_log = TradeLog()
     metrics_all = []
 
-    if "pair" in df.columns:
-        for pair, g in df.groupby("pair"):
-            t, m = backtest_pair(g.copy(), pair, args)
-            if not t.empty:
-                trades_all.append(t)
-            metrics_all.append(m)
-    else:
-        t, m = backtest_pair(df.copy(), "UNKNOWN", args)
-        if not t.empty:
-            trades_all.append(t)
+    for pair, g in load_pairs(args):
+        t, m = backtest_pair(g, pair, args)
+        trades_log.append(t)
         metrics_all.append(m)
 
-    trades_all = pd.concat(trades_all, ignore_index=True) if trades_all else pd.DataFrame(columns=["pair","net_pnl"])
+    trades_all = trades_log.to_frame(SIGNALS_COLUMNS) if len(trades_log) else pd.DataFrame(columns=["pair","net_pnl"])
     metrics_all = pd.concat(metrics_all, ignore_index=True) if metrics_all else pd.DataFrame()
 
     # salva
@@ -293,7 +276,11 @@ def main():
     trades_all.to_csv(trades_path, index=False)
     metrics_all.to_csv(metrics_path, index=False)
 
-    # equity
+    # equity (matplotlib importato solo qui: l'uso come libreria, es.
+    # optimize_params, non ne paga l'import)
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(9,4))
     if not trades_all.empty:
         plt.plot(trades_all["net_pnl"].cumsum().values)
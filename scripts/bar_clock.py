@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — barre intraday: durate, finestre temporali e orologio delle barre
+
+Gli engine nascono su barre giornaliere: finestre z, max_hold e latency
+contano barre, days_held è una differenza di indici. Con barre al minuto o
+orarie (es. dislocazioni intraday LSE/Xetra) le finestre vanno espresse in
+tempo: una finestra di 60 barre a inizio seduta pescherebbe nella seduta
+precedente, una di "60min" no.
+
+Convenzione per le opzioni CLI (z_window, max_hold, griglie):
+  "60"            -> 60 barre (int, comportamento storico)
+  "90min", "4h",
+  "2d"            -> durata (pd.Timedelta): finestra (t - W, t] sui timestamp
+
+Tutto lavora su timestamp int64 ns ordinati (come fold_plan/feature_cache):
+  window_starts(ts, W)  -> primo indice della finestra temporale di ogni barra
+  hold_deadline(ts, H)  -> prima barra con t >= t_entry + H (timeout di max_hold)
+entrambi con searchsorted, O(n log n), senza loop Python.
+
+Download (fetch_prices.py, run_mvp.py): default_period(interval) rispetta i
+limiti di storico intraday di yfinance; interval_suffix(interval) separa i
+file intraday da quelli giornalieri (SWDA_L.csv vs SWDA_L_5m.csv).
+"""
+from __future__ import annotations
+import math
+from typing import List, Union
+import numpy as np
+import pandas as pd
+
+from bt_kernel import DAY_NS
+
+Duration = Union[int, pd.Timedelta]
+
+
+def parse_duration(spec) -> Duration:
+    """"60" -> 60 barre; "90min" / "4h" / "2d" -> pd.Timedelta."""
+    if isinstance(spec, (int, np.integer)) or isinstance(spec, pd.Timedelta):
+        return spec
+    s = str(spec).strip()
+    try:
+        return int(float(s))
+    except ValueError:
+        return pd.Timedelta(s)
+
+
+def parse_durations(s) -> List[Duration]:
+    """Lista separata da virgola; barre e durate non si mescolano."""
+    vals = [parse_duration(x) for x in str(s).split(",") if x.strip()]
+    if len({isinstance(v, pd.Timedelta) for v in vals}) > 1:
+        raise SystemExit(f"Valori misti barre/durate in '{s}': usare solo interi o solo durate (es. 30min,60min)")
+    return vals
+
+
+def parse_days(spec) -> Duration:
+    """--train-days/--test-days/--step-days: intero = giorni (int, storico), oppure durata (es. 36h)."""
+    return parse_duration(spec)
+
+
+def is_time(v) -> bool:
+    return isinstance(v, pd.Timedelta)
+
+
+def fmt_duration(v: Duration) -> str:
+    """Per gli output: interi invariati, durate come stringa compatta (90min, 4h, 2d)."""
+    if not is_time(v):
+        return v
+    try:
+        f = pd.tseries.frequencies.to_offset(v).freqstr
+        return f if f[0].isdigit() else "1" + f
+    except ValueError:
+        return str(v)
+
+
+# yfinance limita lo storico intraday: 1m ~7 giorni, <=90m ~60 giorni, 60m/1h ~2 anni
+DEFAULT_PERIOD = {"1m": "7d", "2m": "60d", "5m": "60d", "15m": "60d", "30m": "60d",
+                  "60m": "730d", "90m": "60d", "1h": "730d"}
+
+
+def default_period(interval: str) -> str:
+    """Storico yfinance di default per l'interval (2y per le barre giornaliere o più lunghe)."""
+    return DEFAULT_PERIOD.get(interval, "2y")
+
+
+def interval_suffix(interval: str) -> str:
+    """Suffisso dei file scaricati: "" per 1d (nomi storici), "_5m", "_1h", ... per le altre barre."""
+    return "" if interval == "1d" else f"_{interval}"
+
+
+def bar_ns(ts: np.ndarray) -> int:
+    """Passo tipico delle barre (mediana delle differenze positive), in ns."""
+    d = np.diff(np.asarray(ts, dtype=np.int64))
+    d = d[d > 0]
+    return int(np.median(d)) if d.size else DAY_NS
+
+
+def is_intraday(ts: np.ndarray) -> bool:
+    """Barre più fitte del giorno (con qualche tolleranza per i buchi di calendario)."""
+    return bar_ns(ts) < DAY_NS // 2
+
+
+def window_bars(window: Duration, step_ns: int) -> int:
+    """Finestra in barre equivalenti (per filtri di lunghezza e warm-up)."""
+    if not is_time(window):
+        return int(window)
+    return max(1, int(math.ceil(window.value / max(int(step_ns), 1))))
+
+
+def default_min_periods(window: Duration, step_ns: int = DAY_NS) -> int:
+    """max(5, finestra // 4) come lo z storico, con la finestra in barre equivalenti."""
+    return max(5, window_bars(window, step_ns) // 4)
+
+
+def window_starts(ts: np.ndarray, window: pd.Timedelta) -> np.ndarray:
+    """Per ogni barra i, primo indice con ts > ts[i] - window: finestra (t - W, t] come rolling("W") di pandas."""
+    t = np.asarray(ts, dtype=np.int64)
+    return np.searchsorted(t, t - int(window.value), side="right")
+
+
+def hold_deadline(ts: np.ndarray, hold: pd.Timedelta) -> np.ndarray:
+    """Per ogni barra e, prima barra j con ts[j] >= ts[e] + hold (len(ts) se oltre la fine)."""
+    t = np.asarray(ts, dtype=np.int64)
+    return np.searchsorted(t, t + int(hold.value), side="left")
+
+
+def elapsed_days(ts: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Tempo trascorso tra le barre a e b in giorni (float): days_held sulle barre intraday."""
+    t = np.asarray(ts, dtype=np.int64)
+    return (t[b] - t[a]) / DAY_NS
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — benchmark di scalabilità degli engine (offline, dati sintetici)
+
+Misura throughput e memoria dei percorsi caldi:
+  backtest_on_series  (WF v1, una serie; _lean: mtm=False, paths=False)
+  series_loop_ref     (loop per barra originale di backtest_on_series, riferimento)
+  simulate_trades     (WF v2, una serie)
+  backtest_pair       (backtest_signals, loop sulle pair)
+  evaluate_grid       (kernel a griglia, combinazioni x barre)
+  wf_v1 / wf_v2       (main del walk-forward: loop completo sui fold)
+su spread sintetici AR(1) mean-reverting (seed fisso), al variare di
+barre per pair, numero di pair e combinazioni della griglia.
+
+Ogni caso gira in un processo nuovo (spawn): il picco di RSS
+(ru_maxrss) è quello del caso, non dei precedenti. Tempo = migliore di
+--repeat ripetizioni. Metriche per caso:
+  wall_s, bars_per_s (barre x pair / s; evaluate_grid: barre x combo / s),
+  combos_per_s (combinazioni x pair / s), peak_rss_mb, base_rss_mb
+  (processo dopo gli import, prima dei dati).
+
+Suite:
+  quick  barre 1k-100k, pair 1-10, griglie 1-100 (default, ~1 min)
+  full   barre 1k-1M, pair 1-500, griglie 1-10k (lungo)
+--bars/--pairs/--combos sostituiscono gli assi della suite, --cases filtra.
+
+Ogni run è aggiunto a uno storico JSON (--history) con commit git,
+versioni e host; il report confronta ogni caso con lo stesso caso del
+run precedente (rapporto dei tempi) e segnala le regressioni oltre
+--tolerance.
+
+Obiettivo: backtest_on_series >= SPEEDUP_TARGET (50x) rispetto al loop
+per barra sulla stessa serie. Ogni run con entrambi i casi stampa e salva
+lo speedup per barre (campo "speedup" nello storico) e avvisa se sotto
+obiettivo. Misura attuale: ~8x completo (z-score + MTM + MAE/MFE) e ~18x
+lean su 10 anni giornalieri (2520 barre), ~20x / ~29x a 100k barre; a
+quelle dimensioni il costo fisso (z-score pandas, blocco trade) domina sul
+kernel, per cui l'obiettivo resta aperto e tracciato qui.
+
+Esempio:
+  python scripts/bench_engines.py --suite quick
+  python scripts/bench_engines.py --cases evaluate_grid --combos 1,100,1000 --bars 10000
+"""
+from __future__ import annotations
+import argparse, contextlib, io, json, os, platform, resource, subprocess, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Dict, List
+import numpy as np
+import pandas as pd
+
+from synth_market import ar1_filter
+
+CASES = ["backtest_on_series", "backtest_on_series_lean", "series_loop_ref", "simulate_trades", "backtest_pair", "evaluate_grid", "wf_v1", "wf_v2"]
+
+SUITES = {
+    "quick": dict(bars=[1_000, 10_000, 100_000], pairs=[1, 10], combos=[1, 100]),
+    "full":  dict(bars=[1_000, 10_000, 100_000, 1_000_000], pairs=[1, 10, 100, 500], combos=[1, 100, 1_000, 10_000]),
+}
+# punti fissi degli assi non variati (barre per pair nei casi multi-pair / WF)
+BASE_BARS, WF_BARS, BASE_COMBOS = 10_000, 2_000, 27
+DAILY_MAX_BARS = 50_000   # oltre: barre orarie (le date giornaliere uscirebbero dal range di pandas)
+
+Z_ENTER, Z_EXIT, Z_STOP, MAX_HOLD, Z_WINDOW, NOTIONAL = 2.0, 0.5, 4.0, 10, 60, 250_000.0
+SPEEDUP_TARGET = 50.0      # backtest_on_series vs series_loop_ref
+LOOP_REF_MAX_BARS = 100_000   # il loop per barra oltre è solo lento
+
+
+# ------------------ dati sintetici ------------------
+
+def synth_spread(n: int, seed: int, phi: float = 0.97, sigma: float = 0.01) -> np.ndarray:
+    """AR(1) mean-reverting: s_t = phi * s_{t-1} + eps (synth_market.ar1_filter)."""
+    return ar1_filter(np.random.default_rng(seed).normal(0.0, sigma, n), phi)
+
+
+def synth_clock(n: int) -> np.ndarray:
+    """Timestamp int64 ns UTC: giornalieri fino a DAILY_MAX_BARS barre, poi orari."""
+    step = pd.Timedelta(days=1) if n <= DAILY_MAX_BARS else pd.Timedelta(hours=1)
+    return pd.Timestamp("1990-01-01", tz="UTC").value + np.arange(n, dtype=np.int64) * step.value
+
+
+def grid_lists(k: int) -> Dict[str, List[float]]:
+    """Griglia di circa k combinazioni valide (z_exit < z_enter < z_stop), fattori bilanciati."""
+    ne = max(1, int(round(k ** (1 / 3))))
+    nx = max(1, int(round((k / ne) ** 0.5)))
+    nh = max(1, int(round(k / (ne * nx))))
+    return dict(z_enter=list(np.round(np.linspace(2.0, 3.5, ne), 4)),
+                z_exit=list(np.round(np.linspace(0.0, 1.5, nx), 4)),
+                z_stop=[Z_STOP], max_hold=list(range(3, 3 + nh)), latency=[0])
+
+
+def write_long_csv(path: Path, bars: int, pairs: int) -> List[str]:
+    names = [f"BENCH_{p:03d}" for p in range(pairs)]
+    t = pd.to_datetime(synth_clock(bars), utc=True)
+    parts = [pd.DataFrame({"date": t, "pair": name, "spread_raw": synth_spread(bars, seed=p), "spread_scale": 1.0})
+             for p, name in enumerate(names)]
+    pd.concat(parts, ignore_index=True).to_csv(path, index=False)
+    return names
+
+
+# ------------------ casi ------------------
+
+def _wf_fold_args(bars: int) -> List[str]:
+    """TRAIN/TEST/STEP in proporzione alla storia (12% / 3% / 3%): ~29 fold a ogni scala."""
+    span_days = (synth_clock(bars)[-1] - synth_clock(bars)[0]) / pd.Timedelta(days=1).value
+    d = lambda f: str(max(1, int(span_days * f)))
+    return ["--train-days", d(0.12), "--test-days", d(0.03), "--step-days", d(0.03)]
+
+
+def _wf_grid_args(k: int) -> List[str]:
+    g = grid_lists(k)
+    j = lambda v: ",".join(str(x) for x in v)
+    return ["--grid-z-enter", j(g["z_enter"]), "--grid-z-exit", j(g["z_exit"]), "--grid-z-stop", j(g["z_stop"]),
+            "--grid-max-hold", j(g["max_hold"]), "--latency-days", "0"]
+
+
+def series_loop_ref(dates: pd.Series, spread: pd.Series, params, ctx) -> pd.DataFrame:
+    """
+    Loop per barra di backtest_on_series prima del kernel (z-score pandas,
+    stato in Python, una riga dict per trade): base dello speedup.
+    """
+    from walkforward_backtest import zscore, compute_pnl
+    z = zscore(spread.astype(float), ctx.z_window)
+    in_pos, direction, entry_i, rows = False, None, None, []
+    for i in range(len(spread)):
+        zi = z.iat[i]
+        if np.isnan(zi):
+            continue
+        if not in_pos:
+            if ctx.side in ("short", "both") and zi >= params.z_enter:
+                in_pos, direction, entry_i = True, "SHORT_SPREAD", i
+            elif ctx.side in ("long", "both") and zi <= -params.z_enter:
+                in_pos, direction, entry_i = True, "LONG_SPREAD", i
+        if not in_pos:
+            continue
+        sgn = 1 if direction == "SHORT_SPREAD" else -1
+        if sgn * zi <= params.z_exit:
+            reason = "MEAN_REVERT"
+        elif sgn * zi >= params.z_stop:
+            reason = "STOP"
+        elif i - entry_i >= params.max_hold:
+            reason = "TIMEOUT"
+        else:
+            continue
+        e, x = float(spread.iat[entry_i]), float(spread.iat[i])
+        rows.append({"entry_date": pd.to_datetime(dates.iat[entry_i]).date(),
+                     "exit_date": pd.to_datetime(dates.iat[i]).date(),
+                     "entry_spread_eff": e, "exit_spread_eff": x, "direction": direction,
+                     "days_held": int(i - entry_i),
+                     "net_pnl": float(compute_pnl(direction, e, x, is_pct=ctx.is_pct,
+                                                  spread_scale=ctx.spread_scale, notional=ctx.notional,
+                                                  fee_bps=ctx.fee_bps, slippage_bps=ctx.slippage_bps)),
+                     "entry_z": float(z.iat[entry_i]), "exit_z": float(zi), "reason_exit": reason})
+        in_pos, direction, entry_i = False, None, None
+    return pd.DataFrame(rows)
+
+
+def prepare_case(case: Dict[str, Any], tmp: Path):
+    """Dati e funzione da cronometrare (fuori dal tempo misurato)."""
+    name, bars, pairs, combos = case["case"], case["bars"], case["pairs"], case["combos"]
+    d_ns = synth_clock(bars)
+    s = synth_spread(bars, seed=0)
+
+    if name in ("backtest_on_series", "backtest_on_series_lean", "series_loop_ref"):
+        from walkforward_backtest import backtest_on_series, BTParams, BTContext
+        params = BTParams(z_enter=Z_ENTER, z_exit=Z_EXIT, z_stop=Z_STOP, max_hold=MAX_HOLD, latency=0)
+        ctx = BTContext(is_pct=False, spread_scale=1.0, notional=NOTIONAL, fee_bps=0.0, slippage_bps=0.0,
+                        side="both", z_window=Z_WINDOW)
+        if name == "series_loop_ref":
+            dates, spread = pd.Series(pd.to_datetime(d_ns, utc=True)), pd.Series(s)
+            return lambda: series_loop_ref(dates, spread, params, ctx)
+        lean = name == "backtest_on_series_lean"
+        return lambda: backtest_on_series(d_ns, s, params, ctx, mtm=not lean, paths=not lean)
+
+    if name == "simulate_trades":
+        from walkforward_backtest_v2 import simulate_trades
+        df = pd.DataFrame({"ts": pd.to_datetime(d_ns, utc=True), "spread_eff": s})
+        return lambda: simulate_trades(df, side="both", z_enter=Z_ENTER, z_exit=Z_EXIT, z_stop=Z_STOP,
+                                       max_hold=MAX_HOLD, latency_days=0, notional=NOTIONAL, fee_bps=0.0,
+                                       slippage_bps=0.0, fold_id=1, pair="BENCH", sign=1, z_window=Z_WINDOW)
+
+    if name == "backtest_pair":
+        import backtest_signals as bs
+        with _argv(["backtest_signals", "--side", "both", "--z-enter", str(Z_ENTER), "--z-exit", str(Z_EXIT),
+                    "--max-hold", str(MAX_HOLD), "--z-window", str(Z_WINDOW)]):
+            args = bs.parse_args()
+        t = pd.to_datetime(d_ns, utc=True)
+        frames = [(f"BENCH_{p:03d}", pd.DataFrame({"date": t, "spread_raw": synth_spread(bars, seed=p)}))
+                  for p in range(pairs)]
+        return lambda: [bs.backtest_pair(g, pair, args) for pair, g in frames]
+
+    if name == "evaluate_grid":
+        from bt_kernel import evaluate_grid, grid_combos
+        from feature_cache import rolling_features
+        g = grid_lists(combos)
+        grid = grid_combos(g["z_enter"], g["z_exit"], g["z_stop"], g["max_hold"], g["latency"])
+        case["combos"] = len(grid)
+        z = rolling_features(s, Z_WINDOW).z
+        return lambda: evaluate_grid(z, s, grid, side="both", pnl_mult=NOTIONAL, cost=0.0)
+
+    if name in ("wf_v1", "wf_v2"):
+        src = tmp / "bench_long.csv"
+        names = write_long_csv(src, bars, pairs)
+        g = grid_lists(combos)
+        case["combos"] = len(g["z_enter"]) * len(g["z_exit"]) * len(g["max_hold"])
+        argv = ["--input", str(src), "--side", "both", *_wf_fold_args(bars), *_wf_grid_args(combos)]
+        if name == "wf_v1":
+            import walkforward_backtest as wf
+            argv = ["walkforward_backtest", *argv, "--outdir", str(tmp / "out")]
+            return lambda: _run_main(wf.main, argv)
+        import walkforward_backtest_v2 as wf2
+        pf = tmp / "pairs.csv"
+        pd.DataFrame({"pair": names}).to_csv(pf, index=False)
+        argv = ["walkforward_backtest_v2", *argv, "--pairs-file", str(pf), "--z-window", str(Z_WINDOW)]
+        return lambda: _run_main(wf2.main, argv, cwd=tmp)   # v2 scrive in ./reports
+
+    raise SystemExit(f"Caso sconosciuto: {name}")
+
+
+@contextlib.contextmanager
+def _argv(argv):
+    old = sys.argv
+    sys.argv = list(argv)
+    try:
+        yield
+    finally:
+        sys.argv = old
+
+
+def _run_main(main_fn, argv, cwd=None):
+    old = os.getcwd()
+    try:
+        if cwd is not None:
+            os.chdir(cwd)
+        with _argv(argv), contextlib.redirect_stdout(io.StringIO()):
+            main_fn()
+    finally:
+        os.chdir(old)
+
+
+def _rss_mb(maxrss: int) -> float:
+    # Linux: KB; macOS: byte
+    return maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_case(case: Dict[str, Any], repeat: int) -> Dict[str, Any]:
+    """Esegue un caso (nel processo corrente): migliore di `repeat` tempi + picco RSS."""
+    base = _rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    case = dict(case)
+    with tempfile.TemporaryDirectory(prefix="arbisense_bench_") as tmp:
+        fn = prepare_case(case, Path(tmp))
+        times = []
+        for _ in range(max(1, repeat)):
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+    wall = min(times)
+    bar_units = case["bars"] * (case["combos"] if case["case"] == "evaluate_grid" else case["pairs"])
+    return dict(case, wall_s=wall, bars_per_s=bar_units / wall if wall > 0 else float("inf"),
+                combos_per_s=case["combos"] * case["pairs"] / wall if wall > 0 else float("inf"),
+                peak_rss_mb=_rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss), base_rss_mb=base)
+
+
+def plan_cases(suite: Dict[str, List[int]], cases: List[str]) -> List[Dict[str, Any]]:
+    """Sweep per asse: barre (serie singola), pair (loop multi-pair / WF), griglia (kernel / WF)."""
+    out = []
+    mk = lambda c, b, p, k: dict(case=c, bars=b, pairs=p, combos=k)
+    for c in cases:
+        if c in ("backtest_on_series", "backtest_on_series_lean", "simulate_trades"):
+            out += [mk(c, b, 1, 1) for b in suite["bars"]]
+        elif c == "series_loop_ref":
+            out += [mk(c, b, 1, 1) for b in suite["bars"] if b <= LOOP_REF_MAX_BARS]
+        elif c == "backtest_pair":
+            out += [mk(c, b, 1, 1) for b in suite["bars"]]
+            out += [mk(c, BASE_BARS, p, 1) for p in suite["pairs"] if p > 1]
+        elif c == "evaluate_grid":
+            out += [mk(c, b, 1, BASE_COMBOS) for b in suite["bars"]]
+            out += [mk(c, BASE_BARS, 1, k) for k in suite["combos"] if k != BASE_COMBOS]
+        elif c in ("wf_v1", "wf_v2"):
+            out += [mk(c, WF_BARS, p, BASE_COMBOS) for p in suite["pairs"]]
+            out += [mk(c, WF_BARS, 1, k) for k in suite["combos"] if k != BASE_COMBOS]
+    # dedup mantenendo l'ordine
+    seen, uniq = set(), []
+    for c in out:
+        key = tuple(c.values())
+        if key not in seen:
+            seen.add(key); uniq.append(c)
+    return uniq
+
+
+# ------------------ storico e confronto ------------------
+
+def case_key(r: Dict[str, Any]) -> str:
+    return f"{r['case']}|bars={r['bars']}|pairs={r['pairs']}|combos={r['combos']}"
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, timeout=10).stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+
+def load_history(path: Path) -> List[Dict[str, Any]]:
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return json.load(f).get("runs", [])
+
+
+def compare(prev: Dict[str, Any], cur: Dict[str, Any], tolerance: float) -> pd.DataFrame:
+    """Casi in comune col run precedente: ratio = wall attuale / wall precedente (>1 = più lento)."""
+    old = {case_key(r): r for r in prev.get("results", [])}
+    rows = []
+    for r in cur["results"]:
+        o = old.get(case_key(r))
+        if o is None:
+            continue
+        ratio = r["wall_s"] / o["wall_s"] if o["wall_s"] > 0 else float("nan")
+        rows.append({"case": r["case"], "bars": r["bars"], "pairs": r["pairs"], "combos": r["combos"],
+                     "wall_prev_s": o["wall_s"], "wall_s": r["wall_s"], "ratio": ratio,
+                     "rss_prev_mb": o["peak_rss_mb"], "rss_mb": r["peak_rss_mb"],
+                     "status": "REGRESSION" if ratio > 1 + tolerance else
+                               "FASTER" if ratio < 1 - tolerance else "same"})
+    return pd.DataFrame(rows)
+
+
+def speedups(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """backtest_on_series(_lean) vs series_loop_ref alle stesse barre."""
+    ref = {r["bars"]: r["wall_s"] for r in results if r["case"] == "series_loop_ref"}
+    return [{"case": r["case"], "bars": r["bars"], "speedup": ref[r["bars"]] / r["wall_s"],
+             "target": SPEEDUP_TARGET}
+            for r in results
+            if r["case"] in ("backtest_on_series", "backtest_on_series_lean") and r["bars"] in ref and r["wall_s"] > 0]
+
+
+def main():
+    ap = argparse.ArgumentParser("ArbiSense engine benchmark")
+    ap.add_argument("--suite", choices=sorted(SUITES), default="quick")
+    ap.add_argument("--cases", default=",".join(CASES), help=f"sottoinsieme di {','.join(CASES)}")
+    ap.add_argument("--bars", default=None, help="assi barre della suite (es. 1000,100000)")
+    ap.add_argument("--pairs", default=None, help="asse pair (es. 1,50)")
+    ap.add_argument("--combos", default=None, help="asse griglia (es. 1,1000)")
+    ap.add_argument("--repeat", type=int, default=3, help="ripetizioni per caso (vale il tempo migliore)")
+    ap.add_argument("--inline", action="store_true",
+                    help="tutti i casi nel processo corrente (più veloce, RSS non isolato per caso)")
+    ap.add_argument("--history", default="reports/bench_history.json")
+    ap.add_argument("--report", default="reports/bench_compare.csv")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="variazione di tempo oltre cui segnalare")
+    ap.add_argument("--label", default="", help="etichetta libera del run (es. nome del branch)")
+    args = ap.parse_args()
+
+    suite = dict(SUITES[args.suite])
+    for axis in ("bars", "pairs", "combos"):
+        if getattr(args, axis):
+            suite[axis] = [int(float(x)) for x in getattr(args, axis).split(",") if x.strip()]
+    cases = [c.strip() for c in args.cases.split(",") if c.strip()]
+    unknown = sorted(set(cases) - set(CASES))
+    if unknown:
+        raise SystemExit(f"Casi sconosciuti: {unknown} (disponibili: {CASES})")
+
+    plan = plan_cases(suite, cases)
+    print(f"[INFO] suite={args.suite}: {len(plan)} casi, repeat={args.repeat}")
+    results = []
+    for c in plan:
+        if args.inline:
+            r = run_case(c, args.repeat)
+        else:
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as ex:
+                r = ex.submit(run_case, c, args.repeat).result()
+        results.append(r)
+        print(f"  {case_key(r):<52} {r['wall_s']*1e3:10.1f} ms  {r['bars_per_s']:12.0f} bars/s  "
+              f"{r['combos_per_s']:10.1f} combos/s  {r['peak_rss_mb']:7.1f} MB")
+
+    run = dict(timestamp=pd.Timestamp.now(tz="UTC").isoformat(timespec="seconds"), label=args.label,
+               git=git_commit(), suite=args.suite, repeat=args.repeat, inline=args.inline,
+               python=platform.python_version(), numpy=np.__version__, pandas=pd.__version__,
+               host=platform.node(), machine=platform.machine(), cpus=os.cpu_count(), results=results,
+               speedup=speedups(results))
+    for sp in run["speedup"]:
+        tag = "[OK]" if sp["speedup"] >= sp["target"] else "[WARN]"
+        print(f"{tag} {sp['case']} bars={sp['bars']}: x{sp['speedup']:.1f} vs loop per barra "
+              f"(obiettivo x{sp['target']:.0f})")
+
+    history_path = Path(args.history)
+    runs = load_history(history_path)
+    prev = runs[-1] if runs else None
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(history_path, "w") as f:
+        json.dump({"runs": runs + [run]}, f, indent=1)
+    print(f"[WROTE] {history_path} ({len(runs) + 1} run)")
+
+    if prev is None:
+        print("[INFO] Nessun run precedente nello storico: niente confronto")
+        return
+    cmp = compare(prev, run, args.tolerance)
+    if cmp.empty:
+        print("[INFO] Nessun caso in comune col run precedente")
+        return
+    Path(args.report).parent.mkdir(parents=True, exist_ok=True)
+    cmp.to_csv(args.report, index=False)
+    print(f"[INFO] confronto con {prev['timestamp']} (git {prev.get('git', '?')}):")
+    for r in cmp.itertuples():
+        print(f"  {r.case:<20} bars={r.bars:<8} pairs={r.pairs:<4} combos={r.combos:<6} "
+              f"{r.wall_prev_s*1e3:10.1f} -> {r.wall_s*1e3:10.1f} ms  x{r.ratio:5.2f}  {r.status}")
+    n_reg = int((cmp["status"] == "REGRESSION").sum())
+    if n_reg:
+        print(f"[WARN] {n_reg} casi più lenti di oltre {args.tolerance:.0%}")
+    print(f"[WROTE] {args.report}")
+
+
+if __name__ == "__main__":
+    main()
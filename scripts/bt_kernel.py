@@ -0,0 +1,784 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — kernel condiviso del backtest z-score (array-native)
+
+Macchina a stati entry/exit (side short/long/both, z_enter/z_exit/z_stop,
+max_hold, latency) che lavora su array float64 contigui e restituisce i trade
+come array compatti di indici. Le barre flat non vengono visitate: la prossima
+entry si trova con bisect sugli indici candidati (maschera numpy), e in Python
+si scandiscono solo le barre in posizione: il costo è O(trade * holding), non O(barre).
+
+Usato da:
+    backtest_signals.py (root)         -> backtest_pair
+    scripts/backtest_signals.py        -> backtest_pair
+    scripts/walkforward_backtest.py    -> backtest_on_series
+    scripts/walkforward_backtest_v2.py -> simulate_trades
+    scripts/train_sign_helper.py       -> simulate_pnl
+    scripts/mc_bootstrap.py            -> run_kernel_paths (percorsi bootstrap in batch)
+
+Semantiche supportate (quelle storiche dei vari engine):
+  - deferred=False (WF v1 / backtest_pair): lo z passato è già "latency-shifted",
+    entry ed exit possono cadere sulla stessa barra, il timeout scatta alla
+    prima barra con z valido dopo max_hold barre.
+  - timeout_on_nan=True (train_sign_helper): il timeout scatta anche se lo z
+    della barra è NaN.
+  - deferred=True (WF v2): segnale su z[i], esecuzione a min(i+exec_delay, n-1),
+    nessuna uscita sulla barra di entry, max_hold conta solo le barre con z valido.
+  - max_hold a tempo (barre intraday, bar_clock): `hold_until[e]` è la prima
+    barra da cui scatta il timeout per un'entry su e (bar_clock.hold_deadline);
+    nella griglia `ts` + colonna max_hold in ns.
+"""
+from __future__ import annotations
+from bisect import bisect_left
+from dataclasses import dataclass
+from itertools import product
+from typing import Dict, Optional, Tuple
+import numpy as np
+
+# versione dell'engine nelle chiavi della cache dei risultati (result_cache):
+# da incrementare quando cambia la semantica di simulazione/metriche
+ENGINE_VERSION = "5"   # 2: metriche da PnL mark-to-market giornaliero; 3: trade colonnari (trade_records);
+                       # 4: MAE/MFE per trade; 5: cubo (--cube) con TEST MTM e MaxDD_trade da picco 0
+
+DIR_SHORT = -1   # SHORT_SPREAD (guadagna se lo spread scende)
+DIR_LONG  = +1   # LONG_SPREAD  (guadagna se lo spread sale)
+
+REASON_MEAN_REVERT = 0
+REASON_STOP        = 1
+REASON_TIMEOUT     = 2
+
+DIRECTION_NAMES = np.array(["SHORT_SPREAD", "", "LONG_SPREAD"], dtype=object)  # indicizzato con direction+1
+REASON_NAMES    = np.array(["MEAN_REVERT", "STOP", "TIMEOUT"], dtype=object)
+
+
+@dataclass
+class KernelTrades:
+    """Trade compatti: un elemento per trade chiuso."""
+    entry_i: np.ndarray    # int64, barra di esecuzione entry
+    exit_i: np.ndarray     # int64, barra di esecuzione exit
+    direction: np.ndarray  # int8, DIR_SHORT | DIR_LONG
+    reason: np.ndarray     # int8, REASON_*
+    held: np.ndarray       # int64, barre di holding (semantica dell'engine)
+
+    def __len__(self) -> int:
+        return int(self.entry_i.shape[0])
+
+    def direction_names(self) -> np.ndarray:
+        return DIRECTION_NAMES[self.direction.astype(np.int64) + 1]
+
+    def reason_names(self) -> np.ndarray:
+        return REASON_NAMES[self.reason.astype(np.int64)]
+
+
+def as_f64(x) -> np.ndarray:
+    """Vista float64 contigua (copia solo se serve)."""
+    return np.ascontiguousarray(np.asarray(x, dtype=np.float64))
+
+
+def shift_array(x: np.ndarray, k: int) -> np.ndarray:
+    """Equivalente di Series.shift(k) per k >= 0 (riempie con NaN)."""
+    x = as_f64(x)
+    if k <= 0:
+        return x
+    n = x.shape[0]
+    out = np.full_like(x, np.nan)
+    if k < n:
+        out[k:] = x[:n - k]
+    return out
+
+
+def _empty_trades() -> KernelTrades:
+    e = np.empty(0, dtype=np.int64)
+    return KernelTrades(e, e.copy(), np.empty(0, dtype=np.int8), np.empty(0, dtype=np.int8), e.copy())
+
+
+def run_kernel(z: np.ndarray, *, side: str, z_enter: float, z_exit: float, z_stop: float,
+               max_hold: int, exec_delay: int = 0, deferred: bool = False,
+               timeout_on_nan: bool = False, hold_until: Optional[np.ndarray] = None) -> KernelTrades:
+    """
+    Esegue la macchina a stati su `z` e ritorna i trade chiusi (le posizioni aperte a fine serie sono scartate).
+    hold_until: timeout a tempo (max_hold ignorato), scatta alla prima barra
+    j >= hold_until[e] con z valido.
+    """
+    z = as_f64(z)
+    n = z.shape[0]
+    if n == 0:
+        return _empty_trades()
+
+    want_short = side in ("short", "both")
+    want_long  = side in ("long", "both")
+    if not (want_short or want_long):
+        raise ValueError(f"Side sconosciuto: {side}")
+
+    # barre candidate all'entry (i confronti con NaN sono False: niente segnali senza z)
+    if want_short and want_long:
+        cand = (z >= z_enter) | (z <= -z_enter)
+    elif want_short:
+        cand = z >= z_enter
+    else:
+        cand = z <= -z_enter
+    entries = np.flatnonzero(cand).tolist()
+    n_ent = len(entries)
+    if n_ent == 0:
+        return _empty_trades()
+
+    hold = max(int(max_hold), 1) if deferred else int(max_hold)
+    seg_len = max(hold, 0) + 2  # un trade senza NaN si chiude entro un segmento
+    last = n - 1
+    e_out, x_out, d_out, r_out, h_out = [], [], [], [], []
+    k = 0
+    pos = 0
+    while True:
+        k = bisect_left(entries, pos, k)
+        if k >= n_ent:
+            break
+        e = entries[k]
+        short = want_short and z[e] >= z_enter
+        d = DIR_SHORT if short else DIR_LONG
+        if hold_until is not None:
+            # timeout a tempo: stessa condizione (j - e) >= h con h dalla scadenza
+            hold = max(int(hold_until[e]) - e, 1 if deferred else 0)
+            seg_len = hold + 2
+
+        # scansione delle sole barre in posizione, a segmenti (tolist: accesso scalare veloce)
+        x, r, age = n, REASON_TIMEOUT, 0
+        j = e + 1 if deferred else e
+        while x == n and j < n:
+            for zj in z[j:j + seg_len].tolist():
+                if zj != zj:  # z NaN: nessuna uscita (salvo timeout_on_nan)
+                    if timeout_on_nan and j - e >= hold:
+                        x = j
+                        break
+                    j += 1
+                    continue
+                if deferred:
+                    age += 1
+                if short:
+                    if zj <= z_exit:
+                        x, r = j, REASON_MEAN_REVERT
+                        break
+                    if zj >= z_stop:
+                        x, r = j, REASON_STOP
+                        break
+                else:
+                    if zj >= -z_exit:
+                        x, r = j, REASON_MEAN_REVERT
+                        break
+                    if zj <= -z_stop:
+                        x, r = j, REASON_STOP
+                        break
+                if (age if deferred and hold_until is None else j - e) >= hold:
+                    x = j
+                    break
+                j += 1
+        if x >= n:
+            break  # posizione ancora aperta a fine serie
+
+        if deferred:
+            e_out.append(min(e + exec_delay, last))
+            x_out.append(min(x + exec_delay, last))
+            h_out.append(age)
+        else:
+            e_out.append(e)
+            x_out.append(x)
+            h_out.append(x - e)
+        d_out.append(d)
+        r_out.append(r)
+        pos = x + 1
+
+    if not e_out:
+        return _empty_trades()
+    return KernelTrades(
+        entry_i=np.asarray(e_out, dtype=np.int64),
+        exit_i=np.asarray(x_out, dtype=np.int64),
+        direction=np.asarray(d_out, dtype=np.int8),
+        reason=np.asarray(r_out, dtype=np.int8),
+        held=np.asarray(h_out, dtype=np.int64),
+    )
+
+
+# -------------------- griglia parametri (batch) --------------------
+
+# Sharpe_trade / MaxDD_trade: proxy per trade della griglia (selezione sul
+# TRAIN), diversi da Sharpe / MaxDD di mtm_metrics (PnL MTM giornaliero)
+GRID_METRICS = ("trades", "net_pnl_total", "Sharpe_trade", "MaxDD_trade", "hit_rate")
+G_TRADES, G_PNL, G_SHARPE_TRADE, G_MAXDD_TRADE, G_HIT = range(len(GRID_METRICS))
+
+
+def grid_combos(z_enter, z_exit, z_stop, max_hold, latency) -> np.ndarray:
+    """Matrice (combos x 5) nell'ordine di itertools.product (z_enter, z_exit, z_stop, max_hold, latency)."""
+    return np.array(list(product(z_enter, z_exit, z_stop, max_hold, latency)), dtype=np.float64).reshape(-1, 5)
+
+
+@dataclass
+class GridState:
+    """
+    Stato di evaluate_grid dopo le prime `n` barre: posizioni aperte per
+    combinazione (trade a cavallo del confine inclusi) e accumulatori delle
+    metriche. Passato a evaluate_grid su una serie che estende la precedente
+    (stesso inizio, es. TRAIN espandente), la simulazione riprende dalla
+    barra n invece di rifare il prefisso.
+    """
+    n: int
+    in_pos: np.ndarray
+    dirn: np.ndarray
+    entry_i: np.ndarray
+    entry_px: np.ndarray
+    age: np.ndarray
+    cnt: np.ndarray
+    tot: np.ndarray
+    mean: np.ndarray
+    m2: np.ndarray
+    wins: np.ndarray
+    eq: np.ndarray
+    eq_max: np.ndarray
+    mdd: np.ndarray
+
+    @classmethod
+    def start(cls, C: int) -> "GridState":
+        z = lambda: np.zeros(C)
+        return cls(0, np.zeros(C, dtype=bool), z(), np.zeros(C, dtype=np.int64), z(), np.zeros(C, dtype=np.int64),
+                   z(), z(), z(), z(), z(), z(), z(), z())
+
+    def copy(self) -> "GridState":
+        return GridState(self.n, *(getattr(self, f).copy() for f in self.__dataclass_fields__ if f != "n"))
+
+
+def evaluate_grid(z: np.ndarray, px: np.ndarray, combos: np.ndarray, *, side: str,
+                  pnl_mult: float, cost: float, deferred: bool = False,
+                  ts: Optional[np.ndarray] = None, state: Optional[GridState] = None) -> np.ndarray:
+    """
+    Valuta tutte le combinazioni in un solo passaggio sulle barre: lo stato
+    (in posizione, direzione, entry) è un vettore sulle combinazioni e ogni
+    barra aggiorna tutte le combinazioni insieme con operazioni numpy.
+
+    z:      z-score della serie (non laggato)
+    px:     prezzo di esecuzione (spread). Modalità laggata: px[i-lat] con
+            fallback a px[i] se NaN (come backtest_on_series); deferred:
+            px[min(i+lat, n-1)] (come simulate_trades)
+    combos: matrice (C x 5) da grid_combos
+    ts:     timestamp int64 ns: max_hold a tempo, colonna max_hold in ns
+            (timeout quando ts[i] - ts[entry] >= max_hold)
+    state:  GridState di una chiamata precedente su un prefisso di questa
+            serie: si simulano solo le barre nuove e lo stato viene
+            aggiornato sul posto. Con deferred le ultime max(latency) barre
+            (esecuzione tagliata a fine serie) sono simulate su una copia e
+            ripetute alla chiamata successiva: metriche identiche alla
+            valutazione da zero della serie intera
+    PnL trade = direction * (exit - entry) * pnl_mult - cost
+
+    Le barre in cui nessuna combinazione è in posizione e lo z non supera
+    la soglia di entry più bassa sono saltate (nessun effetto sullo stato):
+    sulle serie intraday lunghe si visitano solo le barre utili.
+
+    Ritorna una matrice (C x len(GRID_METRICS)); Sharpe_trade annualizzato
+    con sqrt(252/max_hold) sul PnL per trade (max_hold in giorni se a tempo),
+    MaxDD_trade sulla equity cumulata dei trade (picco iniziale 0, come MTM):
+    proxy economici per la selezione, non confrontabili con Sharpe/MaxDD
+    MTM di wf_metrics (per quelli: run_kernel_paths + mtm_metrics_paths).
+    """
+    z = as_f64(z)
+    px = as_f64(px)
+    combos = np.asarray(combos, dtype=np.float64).reshape(-1, 5)
+    n, C = z.shape[0], combos.shape[0]
+    out = np.zeros((C, len(GRID_METRICS)), dtype=np.float64)
+    if n == 0 or C == 0:
+        return out
+
+    want_short = side in ("short", "both")
+    want_long  = side in ("long", "both")
+    if not (want_short or want_long):
+        raise ValueError(f"Side sconosciuto: {side}")
+
+    ze, zx, zs = combos[:, 0], combos[:, 1], combos[:, 2]
+    mh = combos[:, 3].astype(np.int64)
+    lat = combos[:, 4].astype(np.int64)
+
+    # barre da visitare quando tutte le combinazioni sono flat: z oltre la soglia
+    # minima di entry (per ogni latency della griglia, nella modalità laggata)
+    ze_min = float(ze.min())
+    cand = np.zeros(n, dtype=bool)
+    if want_short:
+        cand |= z >= ze_min
+    if want_long:
+        cand |= z <= -ze_min
+    if not deferred:
+        cand = np.logical_or.reduce([shift_array(cand.astype(np.float64), int(L)) == 1.0
+                                     for L in np.unique(lat)])
+    starts = np.flatnonzero(cand).tolist()
+
+    def next_start(i: int) -> int:
+        k = bisect_left(starts, i)
+        return starts[k] if k < len(starts) else n
+
+    if ts is not None:
+        ts = np.asarray(ts, dtype=np.int64)
+
+    if deferred:
+        last = n - 1
+    else:
+        L = int(lat.max())
+        zpad = np.concatenate([np.full(L, np.nan), z])
+        ppad = np.concatenate([np.full(L, np.nan), px])
+        col = L - lat
+
+    def run(g: GridState, i: int, stop: int):
+        """Barre [i, stop) sullo stato g (aggiornato sul posto)."""
+        in_pos, dirn, entry_i, entry_px, age = g.in_pos, g.dirn, g.entry_i, g.entry_px, g.age
+        cnt, tot, mean, m2 = g.cnt, g.tot, g.mean, g.m2
+        wins, eq, eq_max, mdd = g.wins, g.eq, g.eq_max, g.mdd
+        held_for = (lambda i: ts[i] - ts[entry_i]) if ts is not None else None
+
+        def close(idx: np.ndarray, exit_px: np.ndarray):
+            pnl = dirn[idx] * (exit_px - entry_px[idx]) * pnl_mult - cost
+            c = cnt[idx] + 1.0
+            d = pnl - mean[idx]
+            mean[idx] += d / c
+            m2[idx] += d * (pnl - mean[idx])
+            cnt[idx] = c
+            tot[idx] += pnl
+            wins[idx] += pnl > 0
+            eq[idx] += pnl
+            eq_max[idx] = np.maximum(eq_max[idx], eq[idx])
+            mdd[idx] = np.minimum(mdd[idx], eq[idx] - eq_max[idx])
+            in_pos[idx] = False
+
+        def open_(can: np.ndarray, zi, entry_px_i: np.ndarray, i: int):
+            o_s = (can & (zi >= ze)) if want_short else np.zeros(C, dtype=bool)
+            o_l = (can & ~o_s & (zi <= -ze)) if want_long else np.zeros(C, dtype=bool)
+            opened = o_s | o_l
+            if opened.any():
+                dirn[o_s] = DIR_SHORT
+                dirn[o_l] = DIR_LONG
+                entry_i[opened] = i
+                entry_px[opened] = entry_px_i[opened]
+                age[opened] = 0
+                in_pos[opened] = True
+
+        def exit_mask(zi) -> np.ndarray:
+            short = dirn < 0
+            return np.where(short, (zi <= zx) | (zi >= zs), (zi >= -zx) | (zi <= -zs))
+
+        if deferred:
+            while i < stop:
+                if not in_pos.any():
+                    i = next_start(i)
+                    if i >= stop:
+                        break
+                zi = z[i]
+                if zi != zi:
+                    i += 1
+                    continue
+                can = ~in_pos
+                if not can.all():
+                    age += in_pos
+                    timed_out = (age >= mh) if held_for is None else (held_for(i) >= mh)
+                    ex = in_pos & (exit_mask(zi) | timed_out)
+                    idx = np.flatnonzero(ex)
+                    if idx.shape[0]:
+                        close(idx, px[np.minimum(i + lat[idx], last)])
+                open_(can, zi, px[np.minimum(i + lat, last)], i)
+                i += 1
+        else:
+            while i < stop:
+                if not in_pos.any():
+                    i = next_start(i)
+                    if i >= stop:
+                        break
+                zi = zpad[col + i]
+                pl = ppad[col + i]
+                pi = np.where(pl != pl, px[i], pl)
+                ok = zi == zi
+                open_(~in_pos & ok, zi, pi, i)
+                chk = in_pos & ok
+                if chk.any():
+                    timed_out = ((i - entry_i) >= mh) if held_for is None else (held_for(i) >= mh)
+                    ex = chk & (exit_mask(zi) | timed_out)
+                    idx = np.flatnonzero(ex)
+                    if idx.shape[0]:
+                        close(idx, pi[idx])
+                i += 1
+
+    if state is None:
+        g = GridState.start(C)
+        run(g, 0, n)
+    else:
+        if state.in_pos.shape[0] != C:
+            raise ValueError("GridState di un'altra griglia")
+        # barre con esecuzione entro la serie: stato riportabile alla chiamata successiva
+        safe = max(state.n, n - int(lat.max())) if deferred else n
+        run(state, state.n, safe)
+        state.n = safe
+        g = state
+        if safe < n:
+            g = state.copy()
+            run(g, safe, n)
+
+    cnt, mean, m2 = g.cnt, g.mean, g.m2
+    std = np.sqrt(np.divide(m2, cnt, out=np.zeros(C), where=cnt > 0))
+    ann = np.sqrt(252.0 / np.maximum(1, mh)) if ts is None else np.sqrt(252.0 * DAY_NS / np.maximum(1, mh))
+    out[:, G_TRADES] = cnt
+    out[:, G_PNL] = g.tot
+    out[:, G_SHARPE_TRADE] = np.divide(mean, std, out=np.zeros(C), where=std > 0) * ann
+    out[:, G_MAXDD_TRADE] = g.mdd
+    out[:, G_HIT] = np.divide(g.wins, cnt, out=np.zeros(C), where=cnt > 0)
+    return out
+
+
+# -------------------- percorsi multipli (batch) --------------------
+
+def run_kernel_paths(Z: np.ndarray, *, side: str, z_enter, z_exit, z_stop,
+                     max_hold: int, exec_delay: int = 0, deferred: bool = False,
+                     hold_until: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Stessa macchina a stati di run_kernel su P percorsi in parallelo (es.
+    ricampionamenti bootstrap della stessa serie): Z è una matrice (barre x
+    percorsi), lo stato è un vettore sui percorsi e ogni barra aggiorna tutti
+    i percorsi insieme, come evaluate_grid fa sulle combinazioni. hold_until
+    (timeout a tempo) è comune a tutti i percorsi: stesso clock. z_enter,
+    z_exit e z_stop possono essere vettori sui percorsi: una combinazione di
+    soglie per colonna sulla stessa serie (es. la griglia sul TEST).
+
+    Ritorna (pos, exits), entrambe (barre x percorsi) sulle barre di
+    esecuzione: pos = posizione a fine barra (int8, come position_vector),
+    exits = trade chiusi sulla barra (per i costi). Le posizioni aperte a
+    fine serie sono scartate, come in run_kernel.
+    """
+    Z = np.asarray(Z, dtype=np.float64)
+    n, P = Z.shape
+    pos = np.zeros((n, P), dtype=np.int8)
+    exits = np.zeros((n, P), dtype=np.uint8)
+    if n == 0 or P == 0:
+        return pos, exits
+
+    want_short = side in ("short", "both")
+    want_long  = side in ("long", "both")
+    if not (want_short or want_long):
+        raise ValueError(f"Side sconosciuto: {side}")
+
+    in_pos  = np.zeros(P, dtype=bool)
+    short   = np.zeros(P, dtype=bool)
+    dirn    = np.zeros(P, dtype=np.int8)
+    entry_i = np.zeros(P, dtype=np.int64)
+    until   = np.zeros(P, dtype=np.int64)   # prima barra del timeout
+    age     = np.zeros(P, dtype=np.int64)   # deferred: barre con z valido dall'entry
+    hold = max(int(max_hold), 1) if deferred else int(max_hold)
+    aged = deferred and hold_until is None
+    lat = int(exec_delay) if deferred else 0
+    last = n - 1
+
+    # righe da visitare con tutti i percorsi flat: almeno un percorso oltre z_enter
+    with np.errstate(invalid="ignore"):
+        cand = np.zeros(n, dtype=bool)
+        if want_short:
+            cand |= (Z >= z_enter).any(axis=1)
+        if want_long:
+            cand |= (Z <= -z_enter).any(axis=1)
+
+    for i in range(n):
+        busy = in_pos.any()
+        if not busy and not cand[i]:
+            continue
+        zi = Z[i]
+        ok = zi == zi
+        can = ~in_pos & ok
+        if busy:
+            chk = in_pos & ok
+            if deferred:
+                age += chk
+            ex = chk & np.where(short, (zi <= z_exit) | (zi >= z_stop), (zi >= -z_exit) | (zi <= -z_stop))
+            ex |= chk & ((age >= hold) if aged else (i >= until))
+            if ex.any():
+                in_pos &= ~ex
+                exits[min(i + lat, last)] += ex
+        o_s = (can & (zi >= z_enter)) if want_short else np.zeros(P, dtype=bool)
+        o_l = (can & ~o_s & (zi <= -z_enter)) if want_long else np.zeros(P, dtype=bool)
+        opened = o_s | o_l
+        if opened.any():
+            short[opened] = o_s[opened]
+            dirn[opened] = np.where(o_s[opened], DIR_SHORT, DIR_LONG)
+            entry_i[opened] = i
+            age[opened] = 0
+            if hold_until is not None:
+                until[opened] = max(int(hold_until[i]), i + 1 if deferred else i)
+            else:
+                until[opened] = i + hold
+            in_pos |= opened
+            if not deferred:
+                # entry ed exit sulla stessa barra (z già laggato)
+                ex = opened & np.where(short, (zi <= z_exit) | (zi >= z_stop), (zi >= -z_exit) | (zi <= -z_stop))
+                ex |= opened & (i >= until)
+                if ex.any():
+                    in_pos &= ~ex
+                    exits[i] += ex
+        # posizione a fine barra di segnale: dirn dove in posizione
+        pos[i] = np.where(in_pos, dirn, 0)
+
+    # posizioni ancora aperte a fine serie: scartate
+    if in_pos.any():
+        rows = np.arange(n)[:, None]
+        pos[(rows >= entry_i[None, :]) & in_pos[None, :]] = 0
+    if lat:
+        # barre di esecuzione: segnale + exec_delay (oltre la fine: ultima barra)
+        pos[lat:] = pos[:-lat].copy()
+        pos[:lat] = 0
+    return pos, exits
+
+
+def mtm_pnl_paths(pos: np.ndarray, exits: np.ndarray, PX: np.ndarray, *, pnl_mult: float,
+                  cost: float) -> np.ndarray:
+    """mtm_pnl per colonna: (barre x percorsi), px forward-filled sui NaN di ogni percorso."""
+    PX = np.asarray(PX, dtype=np.float64)
+    n = PX.shape[0]
+    pnl = np.zeros(PX.shape, dtype=np.float64)
+    if n == 0:
+        return pnl
+    ok = ~np.isnan(PX)
+    rows = np.maximum.accumulate(np.where(ok, np.arange(n)[:, None], 0), axis=0)
+    p = np.take_along_axis(PX, rows, axis=0)
+    pnl[1:] = pos[:-1] * (p[1:] - p[:-1]) * pnl_mult
+    pnl -= exits * cost
+    return pnl
+
+
+def mtm_metrics_paths(pnl: np.ndarray, ts_ns: np.ndarray, *, capital: float) -> Dict[str, np.ndarray]:
+    """
+    mtm_metrics per colonna da un PnL per barra (barre x percorsi) sullo
+    stesso clock: giorni UTC con reduceat, poi vol/Sharpe/MaxDD/CAGR
+    vettoriali sui percorsi. In più net_pnl (somma del PnL).
+    """
+    P = pnl.shape[1]
+    out = {k: np.zeros(P, dtype=np.float64) for k in ("net_pnl",) + MTM_METRICS}
+    if pnl.shape[0] == 0:
+        return out
+    day = np.asarray(ts_ns, dtype=np.int64) // DAY_NS
+    starts = np.flatnonzero(np.r_[True, day[1:] != day[:-1]])
+    day_pnl = np.add.reduceat(pnl, starts, axis=0)
+    std = day_pnl.std(axis=0)
+    ann = float(np.sqrt(252.0))
+    out["vol_annualized"] = std * ann
+    out["Sharpe"] = np.divide(day_pnl.mean(axis=0), std, out=np.zeros(P), where=std > 0) * ann
+    eq = np.cumsum(day_pnl, axis=0)
+    peak = np.maximum.accumulate(np.maximum(eq, 0.0), axis=0)
+    out["MaxDD"] = np.minimum(0.0, (eq - peak).min(axis=0))
+    out["net_pnl"] = eq[-1].copy()
+    years = float(day[starts[-1]] - day[0]) / 365.25
+    growth = 1.0 + eq[-1] / capital if capital else np.ones(P)
+    cagr = np.zeros(P)
+    if years > 0:
+        with np.errstate(over="ignore", invalid="ignore"):
+            cagr = np.power(np.maximum(growth, 0.0), 1.0 / years) - 1.0
+    cagr[growth <= 0] = -1.0
+    out["CAGR"] = cagr
+    return out
+
+
+# -------------------- PnL mark-to-market giornaliero --------------------
+
+DAY_NS = 86_400 * 10**9
+MTM_METRICS = ("vol_annualized", "Sharpe", "MaxDD", "CAGR")
+
+
+def position_vector(kt: KernelTrades, n: int) -> np.ndarray:
+    """Posizione a fine barra: direction sulle barre [entry, exit), 0 altrove."""
+    d = kt.direction.astype(np.float64)
+    step = np.zeros(n + 1, dtype=np.float64)
+    np.add.at(step, kt.entry_i, d)
+    np.add.at(step, kt.exit_i, -d)
+    return np.cumsum(step[:n])
+
+
+def mtm_pnl(kt: KernelTrades, px: np.ndarray, *, pnl_mult: float, cost: float) -> np.ndarray:
+    """
+    PnL per barra = posizione(t-1) * (px[t] - px[t-1]) * pnl_mult, costo del
+    trade sulla barra di exit. px forward-filled sui NaN: la somma sulle
+    barre coincide con la somma dei PnL netti dei trade.
+    """
+    px = as_f64(px)
+    n = px.shape[0]
+    pnl = np.zeros(n, dtype=np.float64)
+    if n == 0 or len(kt) == 0:
+        return pnl
+    ok = ~np.isnan(px)
+    p = px[np.maximum.accumulate(np.where(ok, np.arange(n), 0))]
+    pos = position_vector(kt, n)
+    held = np.flatnonzero(pos[:-1] != 0)
+    pnl[held + 1] = pos[held] * (p[held + 1] - p[held]) * pnl_mult
+    np.add.at(pnl, kt.exit_i, -cost)
+    return pnl
+
+
+# -------------------- analisi del percorso dei trade --------------------
+
+PATH_METRICS = ("mae", "mfe", "bars_to_mfe", "trade_dd")
+
+
+def path_analytics(entry_i: np.ndarray, exit_i: np.ndarray, direction: np.ndarray, px: np.ndarray, *,
+                   pnl_mult: float = 1.0) -> Dict[str, np.ndarray]:
+    """
+    Percorso di ogni trade sulle barre [entry, exit] (px forward-filled come
+    in mtm_pnl), PnL lordo aperto p_t = direction * (px[t] - px[entry]) * pnl_mult:
+      mae          minimo di p (<= 0, escursione avversa massima)
+      mfe          massimo di p (>= 0, escursione favorevole massima)
+      bars_to_mfe  barre dall'entry al primo massimo
+      trade_dd     massimo drawdown di p dal suo picco corrente (>= 0)
+    Tutti i trade in un passaggio: barre dei trade concatenate, min/max con
+    reduceat sui segmenti; il picco corrente per il drawdown con un accumulate
+    per gruppo di trade della stessa durata (matrice trade x barre).
+    """
+    e = np.asarray(entry_i, dtype=np.int64)
+    x = np.asarray(exit_i, dtype=np.int64)
+    n = e.shape[0]
+    if n == 0:
+        return {k: np.zeros(0, dtype=np.int64 if k == "bars_to_mfe" else np.float64) for k in PATH_METRICS}
+    px = as_f64(px)
+    ok = ~np.isnan(px)
+    px = px[np.maximum.accumulate(np.where(ok, np.arange(px.shape[0]), 0))]
+
+    length = x - e + 1
+    starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(length[:-1], out=starts[1:])
+    seg = np.repeat(np.arange(n), length)
+    off = np.arange(int(length.sum()), dtype=np.int64) - starts[seg]
+    p = (np.asarray(direction, dtype=np.float64) * pnl_mult)[seg] * (px[e[seg] + off] - px[e][seg]) + 0.0   # niente -0.0
+
+    mae = np.minimum.reduceat(p, starts)
+    mfe = np.maximum.reduceat(p, starts)
+    bars_to_mfe = np.minimum.reduceat(np.where(p == mfe[seg], off, np.iinfo(np.int64).max), starts)
+    dd = np.empty(n, dtype=np.float64)
+    for ln in np.unique(length):
+        sel = np.flatnonzero(length == ln)
+        m = p[starts[sel, None] + np.arange(ln)]
+        dd[sel] = (np.maximum.accumulate(m, axis=1) - m).max(axis=1)
+    return dict(mae=mae, mfe=mfe, bars_to_mfe=bars_to_mfe, trade_dd=dd)
+
+
+def daily_pnl(pnl: np.ndarray, ts_ns: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """PnL per barra -> (giorno UTC come int64 giorni dal 1970, PnL del giorno); barre ordinate."""
+    if pnl.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    day = ts_ns // DAY_NS
+    starts = np.flatnonzero(np.r_[True, day[1:] != day[:-1]])
+    return day[starts], np.add.reduceat(pnl, starts)
+
+
+def mtm_metrics(day_pnl: np.ndarray, days: np.ndarray, *, capital: float) -> Dict[str, float]:
+    """
+    Metriche dal PnL giornaliero (giorni flat inclusi): vol e Sharpe
+    annualizzati con sqrt(252), MaxDD sulla equity cumulata (picco iniziale
+    0, in valuta), CAGR su `capital` (es. notional) tra primo e ultimo giorno.
+    """
+    out = dict.fromkeys(MTM_METRICS, 0.0)
+    if day_pnl.shape[0] == 0:
+        return out
+    std = float(day_pnl.std())
+    out["vol_annualized"] = std * float(np.sqrt(252.0))
+    out["Sharpe"] = float(day_pnl.mean()) / std * float(np.sqrt(252.0)) if std > 0 else 0.0
+    eq = np.cumsum(day_pnl)
+    peak = np.maximum.accumulate(np.maximum(eq, 0.0))
+    out["MaxDD"] = float(min(0.0, (eq - peak).min()))
+    years = float(days[-1] - days[0]) / 365.25
+    growth = 1.0 + float(eq[-1]) / capital if capital else 1.0
+    if growth <= 0:
+        out["CAGR"] = -1.0
+    elif years > 0:
+        try:
+            out["CAGR"] = growth ** (1.0 / years) - 1.0
+        except OverflowError:   # periodi brevissimi (fold intraday di pochi giorni)
+            out["CAGR"] = float("inf")
+    return out
+
+
+def portfolio_daily(parts) -> Tuple[np.ndarray, np.ndarray]:
+    """Somma per giorno di più curve (days, pnl) (pair/fold): curva di portafoglio."""
+    parts = [p for p in parts if p is not None and p[0].shape[0]]
+    if not parts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    days = np.concatenate([p[0] for p in parts])
+    pnl = np.concatenate([p[1] for p in parts])
+    u, inv = np.unique(days, return_inverse=True)
+    return u, np.bincount(inv, weights=pnl, minlength=u.shape[0])
+
+
+def days_to_dates(days: np.ndarray) -> np.ndarray:
+    """Giorni dal 1970 -> stringhe YYYY-MM-DD."""
+    return np.datetime_as_string(days.astype("datetime64[D]"))
+
+
+# -------------------- ricerca adattiva --------------------
+
+def valid_combo_mask(combos: np.ndarray) -> np.ndarray:
+    """
+    Combinazioni logicamente sensate: z_exit < z_enter (altrimenti si esce
+    subito dopo l'entry) e z_stop > z_enter (altrimenti lo stop scatta
+    sull'entry). Le altre si possono scartare senza simularle.
+    """
+    ze, zx, zs = combos[:, 0], combos[:, 1], combos[:, 2]
+    return (zx < ze) & (zs > ze)
+
+
+def trades_after(z: np.ndarray, combos: np.ndarray, m: int, *, side: str, deferred: bool = False) -> np.ndarray:
+    """
+    Limite superiore, per combinazione, ai trade di evaluate_grid sulla serie
+    intera che si chiudono dopo il prefisso di m barre: la posizione aperta
+    alla barra m più una per barra di segnale in [m, n) (ogni trade entra su
+    una barra con z oltre z_enter, dopo l'exit del precedente). Modalità
+    laggata: il segnale della barra i è z[i-lat], si contano da m-lat.
+    """
+    z = as_f64(z)
+    combos = np.asarray(combos, dtype=np.float64).reshape(-1, 5)
+    out = np.ones(combos.shape[0], dtype=np.int64)
+    lat = np.zeros(combos.shape[0], dtype=np.int64) if deferred else combos[:, 4].astype(np.int64)
+    for L in np.unique(lat):
+        sel = lat == L
+        tail = z[max(0, m - int(L)):]
+        if side == "both":
+            v = np.abs(tail)
+        elif side in ("short", "long"):
+            v = tail if side == "short" else -tail
+        else:
+            raise ValueError(f"Side sconosciuto: {side}")
+        v = np.sort(v[np.isfinite(v)])
+        out[sel] += v.size - np.searchsorted(v, combos[sel, 0], side="left")
+    return out
+
+
+def successive_halving(eval_fn, n_bars: int, idx: np.ndarray, *, eta: int = 3, min_bars: int = 60,
+                       min_trades: int = 0):
+    """
+    Successive halving sui prefissi della finestra: ogni rung valuta i
+    candidati sulle prime m barre (m cresce di un fattore eta fino a n_bars)
+    e tiene il miglior 1/eta. L'ultimo rung (finestra intera) è lasciato al
+    chiamante, che valuta i sopravvissuti con le regole complete.
+
+    eval_fn(m, idx) -> (score, max_trades): score sul prefisso di m barre e
+    un limite superiore ai trade sulla finestra intera (trade del prefisso +
+    trades_after). Un candidato con max_trades < min_trades non può più
+    raggiungere il minimo e viene scartato prima della classifica.
+
+    Ritorna (idx sopravvissuti in ordine crescente, barre simulate per
+    candidato sommate sui rung intermedi).
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    eta = max(2, int(eta))
+    rungs = []
+    m = n_bars
+    while True:
+        m = m // eta
+        if m < max(1, min_bars):
+            break
+        rungs.append(m)
+    sim_bars = 0
+    for m in reversed(rungs):
+        if idx.size <= 1:
+            break
+        score, max_trades = eval_fn(m, idx)
+        sim_bars += m * idx.size
+        alive = max_trades >= min_trades
+        idx, score = idx[alive], score[alive]
+        keep = max(1, -(-idx.size // eta))
+        if idx.size > keep:
+            # top 1/eta per score (stabile: a parità tiene l'indice più basso)
+            top = np.argsort(-score, kind="stable")[:keep]
+            idx = np.sort(idx[top])
+    return idx, sim_bars
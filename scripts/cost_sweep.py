@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — sensibilità a fee / slippage / notional senza ri-simulare
+
+Il PnL di un trade è lineare nei parametri di costo:
+  net = gross_ref * N / N_ref - cost_legs * (fee_bps + slippage_bps) * 1e-4 * N
+(gross scala col notional, il costo è un addebito fisso in bps per leg).
+I trade salvati dagli engine (gross_pnl, notional, cost_legs) bastano
+quindi per ricalcolare le metriche nette su una griglia qualunque: una
+matrice (combinazioni x trade) in numpy, nessuna simulazione.
+
+Input: wf_trades.csv (WF v1/v2) o backtest_trades.csv.
+Output: tabella di sensibilità per pair (+ riga "ALL" di portafoglio)
+  pair, fee_bps, slippage_bps, notional, trades, gross_pnl_total,
+  cost_total, net_pnl_total, hit_rate, MaxDD, breakeven_bps
+breakeven_bps = fee+slippage (bps) a cui il PnL netto totale si azzera
+(non dipende dal notional).
+Il set di trade resta quello del run originale: nel walk-forward i
+parametri scelti (e quindi i trade) possono cambiare con i costi; per
+quello serve un nuovo run, il sweep misura la fragilità dei trade dati.
+
+Esempio:
+  python scripts/cost_sweep.py --trades reports/wf_trades.csv \
+      --fee-bps 0,1,2,5 --slippage-bps 0,1,2 --notional 100000,250000
+"""
+from __future__ import annotations
+import argparse, itertools, sys, time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+def parse_floats(s):
+    return [float(x) for x in str(s).split(",") if x.strip()]
+
+
+def load_trades(path, ref_notional=None, cost_legs=None):
+    """Trade con gross/notional/cost_legs; colonne mancanti da opzioni o dai costi salvati."""
+    t = pd.read_csv(path)
+    if t.empty:
+        return t
+    if "gross_pnl" not in t.columns:
+        sys.exit(f"{path}: manca la colonna gross_pnl (rigenerare i trade con l'engine aggiornato)")
+    if "notional" not in t.columns:
+        if ref_notional is None:
+            sys.exit(f"{path}: manca la colonna notional (usare --ref-notional)")
+        t["notional"] = float(ref_notional)
+    if cost_legs is not None:
+        t["cost_legs"] = float(cost_legs)
+    elif "cost_legs" not in t.columns:
+        sys.exit(f"{path}: manca la colonna cost_legs (usare --cost-legs)")
+    if "pair" not in t.columns:
+        t["pair"] = "UNKNOWN"
+    # ordine temporale per pair: equity / drawdown per trade
+    order = [c for c in ("pair", "exit_date", "entry_date") if c in t.columns]
+    return t.sort_values(order, kind="stable").reset_index(drop=True)
+
+
+def sweep(trades: pd.DataFrame, fee_bps, slippage_bps, notional) -> pd.DataFrame:
+    """Metriche nette per (pair x fee x slippage x notional), vettoriali su combinazioni e trade."""
+    combos = np.array(list(itertools.product(fee_bps, slippage_bps, notional)), dtype=np.float64).reshape(-1, 3)
+    g_unit = trades["gross_pnl"].to_numpy(np.float64) / trades["notional"].to_numpy(np.float64)
+    c_unit = trades["cost_legs"].to_numpy(np.float64) * 1e-4
+    N = combos[:, 2:3]
+    gross = g_unit[None, :] * N                                   # K x T
+    cost = c_unit[None, :] * (combos[:, 0:1] + combos[:, 1:2]) * N  # K x T
+    net = gross - cost
+
+    pairs = trades["pair"].astype(str).to_numpy()
+    starts = np.flatnonzero(np.r_[True, pairs[1:] != pairs[:-1]])
+    groups = [(pairs[a], np.arange(a, b)) for a, b in zip(starts, np.r_[starts[1:], len(pairs)])]
+    # portafoglio: trade di tutte le pair in ordine di uscita
+    exit_key = trades["exit_date"].astype(str).to_numpy() if "exit_date" in trades else np.zeros(len(pairs))
+    groups.append(("ALL", np.argsort(exit_key, kind="stable")))
+
+    rows = []
+    for name, idx in groups:
+        g, c, n = gross[:, idx], cost[:, idx], net[:, idx]
+        eq = np.cumsum(n, axis=1)
+        peak = np.maximum.accumulate(np.maximum(eq, 0.0), axis=1)
+        unit_cost = c_unit[idx].sum()
+        rows.append(pd.DataFrame({
+            "pair": name,
+            "fee_bps": combos[:, 0], "slippage_bps": combos[:, 1], "notional": combos[:, 2],
+            "trades": idx.size,
+            "gross_pnl_total": g.sum(axis=1),
+            "cost_total": c.sum(axis=1),
+            "net_pnl_total": n.sum(axis=1),
+            "hit_rate": (n > 0).mean(axis=1),
+            "MaxDD": np.minimum((eq - peak).min(axis=1), 0.0),
+            "breakeven_bps": g_unit[idx].sum() / unit_cost if unit_cost > 0 else np.nan,
+        }))
+    return pd.concat(rows, ignore_index=True)
+
+
+def main():
+    ap = argparse.ArgumentParser("ArbiSense cost sweep")
+    ap.add_argument("--trades", default="reports/wf_trades.csv")
+    ap.add_argument("--fee-bps", default="0,0.5,1,2,5")
+    ap.add_argument("--slippage-bps", default="0,0.5,1,2")
+    ap.add_argument("--notional", default="250000")
+    ap.add_argument("--ref-notional", type=float, default=None,
+                    help="notional dei trade se il file non ha la colonna notional")
+    ap.add_argument("--cost-legs", type=float, default=None,
+                    help="addebiti fee+slippage per trade (1: WF v1/backtest_signals, 2: WF v2) se non nel file")
+    ap.add_argument("--out", default="reports/cost_sweep.csv")
+    args = ap.parse_args()
+
+    trades = load_trades(args.trades, args.ref_notional, args.cost_legs)
+    if trades.empty:
+        print("[INFO] Nessun trade"); sys.exit(0)
+
+    t0 = time.perf_counter()
+    out = sweep(trades, parse_floats(args.fee_bps), parse_floats(args.slippage_bps), parse_floats(args.notional))
+    dt_ms = (time.perf_counter() - t0) * 1e3
+
+    Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+    out.to_csv(args.out, index=False)
+    n_combos = len(out) // out["pair"].nunique()
+    print(f"[OK] {len(trades)} trade x {n_combos} combinazioni in {dt_ms:.1f} ms")
+    print(f"[WROTE] {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — equivalenza tra gli engine e fixture golden
+
+La stessa strategia z-score vive in quattro implementazioni:
+  root     backtest_signals.py (radice del repo)
+  signals  scripts/backtest_signals.py  (backtest_pair)
+  wf_v1    walkforward_backtest.backtest_on_series
+  wf_v2    walkforward_backtest_v2.simulate_trades
+che condividono il kernel (bt_kernel.run_kernel) ma non le convenzioni:
+  - latency: root/signals/v1 ritardano il segnale ed eseguono allo spread
+    laggato; v2 esegue in differita (barra i+lat, spread_eff di quella barra)
+  - costi: root/signals/v1 un addebito (fee+slippage) per trade, v2 due
+    (entry ed exit)
+  - scala: root/signals/v1 spread x spread_scale x notional, v2 spread_eff
+    x notional (qui alimentato con spread x spread_scale, stessa unità)
+
+Il harness esegue tutti gli engine sugli stessi input (serie sintetica
+AR(1) + pair di data_sample) e scenari (side, soglie, max_hold, latency,
+costi) e normalizza i trade in una tabella canonica:
+  series, scenario, trade, entry_i, exit_i, direction, reason, net_pnl
+(indici di barra sulla serie, codici int di bt_kernel). Il diff è trade
+per trade contro un engine di riferimento: primo trade/campo/barra
+divergente, numero di trade, PnL totale.
+
+Fixture golden: --write-golden DIR salva i trade canonici di ogni engine
+(DIR/<engine>.csv) + manifest.json (scenari, hash degli input, commit);
+--check DIR riesegue e confronta, exit code 1 alla prima divergenza.
+Un engine più veloce si registra in ENGINES con golden=<engine che
+sostituisce>: deve riprodurne la fixture trade per trade prima di
+prenderne il posto.
+
+Output: reports/engine_equivalence.csv (diff per serie x scenario x engine)
+        reports/engine_equivalence_trades.csv (trade canonici di tutti gli engine)
+
+Esempio:
+  python scripts/engine_equivalence.py
+  python scripts/engine_equivalence.py --write-golden data_sample/golden_engines
+  python scripts/engine_equivalence.py --check data_sample/golden_engines
+"""
+from __future__ import annotations
+import argparse, hashlib, importlib.util, json, os, sys
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, List
+import numpy as np
+import pandas as pd
+
+from bt_kernel import DIRECTION_NAMES, REASON_NAMES
+
+ROOT = Path(__file__).resolve().parent.parent
+CANON = ["series", "scenario", "trade", "entry_i", "exit_i", "direction", "reason", "net_pnl"]
+INT_FIELDS = ["entry_i", "exit_i", "direction", "reason"]
+NOTIONAL = 250_000.0
+SPREAD_SCALE = 1e-4   # scala esplicita: niente euristica "auto" diversa tra engine
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    side: str = "both"
+    z_enter: float = 2.0
+    z_exit: float = 0.5
+    z_stop: float = 4.0
+    max_hold: int = 10
+    latency: int = 0
+    fee_bps: float = 0.0
+    slippage_bps: float = 0.0
+    z_window: int = 60
+
+
+SCENARIOS = [
+    Scenario("base"),
+    Scenario("latency1", latency=1),
+    Scenario("latency2_costs", latency=2, fee_bps=1.0, slippage_bps=0.5),
+    Scenario("short_stop", side="short", z_enter=1.8, z_stop=2.6),
+    Scenario("long_timeout", side="long", z_enter=1.5, z_exit=0.0, max_hold=3),
+    Scenario("costs_window40", fee_bps=2.0, z_window=40),
+]
+
+
+@dataclass
+class Series:
+    name: str
+    d_ns: np.ndarray   # int64 ns UTC, ordinati e unici
+    s: np.ndarray      # spread (raw)
+
+    def digest(self) -> str:
+        h = hashlib.sha256()
+        h.update(self.d_ns.tobytes()); h.update(np.ascontiguousarray(self.s, dtype=np.float64).tobytes())
+        return h.hexdigest()[:16]
+
+
+def load_series(sample: str, pairs: List[str], synth_bars: int) -> List[Series]:
+    from bench_engines import synth_spread, synth_clock
+    out = [Series("SYN_AR1", synth_clock(synth_bars), synth_spread(synth_bars, seed=7))] if synth_bars else []
+    if pairs:
+        df = pd.read_csv(sample)
+        df["date"] = pd.to_datetime(df["date"], utc=True)
+        for p in pairs:
+            g = df[df["pair"] == p].sort_values("date")
+            if g.empty:
+                sys.exit(f"{sample}: pair {p} assente")
+            out.append(Series(p, pd.DatetimeIndex(g["date"]).as_unit("ns").asi8,
+                              g["spread_raw"].to_numpy(np.float64)))
+    return out
+
+
+# ------------------ adattatori: engine -> trade canonici ------------------
+
+def _canon(ser: Series, sc: Scenario, entry_i, exit_i, direction, reason, net) -> pd.DataFrame:
+    n = len(entry_i)
+    return pd.DataFrame({"series": ser.name, "scenario": sc.name, "trade": np.arange(n),
+                         "entry_i": np.asarray(entry_i, dtype=np.int64), "exit_i": np.asarray(exit_i, dtype=np.int64),
+                         "direction": np.asarray(direction, dtype=np.int64),
+                         "reason": np.asarray(reason, dtype=np.int64),
+                         "net_pnl": np.asarray(net, dtype=np.float64)}, columns=CANON)
+
+
+def _codes(names: np.ndarray, table: np.ndarray, offset: int = 0) -> np.ndarray:
+    lookup = {str(v): k - offset for k, v in enumerate(table) if v}
+    return np.array([lookup[str(x)] for x in names], dtype=np.int64)
+
+
+def _block(ser: Series, sc: Scenario, blk) -> pd.DataFrame:
+    """TradeBlock (trade_records) -> canonico; barre dai timestamp."""
+    if blk is None or not len(blk):
+        return _canon(ser, sc, [], [], [], [], [])
+    r = blk.rec
+    return _canon(ser, sc, np.searchsorted(ser.d_ns, r["entry_ns"]), np.searchsorted(ser.d_ns, r["exit_ns"]),
+                  r["direction"], r["reason"], r["net_pnl"])
+
+
+def _signals_args(module, sc: Scenario):
+    old = sys.argv
+    sys.argv = ["backtest_signals", "--side", sc.side, "--z-enter", str(sc.z_enter), "--z-exit", str(sc.z_exit),
+                "--z-stop", str(sc.z_stop), "--max-hold", str(sc.max_hold), "--latency-days", str(sc.latency),
+                "--z-window", str(sc.z_window), "--notional", str(NOTIONAL), "--fee-bps", str(sc.fee_bps),
+                "--slippage-bps", str(sc.slippage_bps), "--spread-scale", str(SPREAD_SCALE)]
+    try:
+        return module.parse_args()
+    finally:
+        sys.argv = old
+
+
+def _frame(ser: Series) -> pd.DataFrame:
+    return pd.DataFrame({"date": pd.to_datetime(ser.d_ns, utc=True), "pair": ser.name, "spread_raw": ser.s})
+
+
+_ROOT_MODULE = None
+
+def run_root(ser: Series, sc: Scenario) -> pd.DataFrame:
+    global _ROOT_MODULE
+    if _ROOT_MODULE is None:
+        # stesso nome del modulo in scripts/: caricato sotto un altro nome
+        spec = importlib.util.spec_from_file_location("backtest_signals_root", ROOT / "backtest_signals.py")
+        _ROOT_MODULE = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_ROOT_MODULE)
+    t, _ = _ROOT_MODULE.backtest_pair(_frame(ser), _signals_args(_ROOT_MODULE, sc))
+    if t.empty:
+        return _canon(ser, sc, [], [], [], [], [])
+    return _canon(ser, sc, t["entry_idx"], t["exit_idx"], _codes(t["direction"], DIRECTION_NAMES, 1),
+                  _codes(t["reason_exit"], REASON_NAMES), t["net_pnl"])
+
+
+def run_signals(ser: Series, sc: Scenario) -> pd.DataFrame:
+    import backtest_signals as bs
+    blk, _ = bs.backtest_pair(_frame(ser), ser.name, _signals_args(bs, sc))
+    return _block(ser, sc, blk)
+
+
+def run_wf_v1(ser: Series, sc: Scenario) -> pd.DataFrame:
+    from walkforward_backtest import backtest_on_series, BTParams, BTContext
+    params = BTParams(z_enter=sc.z_enter, z_exit=sc.z_exit, z_stop=sc.z_stop, max_hold=sc.max_hold, latency=sc.latency)
+    ctx = BTContext(is_pct=False, spread_scale=SPREAD_SCALE, notional=NOTIONAL, fee_bps=sc.fee_bps,
+                    slippage_bps=sc.slippage_bps, side=sc.side, z_window=sc.z_window)
+    blk, _, _ = backtest_on_series(ser.d_ns, ser.s, params, ctx)
+    return _block(ser, sc, blk)
+
+
+def run_wf_v2(ser: Series, sc: Scenario) -> pd.DataFrame:
+    from walkforward_backtest_v2 import simulate_trades
+    df = pd.DataFrame({"ts": pd.to_datetime(ser.d_ns, utc=True), "spread_eff": ser.s * SPREAD_SCALE})
+    blk, _ = simulate_trades(df, side=sc.side, z_enter=sc.z_enter, z_exit=sc.z_exit, z_stop=sc.z_stop,
+                             max_hold=sc.max_hold, latency_days=sc.latency, notional=NOTIONAL, fee_bps=sc.fee_bps,
+                             slippage_bps=sc.slippage_bps, fold_id=1, pair=ser.name, sign=1, z_window=sc.z_window)
+    return _block(ser, sc, blk)
+
+
+@dataclass(frozen=True)
+class Engine:
+    name: str
+    run: Callable[[Series, Scenario], pd.DataFrame]
+    golden: str   # fixture da riprodurre (un engine sostitutivo punta a quella dell'originale)
+
+
+ENGINES = [
+    Engine("root", run_root, "root"),
+    Engine("signals", run_signals, "signals"),
+    Engine("wf_v1", run_wf_v1, "wf_v1"),
+    Engine("wf_v2", run_wf_v2, "wf_v2"),
+]
+
+
+# ------------------ diff ------------------
+
+def diff_trades(a: pd.DataFrame, b: pd.DataFrame, rtol: float, atol: float) -> Dict[str, object]:
+    """Primo trade divergente tra due tabelle canoniche (stessa serie/scenario), in ordine di trade."""
+    n = min(len(a), len(b))
+    first = dict(first_diff_trade=-1, first_diff_field="", first_diff_bar=-1, value="", ref_value="")
+    if n:
+        bad = np.zeros((n, len(INT_FIELDS) + 1), dtype=bool)
+        for j, f in enumerate(INT_FIELDS):
+            bad[:, j] = a[f].to_numpy()[:n] != b[f].to_numpy()[:n]
+        bad[:, -1] = ~np.isclose(a["net_pnl"].to_numpy()[:n], b["net_pnl"].to_numpy()[:n], rtol=rtol, atol=atol)
+        rows = np.flatnonzero(bad.any(axis=1))
+        if rows.size:
+            k = int(rows[0]); j = int(np.argmax(bad[k]))
+            f = (INT_FIELDS + ["net_pnl"])[j]
+            first = dict(first_diff_trade=k, first_diff_field=f,
+                         first_diff_bar=int(min(a["entry_i"].iat[k], b["entry_i"].iat[k])),
+                         value=str(a[f].iat[k]), ref_value=str(b[f].iat[k]))
+    if first["first_diff_trade"] < 0 and len(a) != len(b):
+        k = n
+        extra = a if len(a) > len(b) else b
+        first = dict(first_diff_trade=k, first_diff_field="trades", first_diff_bar=int(extra["entry_i"].iat[k]),
+                     value=str(len(a)), ref_value=str(len(b)))
+    return dict(equal=first["first_diff_trade"] < 0, **first)
+
+
+def compare_tables(cur: pd.DataFrame, ref: pd.DataFrame, rtol: float, atol: float) -> pd.DataFrame:
+    """Diff per (serie, scenario) tra due tabelle canoniche di più serie/scenari."""
+    rows = []
+    groups_ref = {k: g for k, g in ref.groupby(["series", "scenario"], sort=False)}
+    for k, g in cur.groupby(["series", "scenario"], sort=False):
+        r = groups_ref.get(k, ref.iloc[0:0])
+        rows.append({"series": k[0], "scenario": k[1], "trades": len(g), "ref_trades": len(r),
+                     "net_total": float(g["net_pnl"].sum()), "ref_net_total": float(r["net_pnl"].sum()),
+                     **diff_trades(g.reset_index(drop=True), r.reset_index(drop=True), rtol, atol)})
+    return pd.DataFrame(rows)
+
+
+def run_engine(engine: Engine, series: List[Series], scenarios: List[Scenario]) -> pd.DataFrame:
+    return pd.concat([engine.run(ser, sc) for ser in series for sc in scenarios], ignore_index=True)
+
+
+def _git_commit() -> str:
+    import subprocess
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=ROOT, timeout=10).stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+
+def read_golden(golden_dir: Path, name: str) -> pd.DataFrame:
+    g = pd.read_csv(golden_dir / f"{name}.csv")
+    return g.astype({f: np.int64 for f in INT_FIELDS + ["trade"]})
+
+
+def main():
+    ap = argparse.ArgumentParser("ArbiSense engine equivalence")
+    ap.add_argument("--engines", default=",".join(e.name for e in ENGINES))
+    ap.add_argument("--reference", default="signals", help="engine di riferimento per il diff incrociato")
+    ap.add_argument("--input", default="data_sample/spread_report_all_pairs_long.normalized.csv")
+    ap.add_argument("--pairs", default="IWDA_AS_EUNL_DE,VWRL_L_VEVE_AS", help="pair reali dall'input (vuoto: nessuna)")
+    ap.add_argument("--synth-bars", type=int, default=2000, help="barre della serie sintetica (0: nessuna)")
+    ap.add_argument("--rtol", type=float, default=1e-9)
+    ap.add_argument("--atol", type=float, default=1e-6, help="tolleranza assoluta sul PnL (valuta)")
+    ap.add_argument("--write-golden", default=None, metavar="DIR", help="salva le fixture golden in DIR")
+    ap.add_argument("--check", default=None, metavar="DIR", help="confronta con le fixture golden in DIR")
+    ap.add_argument("--outdir", default="reports")
+    args = ap.parse_args()
+
+    names = [x.strip() for x in args.engines.split(",") if x.strip()]
+    by_name = {e.name: e for e in ENGINES}
+    unknown = [x for x in names if x not in by_name]
+    if unknown:
+        sys.exit(f"Engine sconosciuti: {unknown} (disponibili: {list(by_name)})")
+    pairs = [p.strip() for p in args.pairs.split(",") if p.strip()]
+    series = load_series(args.input, pairs, args.synth_bars)
+    tables = {n: run_engine(by_name[n], series, SCENARIOS) for n in names}
+
+    # diff incrociato contro il riferimento
+    os.makedirs(args.outdir, exist_ok=True)
+    report = []
+    ref = tables.get(args.reference)
+    if ref is not None:
+        for n, t in tables.items():
+            if n != args.reference:
+                report.append(compare_tables(t, ref, args.rtol, args.atol).assign(engine=n, reference=args.reference))
+    rep = pd.concat(report, ignore_index=True) if report else pd.DataFrame()
+    if not rep.empty:
+        rep = rep[["engine", "reference"] + [c for c in rep.columns if c not in ("engine", "reference")]]
+        out_rep = os.path.join(args.outdir, "engine_equivalence.csv")
+        out_tr = os.path.join(args.outdir, "engine_equivalence_trades.csv")
+        rep.to_csv(out_rep, index=False)
+        pd.concat([t.assign(engine=n) for n, t in tables.items()], ignore_index=True).to_csv(out_tr, index=False)
+        for n, g in rep.groupby("engine", sort=False):
+            eq = int(g["equal"].sum())
+            print(f"[INFO] {n} vs {args.reference}: {eq}/{len(g)} (serie x scenario) identici")
+            for r in g[~g["equal"]].itertuples():
+                print(f"  {r.series:<16} {r.scenario:<15} trade {r.first_diff_trade} bar {r.first_diff_bar}: "
+                      f"{r.first_diff_field} {r.value} vs {r.ref_value}  (PnL {r.net_total:.2f} vs {r.ref_net_total:.2f})")
+        print(f"[WROTE] {out_rep}\n[WROTE] {out_tr}")
+
+    manifest = dict(scenarios=[asdict(s) for s in SCENARIOS],
+                    series={s.name: dict(bars=int(len(s.s)), sha256=s.digest()) for s in series},
+                    notional=NOTIONAL, spread_scale=SPREAD_SCALE)
+
+    if args.write_golden:
+        gdir = Path(args.write_golden)
+        gdir.mkdir(parents=True, exist_ok=True)
+        for n, t in tables.items():
+            t.to_csv(gdir / f"{n}.csv", index=False)
+        with open(gdir / "manifest.json", "w") as f:
+            json.dump(dict(manifest, engines=list(tables), git=_git_commit(),
+                           created=pd.Timestamp.now(tz="UTC").isoformat(timespec="seconds")), f, indent=1)
+        print(f"[WROTE] {gdir}/ ({len(tables)} engine, {len(series)} serie x {len(SCENARIOS)} scenari)")
+
+    if args.check:
+        gdir = Path(args.check)
+        with open(gdir / "manifest.json") as f:
+            gm = json.load(f)
+        if gm["series"] != manifest["series"] or gm["scenarios"] != manifest["scenarios"]:
+            sys.exit(f"[FAIL] input o scenari diversi da {gdir}/manifest.json: rigenerare le fixture o "
+                     f"usare gli stessi --input/--pairs/--synth-bars")
+        failed = 0
+        for n, t in tables.items():
+            golden = by_name[n].golden
+            res = compare_tables(t, read_golden(gdir, golden), args.rtol, args.atol)
+            bad = res[~res["equal"]]
+            if bad.empty:
+                print(f"[OK] {n}: {len(res)} (serie x scenario) identici a golden/{golden}")
+                continue
+            failed += 1
+            r = bad.iloc[0]
+            print(f"[FAIL] {n} vs golden/{golden}: {len(bad)}/{len(res)} divergenti; primo: {r.series} {r.scenario} "
+                  f"trade {r.first_diff_trade} bar {r.first_diff_bar} {r.first_diff_field} {r.value} vs {r.ref_value}")
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,5 @@
 import argparse, json, pandas as pd, numpy as np
-
-def zscore(x, win):
-    m = x.rolling(win, min_periods=max(5, win//4)).mean()
-    v = x.rolling(win, min_periods=max(5, win//4)).std(ddof=0)
-    return (x - m) / v
+from feature_cache import FEATURES
 
 ap = argparse.ArgumentParser()
 ap.add_argument("--input", required=True)
@@ -41,8 +37,9 @@ if not spread_col:
     raise SystemExit("Manca colonna spread_raw/spread/spread_pct")
 
 s = pd.to_numeric(df[spread_col], errors="coerce")
-s = s * sign  # applica segno del preset
-z = zscore(s.astype(float), z_window)
+# z dello spread col segno del preset (z(-s) = -z(s): stessa entry in cache)
+f = FEATURES.get(pair, s.astype(float), z_window, sign=sign)
+z = pd.Series(f.z, index=s.index)
 
 # segnali sugli ultimi N punti (crossing + near)
 N = min(args.lookback, len(z))
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — cache delle feature rolling (media, std, z-score) per pair
+
+Le statistiche rolling di una serie vengono calcolate una sola volta per
+(pair, finestra, min_periods, span) e poi servite a tutti i consumatori
+(la chiave include un'impronta dei valori e dei timestamp della slice:
+stessa pair con dati diversi = entry diversa, mai dati vecchi):
+  - walk-forward v1/v2 (TRAIN/TEST di ogni fold, entrambi i segni)
+  - filter_regime.py, export_from_preset.py, quality_metrics.py
+
+Simmetria di segno: per -x la media cambia segno, la std resta uguale e
+z(-x) = -z(x); il segno -1 si ricava dalla entry di +x senza ri-calcolare
+il rolling (il risultato è identico bit a bit a rolling su -x).
+
+Storia completa: con `full_history=True` le feature sono calcolate una
+volta sull'intera serie e ogni span è una vista; il rolling usa solo barre
+passate, quindi la slice resta causale ma parte già "calda" (niente
+warm-up a inizio fold).
+
+Slice causali: `upto(ts)` / `window(end, n)` restituiscono viste che usano
+solo dati con timestamp <= ts (niente look-ahead).
+
+Momenti a somme prefisse: `PrefixMoments` tiene cumsum di x, x^2 e del
+conteggio dei valori validi; media e std rolling per qualunque finestra
+costano O(1) a barra (O(n) per finestra, senza ri-scansione), per cui
+z_window diventa una dimensione di griglia (`method="prefix"` in get).
+Stessa semantica di pandas (NaN esclusi, min_periods), numeri uguali a
+meno dell'arrotondamento: il path di default resta `rolling` di pandas.
+
+Finestre a tempo (barre intraday): `window` può essere un pd.Timedelta
+("60min"): la finestra di ogni barra è (t - W, t] sui timestamp, come
+rolling("60min") di pandas; serve `ts`. min_periods di default sulle
+barre equivalenti (bar_clock.default_min_periods).
+
+Le entry sono tenute in LRU con budget di memoria (byte degli array);
+default 256 MB, configurabile con ARBISENSE_FEATURE_CACHE_MB.
+"""
+from __future__ import annotations
+import hashlib, os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple, Union
+import numpy as np
+import pandas as pd
+
+from bar_clock import default_min_periods, bar_ns, window_starts, is_time
+
+Window = Union[int, pd.Timedelta]
+
+
+@dataclass
+class RollingFeatures:
+    """Feature rolling di una serie (array float64 allineati alla serie)."""
+    x: np.ndarray
+    mean: np.ndarray
+    std: np.ndarray
+    z: np.ndarray
+    ts: Optional[np.ndarray] = None   # int64 ns UTC, ordinati (opzionale)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.x, self.mean, self.std, self.z, self.ts) if a is not None)
+
+    def signed(self, sign: int) -> "RollingFeatures":
+        """Feature della serie sign * x (sign = +1/-1) senza ri-calcolare il rolling."""
+        if sign >= 0:
+            return self
+        return RollingFeatures(-self.x, -self.mean, self.std, -self.z, self.ts)
+
+    def view(self, a: int, b: int) -> "RollingFeatures":
+        """Viste (senza copia) sulle barre [a, b)."""
+        return RollingFeatures(self.x[a:b], self.mean[a:b], self.std[a:b], self.z[a:b],
+                               None if self.ts is None else self.ts[a:b])
+
+    def upto(self, ts) -> int:
+        """Indice di fine (esclusivo) della slice causale con timestamp <= ts."""
+        if self.ts is None:
+            raise ValueError("Feature senza timestamp: slice causale non disponibile")
+        t = pd.Timestamp(ts)
+        t = t.tz_localize("UTC") if t.tzinfo is None else t.tz_convert("UTC")
+        return int(np.searchsorted(self.ts, t.value, side="right"))
+
+    def window(self, end: int, n: int) -> slice:
+        """Ultime n barre che terminano a `end` (esclusivo)."""
+        return slice(max(0, end - n), end)
+
+
+@dataclass
+class PrefixMoments:
+    """
+    Somme prefisse (lunghezza n+1) dei valori validi di x, centrati su `c`
+    per limitare la cancellazione numerica in E[x^2] - E[x]^2.
+    """
+    x: np.ndarray
+    c: float
+    s1: np.ndarray
+    s2: np.ndarray
+    cnt: np.ndarray
+    chg: np.ndarray   # cumsum dei cambi di valore tra valori validi consecutivi
+
+    @classmethod
+    def build(cls, x) -> "PrefixMoments":
+        x = np.asarray(x, dtype=np.float64)
+        ok = np.isfinite(x)
+        c = float(x[ok].mean()) if ok.any() else 0.0
+        # accumulo in long double (80 bit su x86-64) per le serie lunghe
+        d = np.where(ok, x - c, 0.0).astype(np.longdouble)
+        s1 = np.concatenate(([0.0], np.cumsum(d))).astype(np.longdouble)
+        s2 = np.concatenate(([0.0], np.cumsum(d * d))).astype(np.longdouble)
+        cnt = np.concatenate(([0], np.cumsum(ok, dtype=np.int64)))
+        v = x[ok]
+        chg = np.concatenate(([0], np.cumsum(v[1:] != v[:-1], dtype=np.int64))) if v.size else np.zeros(1, np.int64)
+        return cls(x, c, s1, s2, cnt, chg)
+
+    @property
+    def nbytes(self) -> int:
+        return self.x.nbytes + self.s1.nbytes + self.s2.nbytes + self.cnt.nbytes + self.chg.nbytes
+
+    def features(self, window: Window, min_periods: Optional[int] = None, *,
+                 zero_std_nan: bool = False, ts: Optional[np.ndarray] = None) -> RollingFeatures:
+        """Rolling mean/std(ddof=0) e z per `window` dalle somme prefisse (a tempo: serve ts)."""
+        if min_periods is None:
+            min_periods = _min_periods(window, ts)
+        n = self.x.shape[0]
+        hi = np.arange(1, n + 1)
+        lo = window_starts(ts, window) if is_time(window) else np.maximum(hi - int(window), 0)
+        k = (self.cnt[hi] - self.cnt[lo]).astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            m1 = (self.s1[hi] - self.s1[lo]) / k
+            m2 = (self.s2[hi] - self.s2[lo]) / k
+            var = np.maximum(m2 - m1 * m1, 0.0)
+            # finestre costanti: varianza esattamente 0 (come pandas), non residui
+            # di arrotondamento
+            first = np.minimum(self.cnt[lo], self.chg.shape[0] - 1)
+            last = np.maximum(self.cnt[hi] - 1, first)
+            var[self.chg[last] == self.chg[first]] = 0.0
+            m1 = m1.astype(np.float64)
+            std = np.sqrt(var).astype(np.float64)
+            bad = k < max(int(min_periods), 1)
+            m1[bad] = np.nan
+            std[bad] = np.nan
+            # finestra costante: x coincide con la media, z = 0/0 = NaN come in pandas
+            flat = std == 0
+            if zero_std_nan:
+                std[flat] = np.nan
+            z = (self.x - (m1 + self.c)) / std
+            z[flat] = np.nan
+        return RollingFeatures(self.x, m1 + self.c, std, z)
+
+
+def ts_ns(ts) -> np.ndarray:
+    """Timestamp -> int64 ns UTC (NaT -> max int64: in coda, mai <= di un ts valido)."""
+    if isinstance(ts, np.ndarray) and ts.dtype == np.int64:
+        return ts   # già in ns (es. vista di un fold)
+    dtype = getattr(ts, "dtype", None)
+    if isinstance(dtype, np.dtype) and dtype.kind == "M":
+        # datetime64 naive (= UTC): cast numpy, più rapido di as_unit sugli array
+        # corti; fuori dal range ns il cast numpy andrebbe in overflow senza errore
+        a = np.asarray(ts)
+        ok = ~np.isnat(a)
+        lim = np.array([pd.Timestamp.min, pd.Timestamp.max], dtype="datetime64[ns]").astype(a.dtype)
+        if not ok.any() or (a[ok].min() >= lim[0] and a[ok].max() <= lim[1]):
+            out = a.astype("datetime64[ns]").view(np.int64).copy()
+            out[~ok] = np.iinfo(np.int64).max
+            return out
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        # già datetime: to_datetime scorrerebbe gli elementi per la sua cache
+        idx = pd.DatetimeIndex(ts).as_unit("ns")
+    else:
+        idx = pd.DatetimeIndex(pd.to_datetime(ts, utc=True)).as_unit("ns")
+    out = idx.asi8.copy()
+    out[idx.isna()] = np.iinfo(np.int64).max
+    return out
+
+
+def fingerprint(*arrays) -> Optional[str]:
+    """Impronta (sha256, accelerato in hardware) del contenuto degli array, None se tutti None."""
+    if all(x is None for x in arrays):
+        return None
+    h = hashlib.sha256()
+    for x in arrays:
+        if x is not None:
+            x = np.ascontiguousarray(x)
+            h.update(f"{x.dtype.str}{x.shape}".encode())
+            h.update(x.data)
+    return h.hexdigest()[:32]
+
+
+def _min_periods(window: Window, ts=None) -> int:
+    if not is_time(window):
+        return max(5, window//4)
+    if ts is None:
+        raise ValueError("Finestra a tempo senza timestamp")
+    return default_min_periods(window, bar_ns(ts))
+
+
+def rolling_features(x, window: Window, min_periods: Optional[int] = None, *,
+                     zero_std_nan: bool = False, ts: Optional[np.ndarray] = None) -> RollingFeatures:
+    """Rolling mean/std(ddof=0) e z; stessi numeri di x.rolling(...) in pandas (a tempo: serve ts)."""
+    if min_periods is None:
+        min_periods = _min_periods(window, ts)
+    s = pd.Series(np.asarray(x, dtype=np.float64))
+    if is_time(window):
+        s.index = pd.to_datetime(np.asarray(ts, dtype=np.int64), utc=True)
+    r = s.rolling(window, min_periods=min_periods)
+    m = r.mean()
+    v = r.std(ddof=0)
+    if zero_std_nan:
+        v = v.replace(0, np.nan)
+    z = (s - m) / v
+    return RollingFeatures(s.to_numpy(), m.to_numpy(), v.to_numpy(), z.to_numpy())
+
+
+class FeatureCache:
+    """LRU di RollingFeatures con budget in byte."""
+
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = int(max_bytes)
+        self._entries: "OrderedDict[tuple, RollingFeatures]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, pair: str, values, window: Window, min_periods: Optional[int] = None, *,
+            sign: int = 1, span: Optional[Tuple[int, int]] = None, ts=None,
+            zero_std_nan: bool = False, method: str = "rolling",
+            full_history: bool = False) -> RollingFeatures:
+        """
+        Feature per `values` (serie completa della pair, segno +1).
+        span=(a, b): rolling calcolato sulla sola slice values[a:b] (finestra
+        che riparte da a, come il backtest per fold). ts: timestamp della serie
+        (stessa lunghezza di values) per le slice causali.
+        full_history: rolling sull'intera serie, span restituito come vista.
+        method: "rolling" (pandas, default) o "prefix" (somme prefisse
+        condivise da tutte le finestre della stessa serie/span).
+        `pair` identifica la serie all'interno del processo.
+        window a tempo (pd.Timedelta): richiede ts.
+        """
+        n = len(values)
+        if is_time(window) and ts is None:
+            raise ValueError("Finestra a tempo senza timestamp")
+        t_all = ts_ns(ts) if ts is not None else None
+        if min_periods is None:
+            min_periods = _min_periods(window, t_all)
+        if full_history and span is not None:
+            a, b = span
+            return self.get(pair, values, window, min_periods, ts=ts, zero_std_nan=zero_std_nan,
+                            method=method).view(a, b).signed(sign)
+        a, b = span if span is not None else (0, n)
+        arr = np.asarray(values, dtype=np.float64)[a:b]
+        t = t_all[a:b] if t_all is not None else None
+        wkey = str(window) if is_time(window) else int(window)
+        key = (pair, wkey, int(min_periods), int(a), int(b), bool(zero_std_nan), method, fingerprint(arr, t))
+
+        f = self._entries.get(key)
+        if f is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return f.signed(sign)
+
+        self.misses += 1
+        if method == "prefix":
+            f = self.moments(pair, values, span=(a, b)).features(window, min_periods, zero_std_nan=zero_std_nan, ts=t)
+        elif method == "rolling":
+            f = rolling_features(arr, window, min_periods, zero_std_nan=zero_std_nan, ts=t)
+        else:
+            raise ValueError(f"method sconosciuto: {method}")
+        if ts is not None:
+            f.ts = t
+        self._put(key, f)
+        return f.signed(sign)
+
+    def moments(self, pair: str, values, span: Optional[Tuple[int, int]] = None) -> PrefixMoments:
+        """Somme prefisse di values[a:b] (una per serie/span, condivise tra finestre)."""
+        a, b = span if span is not None else (0, len(values))
+        arr = np.asarray(values, dtype=np.float64)[a:b]
+        key = ("__moments__", pair, int(a), int(b), fingerprint(arr))
+        pm = self._entries.get(key)
+        if pm is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return pm
+        self.misses += 1
+        pm = PrefixMoments.build(arr)
+        self._put(key, pm)
+        return pm
+
+    def _put(self, key: tuple, f):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self._entries[key] = f
+        self.nbytes += f.nbytes
+        # evict LRU (tiene sempre almeno l'ultima entry)
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, ev = self._entries.popitem(last=False)
+            self.nbytes -= ev.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# cache condivisa dagli script dello stesso processo
+FEATURES = FeatureCache(int(float(os.environ.get("ARBISENSE_FEATURE_CACHE_MB", "256")) * 2**20))
@@ -1,33 +1,38 @@
 #!/usr/bin/env python3
-import sys
+import argparse
 import logging
 import yfinance as yf
 import pandas as pd
 import os
 
+from bar_clock import default_period, interval_suffix
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
 DATA_DIR = "data_sample"
 
-def fetch_and_save(ticker):
+def fetch_and_save(ticker, period="2y", interval="1d"):
     try:
-        logger.info(f"Fetching {ticker}...")
-        data = yf.download(ticker, period="2y", interval="1d", progress=False)
+        logger.info(f"Fetching {ticker} ({interval}, {period})...")
+        data = yf.download(ticker, period=period, interval=interval, progress=False)
         if data.empty:
             logger.warning(f"No data for {ticker}")
             return
         data = data[['Close']].rename(columns={'Close': ticker})
         os.makedirs(DATA_DIR, exist_ok=True)
-        filename = f"{DATA_DIR}/{ticker}.csv"
+        filename = f"{DATA_DIR}/{ticker}{interval_suffix(interval)}.csv"
         data.to_csv(filename)
         logger.info(f"Saved {filename}")
     except Exception as e:
         logger.error(f"Error fetching {ticker}: {e}")
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        logger.error("Usage: python scripts/fetch_prices.py TICKER1 [TICKER2 ...]")
-        sys.exit(1)
-    for t in sys.argv[1:]:
-        fetch_and_save(t)
+    ap = argparse.ArgumentParser()
+    ap.add_argument("tickers", nargs="+")
+    ap.add_argument("--interval", default="1d", help="barre yfinance; se diverso da 1d il file è {ticker}_{interval}.csv")
+    ap.add_argument("--period", default=None, help="default: 2y (1d), limiti yfinance per l'intraday")
+    args = ap.parse_args()
+    period = args.period or default_period(args.interval)
+    for t in args.tickers:
+        fetch_and_save(t, period=period, interval=args.interval)
@@ -1,5 +1,6 @@
 import argparse, pandas as pd, numpy as np
 from pathlib import Path
+from feature_cache import FEATURES
 
 ap = argparse.ArgumentParser()
 ap.add_argument("--input", default="reports/strong_signals.csv")
@@ -38,12 +39,14 @@ if not {"pair","spread_raw","spread_scale"}.issubset(raw.columns):
 
 # z = standardizzazione rolling dello spread_eff = spread_raw * spread_scale
 raw["spread_eff"] = raw["spread_raw"].astype(float) * raw["spread_scale"].fillna(1.0).astype(float)
+# (feature rolling dalla cache condivisa, con ts per le slice causali di zvol_ok)
 raw["z"] = np.nan
+feats = {}
 for p, g in raw.groupby("pair"):
-    se = g["spread_eff"].astype(float)
-    mu = se.rolling(args.z_window, min_periods=max(5, args.z_window//2)).mean()
-    sd = se.rolling(args.z_window, min_periods=max(5, args.z_window//2)).std(ddof=0)
-    raw.loc[g.index, "z"] = (se - mu) / sd.replace(0, np.nan)
+    f = FEATURES.get(p, g["spread_eff"].astype(float), args.z_window, max(5, args.z_window//2),
+                     ts=g[tcol], zero_std_nan=True)
+    raw.loc[g.index, "z"] = f.z
+    feats[p] = f
 
 # mappa adf_p da pair_quality (se richiesto)
 adf_map = {}
@@ -58,12 +61,13 @@ df = df.sort_values(["pair","timestamp"]).reset_index(drop=True)
 
 def zvol_ok(pair, ts):
     if args.regime_zvol_max is None: return True
-    g = raw[raw["pair"]==pair]
-    if g.empty: return True
-    g = g[g[tcol] <= ts].tail(args.regime_zvol_window)
-    if len(g) < max(5, args.regime_zvol_window//2):  # pochi punti -> non blocco
+    f = feats.get(pair)
+    if f is None or pd.isna(ts): return True
+    # ultime `win` barre con timestamp <= ts (slice causale)
+    z = f.z[f.window(f.upto(ts), args.regime_zvol_window)]
+    if len(z) < max(5, args.regime_zvol_window//2):  # pochi punti -> non blocco
         return True
-    zvol = g["z"].std(ddof=0)
+    zvol = pd.Series(z).std(ddof=0)
     return bool(pd.notna(zvol) and zvol <= args.regime_zvol_max)
 
 def adf_ok(pair):
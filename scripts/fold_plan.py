@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — piano dei fold walk-forward a offset interi
+
+Le finestre TRAIN/TEST (timestamp) di una pair vengono convertite una sola
+volta in offset posizionali [a, b) con searchsorted sui timestamp int64 ns
+(serie ordinata), invece di costruire maschere booleane e copie per fold.
+Le slice x[a:b] sugli array NumPy sono viste, senza copie.
+
+  inclusive_end=True  -> finestra [start, end]   (WF v1, date inclusive)
+  inclusive_end=False -> finestra [start, end)   (WF v2)
+
+Le finestre stesse vengono da `rolling_windows`: con durate in giorni
+(interi, storico) o pd.Timedelta (es. "36h" per fold su barre intraday).
+`expanding_windows`: stessi TEST, TRAIN ancorato all'inizio (espandente);
+`TrainCarry` riporta da un fold al successivo le feature del TRAIN e lo
+stato della griglia (bt_kernel.GridState), così ogni fold simula solo le
+barre TRAIN nuove.
+Con barre intraday le date inclusive di v1 taglierebbero l'ultimo giorno
+di TRAIN (fine = mezzanotte): lì si usano finestre semiaperte.
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple, Union
+import numpy as np
+import pandas as pd
+
+from bt_kernel import GridState
+from feature_cache import FEATURES, RollingFeatures, ts_ns
+
+Window = Tuple[pd.Timestamp, pd.Timestamp, pd.Timestamp, pd.Timestamp]
+
+
+@dataclass
+class FoldPlan:
+    """Fold di una pair: finestre temporali + offset [a, b) di TRAIN e TEST."""
+    windows: List[Window]
+    tr_a: np.ndarray
+    tr_b: np.ndarray
+    te_a: np.ndarray
+    te_b: np.ndarray
+    intraday: bool = False   # barre intraday: finestre semiaperte, date con orario negli output
+
+    def __len__(self) -> int:
+        return len(self.windows)
+
+    def tr(self, k: int) -> Tuple[int, int]:
+        return int(self.tr_a[k]), int(self.tr_b[k])
+
+    def te(self, k: int) -> Tuple[int, int]:
+        return int(self.te_a[k]), int(self.te_b[k])
+
+
+def _ns(values) -> np.ndarray:
+    return ts_ns(pd.DatetimeIndex(list(values))) if len(values) else np.zeros(0, np.int64)
+
+
+def build_plan(ts, windows: Sequence[Window], *, inclusive_end: bool, intraday: bool = False) -> FoldPlan:
+    """
+    ts: timestamp ordinati della pair (Series/array di datetime o int64 ns UTC).
+    windows: (train_start, train_end, test_start, test_end) per fold.
+    """
+    t = ts_ns(ts)
+    windows = list(windows)
+    cols = list(zip(*windows)) if windows else [(), (), (), ()]
+    tr_s, tr_e, te_s, te_e = (_ns(c) for c in cols)
+    end_side = "right" if inclusive_end else "left"
+    return FoldPlan(
+        windows=windows,
+        tr_a=np.searchsorted(t, tr_s, side="left"),
+        tr_b=np.searchsorted(t, tr_e, side=end_side),
+        te_a=np.searchsorted(t, te_s, side="left"),
+        te_b=np.searchsorted(t, te_e, side=end_side),
+        intraday=intraday,
+    )
+
+
+def rolling_windows(start, end, *, train: Union[int, pd.Timedelta], test: Union[int, pd.Timedelta],
+                    step: Union[int, pd.Timedelta], inclusive_end: bool) -> List[Window]:
+    """
+    Finestre (train_start, train_end, test_start, test_end) scorrevoli da
+    start a end; train/test/step in giorni (int) o pd.Timedelta.
+      inclusive_end=True  (WF v1, barre giornaliere): date inclusive,
+                          train_end = start + train - 1 giorno
+      inclusive_end=False (WF v2, barre intraday):    [start, start + train), [.., + test)
+    """
+    day = pd.Timedelta(days=1)
+    td, vd, sd = (x if isinstance(x, pd.Timedelta) else pd.Timedelta(days=int(x)) for x in (train, test, step))
+    cur = pd.to_datetime(start, utc=True)
+    end = pd.to_datetime(end, utc=True)
+    windows: List[Window] = []
+    if inclusive_end:
+        while cur + td + vd <= end + day:
+            tr_end = cur + td - day
+            windows.append((cur, tr_end, tr_end + day, tr_end + vd))
+            cur += sd
+    else:
+        while cur + td + vd <= end:
+            windows.append((cur, cur + td, cur + td, cur + td + vd))
+            cur += sd
+    return windows
+
+
+def expanding_windows(start, end, *, train: Union[int, pd.Timedelta], test: Union[int, pd.Timedelta],
+                      step: Union[int, pd.Timedelta], inclusive_end: bool) -> List[Window]:
+    """
+    Come rolling_windows (stesse fini di TRAIN e stessi TEST), ma il TRAIN
+    parte sempre da start: il TRAIN del fold k estende quello del fold k-1
+    di `step`.
+    """
+    anchor = pd.to_datetime(start, utc=True)
+    return [(anchor, tr_end, te_start, te_end)
+            for _, tr_end, te_start, te_end in rolling_windows(start, end, train=train, test=test, step=step,
+                                                               inclusive_end=inclusive_end)]
+
+
+class TrainCarry:
+    """
+    Stato del TRAIN espandente tra i fold `ks` (in ordine) di una pair:
+      - feature rolling calcolate una volta sullo span ancorato fino
+        all'ultima fine TRAIN; il TRAIN di ogni fold ne è una vista
+        (rolling causale dallo stesso inizio: gli stessi numeri del
+        calcolo sul solo prefisso)
+      - GridState di evaluate_grid per (finestra z, segno): posizioni aperte
+        a fine TRAIN e accumulatori delle metriche passano al fold
+        successivo, che simula solo le barre nuove
+    """
+
+    def __init__(self, plan: FoldPlan, ks: Sequence[int]):
+        self.a = int(plan.tr_a[ks[0]])
+        if any(int(plan.tr_a[k]) != self.a for k in ks):
+            raise ValueError("TrainCarry: TRAIN non ancorati allo stesso inizio")
+        self.b = int(max(plan.tr_b[k] for k in ks))
+        self.states: Dict[tuple, GridState] = {}
+
+    def features(self, pair: str, values, window, span: Tuple[int, int], **kw) -> RollingFeatures:
+        """Come FEATURES.get(..., span=span) per il TRAIN (span = (inizio ancorato, fine TRAIN))."""
+        return FEATURES.get(pair, values, window, span=(self.a, self.b), **kw).view(0, span[1] - self.a)
+
+    def state(self, key, n_combos: int) -> GridState:
+        st = self.states.get(key)
+        if st is None:
+            st = self.states[key] = GridState.start(n_combos)
+        return st
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — robustezza dei preset con Monte Carlo block-bootstrap
+
+I preset (presets_from_true_wf.py / promote_from_true_v4.py) sono promossi
+su un solo percorso storico OOS. Qui ogni preset gira su migliaia di
+ricampionamenti stationary block-bootstrap (Politis-Romano) dello
+spread_eff della sua pair e se ne leggono le distribuzioni di PnL, Sharpe
+e MaxDD.
+
+  - bootstrap: blocchi di lunghezza geometrica (media --block barre) con
+    inizio uniforme e avvolgimento circolare, sui livelli di spread_eff
+    (serie stazionaria per costruzione); i valori ricampionati restano sul
+    clock originale (max_hold/z_window a tempo invariati)
+  - simulazione come walkforward_backtest_v2.simulate_trades: z rolling su
+    sign * spread_eff, segnale su z[i], esecuzione a i + latency, costi
+    2 x (fee + slippage), PnL mark-to-market giornaliero
+  - vettoriale sui percorsi: i ricampionamenti di un blocco (--batch) sono
+    colonne di una matrice (barre x percorsi); z rolling di pandas sulle
+    colonne, macchina a stati con bt_kernel.run_kernel_paths (un passaggio
+    sulle barre per tutti i percorsi), metriche con mtm_metrics_paths
+  - parallelo: task (preset, blocco) su --workers processi (wf_parallel);
+    ogni blocco ha il suo generatore (SeedSequence(seed) con spawn_key
+    (preset, blocco)): stessi --seed/--batch -> stessi percorsi qualunque
+    sia --workers
+  - percorso storico ("hist") con la stessa simulazione, come riferimento
+
+Output:
+  reports/mc_paths.csv    una riga per (pair, percorso): trades, net_pnl, Sharpe, MaxDD, ...
+  reports/mc_summary.csv  per (pair, metrica): storico, media, std, quantili,
+                          quota di percorsi <= storico; prob_loss per net_pnl
+
+Esempio:
+  python scripts/mc_bootstrap.py --input data_sample/spread_report_all_pairs_long.normalized.csv \\
+      --presets reports/presets.json --paths 5000 --block 20 --workers 4
+"""
+from __future__ import annotations
+import argparse, json, os, time
+from typing import Any, Dict, List
+import numpy as np
+import pandas as pd
+
+from bt_kernel import run_kernel_paths, mtm_pnl_paths, mtm_metrics_paths, MTM_METRICS
+from feature_cache import ts_ns
+from bar_clock import parse_duration, is_time, bar_ns, default_min_periods, hold_deadline, fmt_duration
+from wf_parallel import STATE, iter_tasks
+
+MC_METRICS = ("trades", "net_pnl") + MTM_METRICS
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def stationary_bootstrap_index(n: int, paths: int, block: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    Indici (n x paths) dello stationary bootstrap: a ogni barra un nuovo
+    blocco parte con probabilità 1/block da una barra uniforme, altrimenti
+    si prosegue dalla barra successiva (circolare).
+    """
+    new = rng.random((n, paths)) < 1.0 / max(float(block), 1.0)
+    new[0] = True
+    start = rng.integers(0, n, size=(n, paths))
+    rows = np.arange(n)[:, None]
+    first = np.maximum.accumulate(np.where(new, rows, 0), axis=0)
+    return (np.take_along_axis(start, first, axis=0) + rows - first) % n
+
+
+def rolling_z_paths(X: np.ndarray, window, t: np.ndarray) -> np.ndarray:
+    """z rolling (ddof=0) di ogni colonna, stessi numeri dello zscore di v2 / rolling_features."""
+    df = pd.DataFrame(X)
+    if is_time(window):
+        df.index = pd.to_datetime(t, utc=True)
+    r = df.rolling(window, min_periods=default_min_periods(window, bar_ns(t)))
+    return ((df - r.mean()) / r.std(ddof=0)).to_numpy()
+
+
+def simulate_paths(X: np.ndarray, t: np.ndarray, pre: Dict[str, Any], fee_bps: float,
+                   slippage_bps: float) -> Dict[str, np.ndarray]:
+    """Preset su ogni colonna di X (spread_eff ricampionato, barre x percorsi): metriche per percorso."""
+    notional = float(pre["notional"])
+    Z = rolling_z_paths(X * pre["sign"], pre["z_window"], t)
+    timed = is_time(pre["max_hold"])
+    pos, exits = run_kernel_paths(Z, side=pre["side"], z_enter=pre["z_enter"], z_exit=pre["z_exit"],
+                                  z_stop=pre["z_stop"], max_hold=1 if timed else pre["max_hold"],
+                                  exec_delay=pre["latency"], deferred=True,
+                                  hold_until=hold_deadline(t, pre["max_hold"]) if timed else None)
+    cost = 2 * notional * (fee_bps + slippage_bps) / 10_000.0
+    pnl = mtm_pnl_paths(pos, exits, X, pnl_mult=notional, cost=cost)
+    out = mtm_metrics_paths(pnl, t, capital=notional)
+    out["trades"] = exits.sum(axis=0, dtype=np.int64).astype(np.float64)
+    return out
+
+
+def mc_task(task):
+    """(preset, blocco) -> metriche dei percorsi del blocco; blocco -1 = percorso storico."""
+    pi, b = task
+    st = STATE
+    eff, t = st["arrays"][f"e{pi}"], st["arrays"][f"t{pi}"]
+    n = eff.shape[0]
+    if b < 0:
+        idx = np.arange(n)[:, None]
+    else:
+        paths = min(st["batch"], st["paths"] - b * st["batch"])
+        rng = np.random.default_rng(np.random.SeedSequence(st["seed"], spawn_key=(pi, b)))
+        idx = stationary_bootstrap_index(n, paths, st["block"], rng)
+    return simulate_paths(eff[idx], t, st["presets"][pi], st["fee_bps"], st["slippage_bps"])
+
+
+def load_presets(path: str) -> List[Dict[str, Any]]:
+    """Lista di preset (presets.json) o preset singolo (preset_best.json); params hanno la precedenza."""
+    raw = json.load(open(path))
+    out = []
+    for it in (raw if isinstance(raw, list) else [raw]):
+        p = {k: v for k, v in it.items() if k != "params"}
+        p.update(it.get("params") or {})
+        out.append(p)
+    return out
+
+
+def normalize_preset(p: Dict[str, Any]) -> Dict[str, Any]:
+    """Campi usati dalla simulazione, con i default di v2 / export_from_preset."""
+    return dict(pair=str(p["pair"]), side=str(p.get("side", "short")),
+                z_enter=float(p["z_enter"]), z_exit=float(p["z_exit"]),
+                z_stop=float(p.get("z_stop", 99.0)), max_hold=parse_duration(p.get("max_hold", 5)),
+                latency=int(float(p.get("latency", 0))), z_window=parse_duration(p.get("z_window", 40)),
+                notional=float(p.get("notional", 250000.0)), sign=int(p.get("sign", 1)))
+
+
+def summarize(pair: str, hist: Dict[str, np.ndarray], dist: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+    rows = []
+    for m in MC_METRICS:
+        x = dist[m]
+        h = float(hist[m][0])
+        row = {"pair": pair, "metric": m, "hist": h, "mean": float(x.mean()), "std": float(x.std())}
+        for q, v in zip(QUANTILES, np.quantile(x, QUANTILES)):
+            row[f"p{int(round(q * 100)):02d}"] = float(v)
+        row["hist_pctile"] = float((x <= h).mean())
+        row["prob_loss"] = float((x < 0).mean()) if m == "net_pnl" else np.nan
+        rows.append(row)
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser("ArbiSense Monte Carlo block-bootstrap")
+    ap.add_argument("--input", default="data_sample/spread_report_all_pairs_long.normalized.csv")
+    ap.add_argument("--presets", default="reports/presets.json")
+    ap.add_argument("--pairs", default=None, help="lista separata da virgola (default: tutte quelle dei preset)")
+    ap.add_argument("--paths", type=int, default=2000, help="ricampionamenti per preset")
+    ap.add_argument("--block", type=float, default=20.0, help="lunghezza media dei blocchi (barre)")
+    ap.add_argument("--batch", type=int, default=500, help="percorsi per task (memoria ~ batch x barre)")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--start", default=None)
+    ap.add_argument("--end", default=None)
+    ap.add_argument("--spread-scale", default="auto")
+    ap.add_argument("--fee-bps", type=float, default=0.0)
+    ap.add_argument("--slippage-bps", type=float, default=0.0)
+    ap.add_argument("--outdir", default="reports")
+    args = ap.parse_args()
+
+    presets = []
+    for p in load_presets(args.presets):
+        try:
+            presets.append(normalize_preset(p))
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"[WARN] preset {p.get('pair')} senza parametri utilizzabili ({e}): saltato")
+    if args.pairs:
+        keep = {x.strip() for x in args.pairs.split(",") if x.strip()}
+        presets = [p for p in presets if p["pair"] in keep]
+    if not presets:
+        raise SystemExit("Nessun preset da valutare")
+
+    # spread_eff per pair come in walkforward_backtest_v2
+    df = pd.read_csv(args.input)
+    date_col = "date" if "date" in df.columns else ("timestamp" if "timestamp" in df.columns else None)
+    if not date_col:
+        raise SystemExit("Input deve avere 'date' o 'timestamp'")
+    df[date_col] = pd.to_datetime(df[date_col], utc=True, errors="coerce")
+    scale = pd.to_numeric(df["spread_scale"], errors="coerce") if str(args.spread_scale).lower() == "auto" \
+        else float(args.spread_scale)
+    df["spread_eff"] = pd.to_numeric(df["spread_raw"], errors="coerce") * scale
+    if args.start: df = df[df[date_col] >= pd.to_datetime(args.start, utc=True)]
+    if args.end:   df = df[df[date_col] <= pd.to_datetime(args.end, utc=True)]
+    df = df.dropna(subset=[date_col, "spread_eff"]).sort_values(["pair", date_col])
+    groups = dict(tuple(df.groupby("pair")))
+
+    arrays: Dict[str, np.ndarray] = {}
+    used = []
+    for p in presets:
+        g = groups.get(p["pair"])
+        if g is None or len(g) < 2:
+            print(f"[WARN] {p['pair']}: nessun dato in input, saltato")
+            continue
+        pi = len(used)
+        arrays[f"e{pi}"] = g["spread_eff"].to_numpy(dtype=np.float64)
+        arrays[f"t{pi}"] = ts_ns(g[date_col])
+        used.append(p)
+    if not used:
+        raise SystemExit("Nessun preset con dati")
+
+    n_batches = -(-args.paths // args.batch)
+    tasks = [(pi, b) for pi in range(len(used)) for b in range(-1, n_batches)]
+    state = dict(presets=used, paths=args.paths, batch=args.batch, block=args.block, seed=args.seed,
+                 fee_bps=args.fee_bps, slippage_bps=args.slippage_bps)
+    t0 = time.perf_counter()
+    res: Dict[int, List[Dict[str, np.ndarray]]] = {pi: [] for pi in range(len(used))}
+    for (pi, _), r in zip(tasks, iter_tasks(mc_task, tasks, workers=args.workers, arrays=arrays, state=state)):
+        res[pi].append(r)
+    elapsed = time.perf_counter() - t0
+
+    path_frames, summary = [], []
+    for pi, p in enumerate(used):
+        hist, blocks = res[pi][0], res[pi][1:]
+        dist = {m: np.concatenate([r[m] for r in blocks]) for m in MC_METRICS}
+        path_frames.append(pd.DataFrame({"pair": p["pair"], "path": np.arange(args.paths), **dist}))
+        summary += summarize(p["pair"], hist, dist)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    paths_csv = os.path.join(args.outdir, "mc_paths.csv")
+    summary_csv = os.path.join(args.outdir, "mc_summary.csv")
+    pd.concat(path_frames, ignore_index=True).to_csv(paths_csv, index=False)
+    sm = pd.DataFrame(summary)
+    sm.to_csv(summary_csv, index=False)
+    print(f"[WROTE] {paths_csv}")
+    print(f"[WROTE] {summary_csv}")
+    print(f"[INFO] {len(used)} preset x {args.paths} percorsi (blocco medio {args.block:g} barre) in {elapsed:.1f}s")
+    for p in used:
+        s = sm[sm["pair"] == p["pair"]].set_index("metric")
+        print(f"- {p['pair']} z {p['z_enter']}/{p['z_exit']} hold {fmt_duration(p['max_hold'])}  "
+              f"PnL hist {s.at['net_pnl', 'hist']:.0f} p05 {s.at['net_pnl', 'p05']:.0f} "
+              f"p50 {s.at['net_pnl', 'p50']:.0f}  P(loss) {s.at['net_pnl', 'prob_loss']:.0%}  "
+              f"Sharpe p50 {s.at['Sharpe', 'p50']:.2f}  MaxDD p05 {s.at['MaxDD', 'p05']:.0f}")
+
+
+if __name__ == "__main__":
+    main()
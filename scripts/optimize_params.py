@@ -4,71 +4,189 @@
 """
 ArbiSense — Grid Search dei parametri del backtest
 
-Esegue backtest_signals.py molte volte con combinazioni di:
+Valuta il backtest di backtest_signals.py (importato come libreria, niente
+subprocess per combinazione) su molte combinazioni di:
 - z-enter, z-exit, z-stop, max-hold, latency-days
-e salva i risultati in:
+Input letto e preparato (date, scala, z-score) UNA volta; le combinazioni
+girano in un pool di worker (--workers) con gli array in shared memory e
+i risultati sono scritti in streaming, nell'ordine della griglia, in:
   reports/opt_results.csv   (tutte le combinazioni)
   reports/opt_best.json     (migliore combinazione)
+Metriche per combinazione: riga della prima pair (come la lettura di
+backtest_metrics.csv .iloc[0] del run a subprocess).
 Criterio: massimizza Sharpe; tie-break per net_pnl_total e MaxDD (più alto Sharpe, più alto PnL, minore MaxDD).
+Con --select pareto: fronte non dominato su PnL, Sharpe, MaxDD, trades,
+hit rate (pareto_select.py) scritto in reports/opt_pareto.csv; il best è la
+combinazione del fronte con lo score pesato più alto (--weights).
+
+Ricerca a budget (--strategy random|tpe|cmaes, --budget N): le soglie z
+sono continue nell'intervallo dato ("lo:hi" oppure [min, max] della lista),
+max-hold intero, latency-days scelta tra i valori. Le valutazioni sono
+asincrone (un nuovo ask appena un worker si libera); ogni trial è appeso a
+  reports/opt_trials.jsonl  (storico persistente)
+e con --resume i trial con lo stesso contesto (input, pair, fee, notional,
+z-window, scala) vengono ri-passati alla strategia prima di proseguire.
+In questa modalità opt_results.csv è nell'ordine di completamento.
 """
 
-import os, sys, json, itertools, subprocess
+import os, sys, json, itertools, argparse
 from pathlib import Path
 import pandas as pd
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from backtest_signals import load_pairs, prepare_pair, backtest_prepared, empty_metrics
+from wf_parallel import TaskPool, STATE
+from result_cache import ResultCache, make_key, iter_cached
+from search_strategies import Space, parse_axis, make_strategy, STRATEGIES
+from pareto_select import OBJECTIVES, parse_objectives, parse_weights, pareto_select
+
 BASE_DIR = Path(__file__).parent.parent
-BACKTEST = BASE_DIR / "scripts" / "backtest_signals.py"
-METRICS  = BASE_DIR / "reports" / "backtest_metrics.csv"
 RESULTS  = BASE_DIR / "reports" / "opt_results.csv"
 BESTJSON = BASE_DIR / "reports" / "opt_best.json"
+TRIALS   = BASE_DIR / "reports" / "opt_trials.jsonl"
+PARETO   = BASE_DIR / "reports" / "opt_pareto.csv"
+
+def bt_args(params, input_path):
+    """Namespace equivalente alla CLI di backtest_signals.py per una combinazione."""
+    return argparse.Namespace(
+        input=input_path, pairs=None, pairs_file=None, side="short",
+        z_enter=float(params["z_enter"]), z_exit=float(params["z_exit"]), z_stop=float(params["z_stop"]),
+        latency_days=int(params["latency_days"]), max_hold=int(params["max_hold"]),
+        fee_bps=float(params["fee_bps"]), slippage_bps=float(params["slippage_bps"]),
+        notional=float(params["notional"]), start=None, end=None,
+        z_window=int(params["z_window"]), spread_scale=params["spread_scale"],
+    )
+
+def run_bt(params):
+    """Una combinazione (worker): backtest della prima pair sugli array preparati."""
+    st = STATE
+    args = bt_args(params, st["input"])
+    pair, meta = st["pair"], st["meta"]
+    try:
+        if meta is None:
+            m = empty_metrics(pair, args).iloc[0].to_dict()
+        else:
+            a = st["arrays"]
+            _, mdf = backtest_prepared(pair, a["s"], a["z"], a["d_ns"], args=args, **meta)
+            m = mdf.iloc[0].to_dict()
+        m.update(params)
+        return m, None
+    except Exception as e:
+        return None, f"{params}: {e}"
+
+def combo_key(state, arrays, task):
+    """Chiave della cache per una combinazione: array preparati della pair + parametri."""
+    return make_key("opt", arrays=[arrays[k] for k in sorted(arrays)],
+                    params=dict(task, pair=state["pair"], meta=state["meta"]))
+
+def trial_score(m):
+    """Obiettivo delle strategie: Sharpe (NaN -> 0, come nel criterio del best)."""
+    sh = m.get("Sharpe")
+    return 0.0 if sh is None or pd.isna(sh) else float(sh)
 
-def run_bt(pairs_file, params):
-    cmd = [
-        "python3", str(BACKTEST),
-        "--pairs-file", str(pairs_file),
-        "--z-enter",  str(params["z_enter"]),
-        "--z-exit",   str(params["z_exit"]),
-        "--z-stop",   str(params["z_stop"]),
-        "--latency-days", str(params["latency_days"]),
-        "--max-hold", str(params["max_hold"]),
-        "--fee-bps",  str(params["fee_bps"]),
-        "--slippage-bps", str(params["slippage_bps"]),
-        "--notional", str(params["notional"]),
-        "--z-window", str(params["z_window"]),
-        "--spread-scale", str(params["spread_scale"])
-    ]
-    out = subprocess.run(cmd, capture_output=True, text=True)
-    if out.returncode != 0:
-        raise RuntimeError(out.stderr or out.stdout or "Backtest failed")
-    if not METRICS.exists():
-        raise RuntimeError("metrics file not found after backtest")
-    m = pd.read_csv(METRICS).iloc[0].to_dict()
-    return m, out.stdout
+def load_trials(path, context):
+    """Trial dello storico con lo stesso contesto (righe JSON illeggibili ignorate)."""
+    out = []
+    if not Path(path).exists():
+        return out
+    with open(path) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if rec.get("context") == context:
+                out.append(rec)
+    return out
+
+def run_search(args, fixed, arrays, state, context, fout, cache=None):
+    """Ricerca ask/tell a budget con valutazioni asincrone; restituisce le righe."""
+    space = Space([
+        parse_axis("z_enter", args.z_enter, "float"),
+        parse_axis("z_exit", args.z_exit, "float"),
+        parse_axis("z_stop", args.z_stop, "float"),
+        parse_axis("max_hold", args.max_hold, "int"),
+        parse_axis("latency_days", args.latency_days, "choice"),
+    ])
+    history = load_trials(args.trials, context) if args.resume else []
+    strat = make_strategy(args.strategy, space, seed=args.seed, resume=len(history))
+    rows = []
+    if args.resume:
+        for rec in history:
+            m = rec["metrics"]
+            strat.tell(rec["params"], trial_score(m))
+            pd.DataFrame([m]).to_csv(fout, header=not rows, index=False)
+            rows.append(m)
+        print(f"[INFO] resume: {len(rows)} trial da {args.trials}", flush=True)
+
+    Path(args.trials).parent.mkdir(parents=True, exist_ok=True)
+    budget, asked = int(args.budget), 0
+    with TaskPool(run_bt, workers=min(args.workers, max(budget, 1)), arrays=arrays, state=state) as pool, \
+         open(args.trials, "a") as ftr:
+        while asked < budget or pool.pending:
+            # tiene occupati tutti i worker: un ask per ogni slot libero
+            while asked < budget and pool.pending < max(args.workers, 1):
+                task = dict(strat.ask(), **fixed)
+                hit = cache.get(combo_key(state, arrays, task), None) if cache is not None else None
+                if hit is not None:
+                    pool.resolve(dict(task, _cached=True), hit)   # marcato: non ri-salvato in cache
+                else:
+                    pool.submit(task)
+                asked += 1
+            task, (m, err) = pool.done()
+            cached = task.pop("_cached", False)
+            params = {k: task[k] for k in ("z_enter", "z_exit", "z_stop", "max_hold", "latency_days")}
+            if err is not None:
+                print(f"[FAIL] {err}", file=sys.stderr)
+                continue
+            if cache is not None and not cached:
+                cache.put(combo_key(state, arrays, task), (m, err), "opt")
+            strat.tell(params, trial_score(m))
+            m = {k: (v.item() if hasattr(v, "item") else v) for k, v in m.items()}
+            ftr.write(json.dumps(dict(strategy=args.strategy, context=context, params=params, metrics=m)) + "\n")
+            ftr.flush()
+            pd.DataFrame([m]).to_csv(fout, header=not rows, index=False)
+            fout.flush()
+            rows.append(m)
+            print(f"[OK] #{len(rows)} zE={m['z_enter']} zX={m['z_exit']} zS={m['z_stop']} H={m['max_hold']} L={m['latency_days']}  ->  Sharpe={m.get('Sharpe'):0.3f}  PnL={m.get('net_pnl_total'):0.0f}")
+    return rows
 
 def main():
-    import argparse
     ap = argparse.ArgumentParser("ArbiSense Optimizer")
+    ap.add_argument("--input", default="data_sample/spread_report_all_pairs_long.csv")
     ap.add_argument("--pairs-file", default=str(BASE_DIR / "reports" / "selected_pairs.csv"))
     ap.add_argument("--notional", type=float, default=250_000)
     ap.add_argument("--z-window", type=int, default=60)
     ap.add_argument("--spread-scale", default="auto")
     ap.add_argument("--fee-bps", type=float, default=1.0)
     ap.add_argument("--slippage-bps", type=float, default=1.0)
-    # griglie
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                    help="processi per le combinazioni (default: tutti i core)")
+    ap.add_argument("--strategy", choices=["grid"] + sorted(STRATEGIES), default="grid",
+                    help="grid = prodotto cartesiano; random/tpe/cmaes = ricerca a budget")
+    ap.add_argument("--budget", type=int, default=50, help="valutazioni per le strategie a budget")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--trials", default=str(TRIALS), help="storico persistente dei trial (JSONL)")
+    ap.add_argument("--resume", action="store_true", help="riprende dallo storico dei trial")
+    ap.add_argument("--cache", nargs="?", const=str(BASE_DIR / "reports" / "bt_cache.sqlite"), default=None,
+                    help="cache persistente dei risultati per combinazione (SQLite); senza valore "
+                         "usa reports/bt_cache.sqlite")
+    ap.add_argument("--select", choices=["sharpe", "pareto"], default="sharpe",
+                    help="sharpe: Sharpe con tie-break PnL/MaxDD; pareto: fronte multi-obiettivo + --weights")
+    ap.add_argument("--weights", default=None,
+                    help=f"pesi per --select pareto su {','.join(OBJECTIVES)} (es. net_pnl_total=2,Sharpe=1; default tutti 1)")
+    # griglie (strategie a budget: intervalli, anche "lo:hi")
     ap.add_argument("--z-enter",  default="2.5,3.0,3.5")
     ap.add_argument("--z-exit",   default="0.5,0.75,1.0")
     ap.add_argument("--z-stop",   default="3.0,3.5,4.0")
     ap.add_argument("--max-hold", default="5,10,15")
     ap.add_argument("--latency-days", default="1")
     args = ap.parse_args()
-
-    grids = {
-        "z_enter":      [float(x) for x in str(args.z_enter).split(",") if x],
-        "z_exit":       [float(x) for x in str(args.z_exit).split(",") if x],
-        "z_stop":       [float(x) for x in str(args.z_stop).split(",") if x],
-        "max_hold":     [int(x)   for x in str(args.max_hold).split(",") if x],
-        "latency_days": [int(x)   for x in str(args.latency_days).split(",") if x],
-    }
+    objectives = parse_objectives(None)
+    try:
+        weights = parse_weights(args.weights, objectives)
+    except ValueError as e:
+        sys.exit(str(e))
 
     fixed = {
         "fee_bps": args.fee_bps,
@@ -78,31 +196,77 @@ def main():
         "spread_scale": args.spread_scale,
     }
 
-    combos = list(itertools.product(*grids.values()))
-    print(f"[INFO] Running {len(combos)} combinations...", flush=True)
+    # dati letti e preparati una volta (date, scala, z: non dipendono dalle soglie)
+    base = bt_args(dict(z_enter=0, z_exit=0, z_stop=0, max_hold=1, latency_days=0, **fixed), args.input)
+    base.pairs_file = args.pairs_file
+    pairs = load_pairs(base)
+    pair, g = pairs[0]
+    prep = prepare_pair(g, base)
+    arrays, meta = {}, None
+    if prep is not None:
+        arrays = {k: prep.pop(k) for k in ("s", "z", "d_ns")}
+        meta = prep
+    state = dict(input=args.input, pair=pair, meta=meta)
 
-    rows = []
-    for (ze, zx, zs, mh, lat) in combos:
-        params = dict(z_enter=ze, z_exit=zx, z_stop=zs, max_hold=mh, latency_days=lat, **fixed)
-        try:
-            m, _ = run_bt(args.pairs_file, params)
-            m.update(params)
-            rows.append(m)
-            print(f"[OK] zE={ze} zX={zx} zS={zs} H={mh} L={lat}  ->  Sharpe={m.get('Sharpe'):0.3f}  PnL={m.get('net_pnl_total'):0.0f}")
-        except Exception as e:
-            print(f"[FAIL] {params}: {e}", file=sys.stderr)
+    RESULTS.parent.mkdir(parents=True, exist_ok=True)
+    cache = ResultCache(args.cache) if args.cache else None
+    if args.strategy != "grid":
+        print(f"[INFO] strategy={args.strategy} budget={args.budget} workers={args.workers}", flush=True)
+        context = dict(input=str(args.input), pair=str(pair), **fixed)
+        with open(RESULTS, "w", newline="") as fout:
+            rows = run_search(args, fixed, arrays, state, context, fout, cache)
+    else:
+        grids = {
+            "z_enter":      [float(x) for x in str(args.z_enter).split(",") if x],
+            "z_exit":       [float(x) for x in str(args.z_exit).split(",") if x],
+            "z_stop":       [float(x) for x in str(args.z_stop).split(",") if x],
+            "max_hold":     [int(x)   for x in str(args.max_hold).split(",") if x],
+            "latency_days": [int(x)   for x in str(args.latency_days).split(",") if x],
+        }
+        combos = list(itertools.product(*grids.values()))
+        print(f"[INFO] Running {len(combos)} combinations...", flush=True)
+
+        tasks = [dict(z_enter=ze, z_exit=zx, z_stop=zs, max_hold=mh, latency_days=lat, **fixed)
+                 for (ze, zx, zs, mh, lat) in combos]
+
+        rows = []
+        with open(RESULTS, "w", newline="") as fout:
+            keys = [combo_key(state, arrays, t) for t in tasks] if cache is not None else []
+            for m, err in iter_cached(run_bt, tasks, keys, cache, kind="opt", cacheable=lambda r: r[1] is None,
+                                      workers=args.workers, arrays=arrays, state=state):
+                if err is not None:
+                    print(f"[FAIL] {err}", file=sys.stderr)
+                    continue
+                # streaming: una riga per combinazione, nell'ordine della griglia
+                pd.DataFrame([m]).to_csv(fout, header=not rows, index=False)
+                fout.flush()
+                rows.append(m)
+                print(f"[OK] zE={m['z_enter']} zX={m['z_exit']} zS={m['z_stop']} H={m['max_hold']} L={m['latency_days']}  ->  Sharpe={m.get('Sharpe'):0.3f}  PnL={m.get('net_pnl_total'):0.0f}")
+
+    if cache is not None:
+        print(f"[INFO] {cache.summary()}")
+        cache.close()
 
     if not rows:
         print("[ERROR] Nessun risultato.", file=sys.stderr); sys.exit(1)
 
     df = pd.DataFrame(rows)
-    RESULTS.parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(RESULTS, index=False)
 
-    # criterio: ordina per Sharpe desc, poi PnL desc, poi MaxDD asc (più vicino a 0 è meglio)
-    df["_ord"] = (-df["Sharpe"].fillna(0), -df["net_pnl_total"].fillna(-1e18), df["MaxDD"].fillna(-1))
-    best = df.sort_values(list(df["_ord"].columns) if hasattr(df["_ord"], "columns") else ["_ord"]).iloc[0].to_dict()
-    best.pop("_ord", None)
+    front = pareto_select(df, objectives, weights, by=None, min_trades=1) if args.select == "pareto" else None
+    if front is not None and not front.empty:
+        # fronte di Pareto: best = score pesato più alto (pareto_rank 1)
+        front.to_csv(PARETO, index=False)
+        best = front.iloc[0].drop(["pareto_score", "pareto_rank"]).to_dict()
+        print(f"[INFO] fronte di Pareto: {len(front)}/{len(df)} combinazioni non dominate")
+    else:
+        if front is not None:
+            print("[WARN] nessuna combinazione con trade: criterio Sharpe", file=sys.stderr)
+        # criterio: ordina per Sharpe desc, poi PnL desc, poi MaxDD desc (più vicino a 0 è meglio)
+        df["_sh"] = df["Sharpe"].fillna(0)
+        df["_pnl"] = df["net_pnl_total"].fillna(-1e18)
+        df["_dd"] = df["MaxDD"].fillna(-1e18)
+        best = df.sort_values(["_sh", "_pnl", "_dd"], ascending=False, kind="stable").iloc[0].to_dict()
+    best = {k: (v.item() if hasattr(v, "item") else v) for k, v in best.items() if k not in ("_sh", "_pnl", "_dd")}
     with open(BESTJSON, "w") as f:
         json.dump(best, f, indent=2)
 
@@ -112,7 +276,8 @@ def main():
     print(f"Sharpe: {best['Sharpe']:.3f} | PnL: {best['net_pnl_total']:.0f} | MaxDD: {best['MaxDD']:.3f}")
     print(f"\n[WROTE] {RESULTS}")
     print(f"[WROTE] {BESTJSON}")
+    if front is not None and not front.empty:
+        print(f"[WROTE] {PARETO}")
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — selezione multi-obiettivo (fronte di Pareto) sui risultati di griglia
+
+Invece di un solo score (Sharpe con tie-break, o PnL + 1e-6 * Sharpe)
+tiene tutte le combinazioni non dominate su:
+  net_pnl_total, Sharpe, MaxDD (<= 0, più vicino a 0 è meglio), trades, hit_rate
+tutti da massimizzare (--objectives per cambiare insieme o verso, es. trades:min).
+Una combinazione è dominata se un'altra è >= su tutti gli obiettivi e > su
+almeno uno; NaN conta come il valore peggiore.
+
+Fronte (pareto_mask): ordinamento lessicografico decrescente, O(n log n),
+dopo il quale una riga può essere dominata solo da righe precedenti;
+  - 2 obiettivi: scansione col massimo cumulato, O(n log n) esatto;
+  - 3+ obiettivi: divide et impera (Kung-Luccio-Preparata) sulle metà
+    dell'ordine, fusione vettoriale "metà sotto vs fronte della metà sopra";
+    il costo segue la dimensione del fronte (piccolo sui risultati di
+    griglia: 10^6 candidati in pochi secondi).
+
+Scelta del preset: sul fronte di ogni pair, obiettivi normalizzati min-max
+in [0, 1] e score = media pesata con --weights (es. net_pnl_total=2,Sharpe=1);
+a parità vince la prima riga dell'input.
+
+Input:
+  reports/wf_cube.npz      (walkforward_backtest.py --cube): per pair e
+                           combinazione, metriche --stage (test|train)
+                           aggregate sui fold: PnL e trades sommati, Sharpe
+                           e hit rate medi, MaxDD peggiore, segno prevalente.
+                           test: Sharpe/MaxDD MTM giornalieri per fold, come
+                           wf_metrics.csv; train: solo i proxy per trade della
+                           griglia, Sharpe_trade/MaxDD_trade (obiettivi di
+                           default con quei nomi, anche nei preset)
+  CSV con le colonne obiettivo (es. reports/opt_results.csv); colonna pair opzionale
+Output:
+  reports/pareto_front.csv    (tutto il fronte, pareto_score e pareto_rank per pair)
+  reports/pareto_presets.json (rank 1 per pair, formato presets.json: mc_bootstrap --presets)
+
+Uso:
+  python scripts/pareto_select.py --input reports/wf_cube.npz --weights net_pnl_total=2,Sharpe=1,MaxDD=1
+"""
+from __future__ import annotations
+import argparse, json, os, sys, datetime as dt
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+
+from result_cube import ResultCube
+
+OBJECTIVES = ("net_pnl_total", "Sharpe", "MaxDD", "trades", "hit_rate")
+TRADE_OBJECTIVES = ("net_pnl_total", "Sharpe_trade", "MaxDD_trade", "trades", "hit_rate")   # cubo, --stage train
+LEAF = 128            # righe sotto cui il fronte è calcolato a forza bruta
+CHUNK = 1 << 22       # elementi massimi per confronto vettoriale (memoria)
+
+
+def parse_objectives(s: Optional[str], default=OBJECTIVES) -> Dict[str, int]:
+    """'net_pnl_total,Sharpe,trades:min' -> {nome: +1 (max) | -1 (min)}."""
+    out = {}
+    for tok in (s.split(",") if s else default):
+        name, _, how = tok.strip().partition(":")
+        if how not in ("", "max", "min"):
+            raise ValueError(f"verso sconosciuto per {name}: {how} (max|min)")
+        out[name] = -1 if how == "min" else 1
+    return out
+
+
+def parse_weights(s: Optional[str], objectives: Dict[str, int]) -> np.ndarray:
+    """'net_pnl_total=2,Sharpe=1' -> pesi nell'ordine degli obiettivi (non indicati: 0; senza --weights: tutti 1)."""
+    if not s:
+        return np.ones(len(objectives))
+    w = dict.fromkeys(objectives, 0.0)
+    for tok in s.split(","):
+        name, _, v = tok.strip().partition("=")
+        if name not in w:
+            raise ValueError(f"peso per un obiettivo non selezionato: {name} (obiettivi: {list(objectives)})")
+        w[name] = float(v)
+    out = np.array(list(w.values()))
+    if np.any(out < 0) or out.sum() <= 0:
+        raise ValueError("--weights: pesi >= 0 e non tutti nulli")
+    return out
+
+
+def _dominated(A: np.ndarray, B: np.ndarray) -> np.ndarray:
+    """Per ogni riga di B: esiste una riga di A >= ovunque e > da qualche parte?"""
+    out = np.zeros(len(B), dtype=bool)
+    if len(A) == 0 or len(B) == 0:
+        return out
+    # matrici (righe B x righe A) colonna per colonna: niente riduzioni sull'asse corto degli obiettivi
+    step = max(1, CHUNK // len(A))
+    for i in range(0, len(B), step):
+        b = B[i:i + step]
+        ge = b[:, 0, None] <= A[None, :, 0]
+        gt = b[:, 0, None] < A[None, :, 0]
+        for k in range(1, A.shape[1]):
+            ge &= b[:, k, None] <= A[None, :, k]
+            gt |= b[:, k, None] < A[None, :, k]
+        out[i:i + step] = (ge & gt).any(axis=1)
+    return out
+
+
+def _front_sorted(G: np.ndarray) -> np.ndarray:
+    """Posizioni non dominate di G, righe già in ordine lessicografico decrescente."""
+    n = len(G)
+    if n <= LEAF:
+        return np.flatnonzero(~_dominated(G, G))
+    h = n // 2
+    top = _front_sorted(G[:h])
+    bot = h + _front_sorted(G[h:])
+    # una riga può essere dominata solo da righe precedenti: basta il fronte di sopra
+    return np.concatenate([top, bot[~_dominated(G[top], G[bot])]])
+
+
+def pareto_mask(F: np.ndarray) -> np.ndarray:
+    """
+    F (n x d), obiettivi da massimizzare. True per le righe non dominate
+    (righe identiche non si dominano: restano entrambe sul fronte).
+    """
+    F = np.asarray(F, dtype=np.float64)
+    n, d = F.shape
+    mask = np.zeros(n, dtype=bool)
+    if n == 0:
+        return mask
+    G = np.where(np.isnan(F), -np.inf, F)
+    order = np.lexsort(-G[:, ::-1].T)        # lessicografico decrescente (prima colonna primaria)
+    G = G[order]
+    # righe identiche (adiacenti dopo l'ordinamento) valutate una volta sola
+    new = np.r_[True, (G[1:] != G[:-1]).any(axis=1)]
+    grp = np.cumsum(new) - 1
+    G = G[new]
+    if d == 1:
+        mask[order] = (G[:, 0] == G[0, 0])[grp]
+        return mask
+    if d == 2:
+        x, y = G[:, 0], G[:, 1]
+        # dominata da una riga con x maggiore e y >=, o con x uguale e y maggiore
+        # (la prima del suo gruppo di x, che ha la y massima)
+        start = np.r_[True, x[1:] != x[:-1]]
+        first = np.flatnonzero(start)[np.cumsum(start) - 1]
+        best_before = np.r_[-np.inf, np.maximum.accumulate(y)[:-1]][first]
+        mask[order] = ~(((first > 0) & (best_before >= y)) | (y[first] > y))[grp]
+        return mask
+    on = np.zeros(len(G), dtype=bool)
+    on[_front_sorted(G)] = True
+    mask[order] = on[grp]
+    return mask
+
+
+def front_scores(F: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Media pesata degli obiettivi normalizzati min-max sulle righe date (colonne costanti: 0)."""
+    G = np.where(np.isnan(F), -np.inf, F)
+    G = np.where(np.isinf(G), np.nan, G)
+    lo, hi = np.nanmin(G, axis=0), np.nanmax(G, axis=0)
+    span = np.where(hi > lo, hi - lo, np.inf)
+    N = np.nan_to_num((G - lo) / span, nan=0.0)
+    return N @ weights / weights.sum()
+
+
+def pareto_select(df: pd.DataFrame, objectives: Dict[str, int], weights: np.ndarray,
+                  by: Optional[str] = "pair", min_trades: int = 0) -> pd.DataFrame:
+    """
+    Fronte di Pareto di df (per gruppo `by`, se la colonna c'è) con
+    pareto_score e pareto_rank (1 = preset scelto). min_trades: scarta prima
+    le combinazioni con meno trade (senza trade MaxDD = 0 sarebbe "ottimo").
+    """
+    missing = [c for c in objectives if c not in df.columns]
+    if missing:
+        sys.exit(f"Colonne obiettivo mancanti: {missing}")
+    if min_trades and "trades" in df.columns:
+        df = df[df["trades"] >= min_trades]
+    sgn = np.array(list(objectives.values()), dtype=np.float64)
+    groups = df.groupby(by, sort=False) if by and by in df.columns else [(None, df)]
+    out = []
+    for _, g in groups:
+        F = g[list(objectives)].to_numpy(dtype=np.float64) * sgn
+        on = pareto_mask(F)
+        front = g[on].copy()
+        front["pareto_score"] = front_scores(F[on], weights)
+        front["pareto_rank"] = front["pareto_score"].rank(ascending=False, method="first").astype(int)
+        out.append(front.sort_values("pareto_rank"))
+    return pd.concat(out, ignore_index=True) if out else df.iloc[:0]
+
+
+def cube_frame(cube: ResultCube, stage: str = "test") -> pd.DataFrame:
+    """
+    Una riga per pair e combinazione: metriche di `stage` aggregate sui fold
+    (train: Sharpe_trade/MaxDD_trade, i proxy per trade della griglia).
+    """
+    m = lambda name: cube.sel(metric=f"{stage}_{name}")
+    sharpe, maxdd = ("Sharpe", "MaxDD") if stage == "test" else ("Sharpe_trade", "MaxDD_trade")
+    agg = dict(net_pnl_total=m("net_pnl_total").reduce(np.nansum, "fold"),
+               **{sharpe: m(sharpe).reduce(np.nanmean, "fold"),
+                  maxdd: m(maxdd).reduce(np.nanmin, "fold")},
+               trades=m("trades").reduce(np.nansum, "fold"),
+               hit_rate=m("hit_rate").reduce(np.nanmean, "fold"),
+               folds=ResultCube(np.isfinite(m("trades").data).astype(np.float64),
+                                m("trades").axes).reduce(np.sum, "fold"),
+               sign=cube.sel(metric="sign").reduce(np.nanmean, "fold"))
+    folds = agg["folds"].data
+    df = agg["folds"].to_frame(dropna=False).drop(columns="value")
+    for k, c in agg.items():
+        df[k] = np.where(folds > 0, c.data, np.nan).ravel()
+    df = df[df["folds"] > 0].reset_index(drop=True)
+    df[["folds", "trades"]] = df[["folds", "trades"]].astype(int)
+    df["sign"] = np.where(df["sign"] >= 0, 1, -1)   # segno prevalente sui fold
+    return df
+
+
+def preset_rows(front: pd.DataFrame, objectives: Dict[str, int], extra: Dict) -> List[Dict]:
+    """Rank 1 di ogni pair nel formato di presets.json (params + metriche)."""
+    skip = set(objectives) | set(OBJECTIVES) | set(TRADE_OBJECTIVES) | {"pareto_score", "pareto_rank", "folds"}
+    out = []
+    for _, r in front[front["pareto_rank"] == 1].iterrows():
+        r = {k: (v.item() if hasattr(v, "item") else v) for k, v in r.items()}
+        params = {("latency" if k == "latency_days" else k): v for k, v in r.items() if k not in skip}
+        params.update({k: v for k, v in extra.items() if k not in params})
+        out.append({"pair": r.get("pair"), "created": dt.datetime.now().isoformat(timespec="seconds"),
+                    "pareto_score": r["pareto_score"], **{k: r[k] for k in objectives},
+                    **({"folds_active": r["folds"]} if "folds" in r else {}), "params": params})
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser("ArbiSense Pareto selection")
+    ap.add_argument("--input", default="reports/wf_cube.npz", help="wf_cube.npz o CSV con le colonne obiettivo")
+    ap.add_argument("--stage", choices=["test", "train"], default="test", help="metriche del cubo da usare")
+    ap.add_argument("--objectives", default=None,
+                    help=f"default {','.join(OBJECTIVES)}; cubo con --stage train: {','.join(TRADE_OBJECTIVES)} "
+                         "(nome[:max|min])")
+    ap.add_argument("--weights", default=None, help="pesi per la scelta sul fronte (es. net_pnl_total=2,Sharpe=1)")
+    ap.add_argument("--min-trades", type=int, default=1, help="scarta combinazioni con meno trade")
+    ap.add_argument("--outdir", default="reports")
+    args = ap.parse_args()
+
+    cube_train = args.input.endswith(".npz") and args.stage == "train"
+    objectives = parse_objectives(args.objectives, TRADE_OBJECTIVES if cube_train else OBJECTIVES)
+    try:
+        weights = parse_weights(args.weights, objectives)
+    except ValueError as e:
+        sys.exit(str(e))
+    extra = {}
+    if args.input.endswith(".npz"):
+        cube = ResultCube.load(args.input)
+        df = cube_frame(cube, args.stage)
+        run = cube.meta.get("args", {})
+        extra = {k: run[k] for k in ("side", "notional") if k in run}
+    else:
+        df = pd.read_csv(args.input)
+    print(f"[INFO] {len(df)} combinazioni da {args.input}")
+
+    front = pareto_select(df, objectives, weights, min_trades=args.min_trades)
+    if front.empty:
+        sys.exit("Nessuna combinazione con trade sufficienti")
+    presets = preset_rows(front, objectives, extra)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    out_front = os.path.join(args.outdir, "pareto_front.csv")
+    out_pres = os.path.join(args.outdir, "pareto_presets.json")
+    front.to_csv(out_front, index=False)
+    with open(out_pres, "w", encoding="utf-8") as f:
+        json.dump(presets, f, ensure_ascii=False, indent=2)
+
+    for p in presets:
+        q = p["params"]
+        print(f"[OK] {p['pair'] or '-'}: zE={q.get('z_enter')} zX={q.get('z_exit')} zS={q.get('z_stop')} "
+              f"H={q.get('max_hold')} L={q.get('latency')}  score={p['pareto_score']:.3f}  "
+              + "  ".join(f"{k}={p[k]:.4g}" for k in objectives))
+    print(f"[INFO] fronte: {len(front)}/{len(df)} combinazioni non dominate")
+    print(f"[WROTE] {out_front}\n[WROTE] {out_pres}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — backtest di portafoglio multi-pair (matrice date x pair)
+
+Le pair non vengono simulate una alla volta: gli spread (wide, una colonna
+per pair, come spread_report_all_pairs_wide.csv; oppure long, pivotato)
+diventano una matrice float64 (date x pair) e tutte le pair avanzano
+insieme barra per barra, con lo stato (in posizione, direzione, entry)
+vettoriale sull'asse delle pair.
+
+Regole di entry/exit come backtest_signals (z rolling, latency, soglie,
+max_hold, exit anche sulla barra di entry). In più, vincoli condivisi:
+  --budget        notional complessivo: al più budget // notional posizioni
+  --max-open      posizioni aperte contemporaneamente
+  --max-per-day   entry al giorno su tutte le pair (MAX_PER_DAY di postfilter_risk)
+  --max-per-pair  entry per pair sul periodo (MAX_PER_PAIR di postfilter_risk; 0 = nessun limite)
+A parità di giorno la priorità va alle pair nell'ordine delle colonne
+(ordinate per nome, come il file di postfilter_risk); i segnali scartati
+dai vincoli vengono contati per motivo. Senza vincoli i trade coincidono
+con quelli di backtest_signals pair per pair. Barre intraday: --z-window e
+--max-hold anche come durate (es. 120min, 2h), come backtest_signals.
+
+Output:
+  reports/portfolio_trades.csv
+  reports/portfolio_daily.csv     date, pnl, equity, open_positions, gross_notional
+  reports/portfolio_metrics.csv   metriche MTM giornaliere del portafoglio + segnali scartati
+
+Esempio:
+  python scripts/portfolio_backtest.py --input data_sample/spread_report_all_pairs_wide.csv \
+      --side both --z-enter 2 --z-exit 0.5 --max-open 2 --budget 500000
+"""
+from __future__ import annotations
+import argparse, math, os, sys
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+from bt_kernel import (DAY_NS, DIR_SHORT, DIR_LONG, REASON_MEAN_REVERT, REASON_STOP, REASON_TIMEOUT,
+                       DIRECTION_NAMES, REASON_NAMES, shift_array, mtm_metrics)
+from backtest_signals import infer_date_col, pick_spread_col, zscore
+from bar_clock import parse_duration, is_time, is_intraday
+from feature_cache import rolling_features
+from trade_records import decode_when
+
+
+def parse_args():
+    ap = argparse.ArgumentParser("ArbiSense Portfolio Backtest")
+    ap.add_argument("--input", default="data_sample/spread_report_all_pairs_wide.csv",
+                    help="CSV wide (date + una colonna per pair) o long (pair, date, spread_raw|spread|spread_pct)")
+    ap.add_argument("--pairs", default=None, help="Lista coppie separate da virgola")
+    ap.add_argument("--side", choices=["short", "long", "both"], default="short")
+    ap.add_argument("--z-enter", type=float, default=3.0)
+    ap.add_argument("--z-exit", type=float, default=2.0)
+    ap.add_argument("--z-stop", type=float, default=99.0)
+    ap.add_argument("--latency-days", type=int, default=0)
+    ap.add_argument("--max-hold", type=parse_duration, default=5, help="barre o durata (es. 2h)")
+    ap.add_argument("--fee-bps", type=float, default=0.0)
+    ap.add_argument("--slippage-bps", type=float, default=0.0)
+    ap.add_argument("--notional", type=float, default=250000.0, help="notional per posizione")
+    ap.add_argument("--budget", type=float, default=None,
+                    help="notional complessivo del portafoglio (default: nessun limite)")
+    ap.add_argument("--max-open", type=int, default=0, help="posizioni aperte max (0 = nessun limite)")
+    ap.add_argument("--max-per-day", type=int, default=10, help="entry al giorno max (0 = nessun limite)")
+    ap.add_argument("--max-per-pair", type=int, default=6, help="entry per pair max sul periodo (0 = nessun limite)")
+    ap.add_argument("--start", default=None, help="YYYY-MM-DD inclusiva")
+    ap.add_argument("--end", default=None, help="YYYY-MM-DD inclusiva")
+    ap.add_argument("--z-window", type=parse_duration, default=60, help="barre o durata (es. 120min)")
+    ap.add_argument("--spread-scale", default="auto", help="auto oppure numero (fattore)")
+    ap.add_argument("--outdir", default="reports")
+    return ap.parse_args()
+
+
+# ------------------ matrice date x pair ------------------
+
+@dataclass
+class PanelData:
+    pairs: List[str]
+    d_ns: np.ndarray     # int64 (T,) date UTC
+    s: np.ndarray        # float64 (T x P) spread (NaN dove la pair non quota)
+    z: np.ndarray        # float64 (T x P) z-score laggato
+    px: np.ndarray       # float64 (T x P) prezzo di esecuzione (spread laggato o pct)
+    mult: np.ndarray     # float64 (P,) PnL per unità di spread (scala * notional)
+    bar: np.ndarray      # int64 (T x P) indice della barra nella serie della pair (max_hold, days_held)
+    intraday: bool = False
+
+
+def load_wide(args) -> pd.DataFrame:
+    """Input -> DataFrame wide (indice date UTC ordinato, una colonna per pair)."""
+    df = pd.read_csv(args.input)
+    date_col = infer_date_col(df)
+    df[date_col] = pd.to_datetime(df[date_col], utc=True, errors="coerce")
+    df = df.dropna(subset=[date_col])
+    if "pair" in df.columns:
+        spread_col, _ = pick_spread_col(df)
+        wide = df.pivot_table(index=date_col, columns="pair", values=spread_col, aggfunc="last")
+        wide.attrs["is_pct"] = spread_col == "spread_pct"
+    else:
+        wide = df.set_index(date_col).apply(pd.to_numeric, errors="coerce")
+        wide = wide[~wide.index.duplicated(keep="last")]
+        wide.attrs["is_pct"] = False
+    wide = wide.sort_index()
+    if args.pairs:
+        keep = [p.strip() for p in str(args.pairs).split(",") if p.strip()]
+        missing = [p for p in keep if p not in wide.columns]
+        if missing:
+            sys.exit(f"Coppie non presenti nell'input: {','.join(missing)}")
+        wide = wide[keep]
+    wide = wide[sorted(wide.columns)]
+    if args.start:
+        wide = wide[wide.index >= pd.to_datetime(args.start, utc=True)]
+    if args.end:
+        wide = wide[wide.index <= pd.to_datetime(args.end, utc=True)]
+    return wide.dropna(how="all")
+
+
+def prepare_panel(wide: pd.DataFrame, args) -> PanelData:
+    """
+    z-score, scala e latency per colonna sulle sole righe in cui la pair
+    quota (come prepare_pair di backtest_signals), poi di nuovo sulla
+    griglia comune delle date.
+    """
+    is_pct = bool(wide.attrs.get("is_pct", False))
+    T, P = wide.shape
+    s = wide.to_numpy(np.float64)
+    d_ns = pd.DatetimeIndex(wide.index).as_unit("ns").asi8
+    z = np.full((T, P), np.nan)
+    px = np.full((T, P), np.nan)
+    mult = np.zeros(P)
+    for j in range(P):
+        rows = np.flatnonzero(~np.isnan(s[:, j]))
+        sj = s[rows, j]
+        if args.spread_scale == "auto":
+            lvl = float(np.median(np.abs(sj))) if sj.size else float("nan")
+            scale = 1.0 if is_pct else (lvl if lvl and not math.isnan(lvl) else 1.0) * 1e-4
+        else:
+            scale = float(args.spread_scale)
+        if is_time(args.z_window):
+            zj = rolling_features(sj, args.z_window, ts=d_ns[rows]).z
+        else:
+            zj = zscore(pd.Series(sj), args.z_window).to_numpy()
+        z[rows, j] = shift_array(zj, args.latency_days)
+        px[rows, j] = sj if is_pct else shift_array(sj, args.latency_days)
+        mult[j] = args.notional if is_pct else scale * args.notional
+    return PanelData(pairs=[str(c) for c in wide.columns], d_ns=d_ns,
+                     s=s, z=z, px=px, mult=mult,
+                     bar=np.cumsum(~np.isnan(s), axis=0) - 1, intraday=is_intraday(d_ns))
+
+
+# ------------------ simulazione ------------------
+
+@dataclass
+class PortfolioTrades:
+    """Trade compatti del portafoglio: un elemento per trade chiuso."""
+    pair_j: np.ndarray     # int64, colonna della pair
+    entry_i: np.ndarray    # int64
+    exit_i: np.ndarray     # int64
+    direction: np.ndarray  # int8
+    reason: np.ndarray     # int8
+
+    def __len__(self) -> int:
+        return int(self.entry_i.shape[0])
+
+
+def run_portfolio(z: np.ndarray, d_ns: np.ndarray, *, side: str, z_enter: float, z_exit: float,
+                  z_stop: float, max_hold: int, max_open: int = 0, max_per_day: int = 0,
+                  max_per_pair: int = 0, bar: Optional[np.ndarray] = None) -> Tuple[PortfolioTrades, Dict[str, int]]:
+    """
+    Macchina a stati di run_kernel (deferred=False) su tutte le colonne di z
+    (T x P) insieme, con i vincoli di portafoglio sulle entry. max_open
+    include già il limite da budget; `bar` (T x P, default l'indice di riga)
+    numera le barre di ogni pair per max_hold (max_hold a tempo: bar = timestamp
+    in ns e max_hold in ns). Ritorna (trade chiusi, segnali scartati
+    per motivo); le posizioni aperte a fine serie sono scartate.
+    """
+    T, P = z.shape
+    want_short = side in ("short", "both")
+    want_long = side in ("long", "both")
+    if not (want_short or want_long):
+        raise ValueError(f"Side sconosciuto: {side}")
+    hold = int(max_hold)
+    max_open = int(max_open) if max_open and max_open > 0 else P
+    per_day = int(max_per_day) if max_per_day and max_per_day > 0 else P
+    per_pair = int(max_per_pair) if max_per_pair and max_per_pair > 0 else T + 1
+
+    in_pos = np.zeros(P, dtype=bool)
+    dirn = np.zeros(P, dtype=np.int8)
+    entry_i = np.zeros(P, dtype=np.int64)
+    entry_bar = np.zeros(P, dtype=np.int64)
+    if bar is None:
+        bar = np.broadcast_to(np.arange(T, dtype=np.int64)[:, None], (T, P))
+    n_pair = np.zeros(P, dtype=np.int64)
+    blocked = dict.fromkeys(("open", "day", "pair"), 0)
+    out: List[Tuple[np.ndarray, ...]] = []
+    day = d_ns // DAY_NS
+    cur_day, day_used = None, 0
+
+    def exits(zi, i, mask):
+        short = dirn < 0
+        revert = np.where(short, zi <= z_exit, zi >= -z_exit)
+        stop = np.where(short, zi >= z_stop, zi <= -z_stop)
+        ex = mask & (revert | stop | ((bar[i] - entry_bar) >= hold))
+        idx = np.flatnonzero(ex)
+        if idx.shape[0]:
+            r = np.where(revert[idx], REASON_MEAN_REVERT, np.where(stop[idx], REASON_STOP, REASON_TIMEOUT))
+            out.append((idx, entry_i[idx].copy(), np.full(idx.shape[0], i), dirn[idx].copy(), r))
+            in_pos[idx] = False
+        return ex
+
+    for i in range(T):
+        zi = z[i]
+        ok = zi == zi
+        if day[i] != cur_day:
+            cur_day, day_used = day[i], 0
+
+        closed = exits(zi, i, in_pos & ok)
+
+        sig_s = (zi >= z_enter) if want_short else np.zeros(P, dtype=bool)
+        sig_l = (~sig_s & (zi <= -z_enter)) if want_long else np.zeros(P, dtype=bool)
+        cand = np.flatnonzero(~in_pos & ~closed & (sig_s | sig_l))
+        if cand.shape[0] == 0:
+            continue
+        # vincoli nell'ordine di postfilter_risk: prima per pair, poi per giorno; poi capienza
+        ok_pair = n_pair[cand] < per_pair
+        blocked["pair"] += int((~ok_pair).sum())
+        cand = cand[ok_pair]
+        n_day = min(cand.shape[0], max(per_day - day_used, 0))
+        blocked["day"] += cand.shape[0] - n_day
+        cand = cand[:n_day]
+        n_new = min(cand.shape[0], max(max_open - int(in_pos.sum()), 0))
+        blocked["open"] += cand.shape[0] - n_new
+        opened = cand[:n_new]
+        if opened.shape[0] == 0:
+            continue
+        in_pos[opened] = True
+        dirn[opened] = np.where(sig_s[opened], DIR_SHORT, DIR_LONG)
+        entry_i[opened] = i
+        entry_bar[opened] = bar[i, opened]
+        n_pair[opened] += 1
+        day_used += opened.shape[0]
+        # come run_kernel: l'exit può cadere sulla barra di entry
+        mask = np.zeros(P, dtype=bool)
+        mask[opened] = True
+        exits(zi, i, mask)
+
+    if out:
+        cols = [np.concatenate(c) for c in zip(*out)]
+    else:
+        cols = [np.empty(0, dtype=np.int64)] * 5
+    trades = PortfolioTrades(pair_j=cols[0].astype(np.int64), entry_i=cols[1].astype(np.int64),
+                             exit_i=cols[2].astype(np.int64), direction=cols[3].astype(np.int8),
+                             reason=cols[4].astype(np.int8))
+    return trades, blocked
+
+
+def panel_mtm(pt: PortfolioTrades, px: np.ndarray, mult: np.ndarray, cost: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    PnL mark-to-market per barra del portafoglio (come bt_kernel.mtm_pnl,
+    su tutte le colonne insieme) e numero di posizioni aperte a fine barra.
+    """
+    T, P = px.shape
+    pos = np.zeros((T + 1, P))
+    d = pt.direction.astype(np.float64)
+    np.add.at(pos, (pt.entry_i, pt.pair_j), d)
+    np.add.at(pos, (pt.exit_i, pt.pair_j), -d)
+    pos = np.cumsum(pos[:T], axis=0)
+    p = pd.DataFrame(px).ffill().to_numpy()
+    pnl = np.zeros(T)
+    if T > 1:
+        step = np.nan_to_num(pos[:-1] * (p[1:] - p[:-1]) * mult[None, :])
+        pnl[1:] = step.sum(axis=1)
+    np.add.at(pnl, pt.exit_i, -cost)
+    return pnl, (pos != 0).sum(axis=1)
+
+
+# ------------------ main ------------------
+
+def main():
+    args = parse_args()
+    os.makedirs(args.outdir, exist_ok=True)
+
+    wide = load_wide(args)
+    if wide.empty:
+        print("[INFO] Nessuna riga"); sys.exit(0)
+    panel = prepare_panel(wide, args)
+
+    max_open = args.max_open if args.max_open > 0 else 0
+    budget_slots = int(args.budget // args.notional) if args.budget else 0
+    limit = min([x for x in (max_open, budget_slots) if x > 0], default=0)
+    if args.budget and budget_slots == 0:
+        sys.exit("budget < notional: nessuna posizione possibile")
+
+    timed = is_time(args.max_hold)
+    clock = np.broadcast_to(panel.d_ns[:, None], panel.bar.shape) if timed else panel.bar
+    pt, blocked = run_portfolio(panel.z, panel.d_ns, side=args.side, z_enter=args.z_enter,
+                                z_exit=args.z_exit, z_stop=args.z_stop,
+                                max_hold=args.max_hold.value if timed else args.max_hold,
+                                max_open=limit, max_per_day=args.max_per_day,
+                                max_per_pair=args.max_per_pair, bar=clock)
+    # scartati per capienza: attribuiti al budget se è il vincolo più stretto
+    by_budget = budget_slots > 0 and (max_open == 0 or budget_slots < max_open)
+    counts = {"blocked_open": 0 if by_budget else blocked["open"],
+              "blocked_budget": blocked["open"] if by_budget else 0,
+              "blocked_day": blocked["day"], "blocked_pair": blocked["pair"]}
+
+    cost = (args.fee_bps + args.slippage_bps) * 1e-4 * args.notional
+    order = np.lexsort((pt.pair_j, pt.entry_i))
+    j, ei, xi = pt.pair_j[order], pt.entry_i[order], pt.exit_i[order]
+    dirn = pt.direction[order]
+    entry_px, exit_px = panel.px[ei, j], panel.px[xi, j]
+    gross = dirn * (exit_px - entry_px) * panel.mult[j]
+    net = gross - cost
+    when = "timestamp" if panel.intraday else "date"
+    trades = pd.DataFrame({
+        "pair": np.asarray(panel.pairs, dtype=object)[j],
+        "entry_date": decode_when(panel.d_ns[ei], when),
+        "exit_date": decode_when(panel.d_ns[xi], when),
+        "entry_spread_eff": entry_px,
+        "exit_spread_eff": exit_px,
+        "direction": DIRECTION_NAMES[dirn.astype(np.int64) + 1],
+        "days_held": ((panel.d_ns[xi] - panel.d_ns[ei]) / DAY_NS) if panel.intraday
+                     else panel.bar[xi, j] - panel.bar[ei, j],
+        "gross_pnl": gross,
+        "cost": float(cost),
+        "net_pnl": net,
+        "entry_z": panel.z[ei, j],
+        "exit_z": panel.z[xi, j],
+        "reason_exit": REASON_NAMES[pt.reason[order].astype(np.int64)],
+        "notional": float(args.notional),
+        "cost_legs": 1,
+    })
+
+    pnl, n_open = panel_mtm(pt, panel.px, panel.mult, cost)
+    day = panel.d_ns // DAY_NS
+    starts = np.flatnonzero(np.r_[True, day[1:] != day[:-1]])
+    days, day_pnl = day[starts], np.add.reduceat(pnl, starts)
+    day_open = n_open[np.r_[starts[1:], len(day)] - 1]
+    daily = pd.DataFrame({
+        "date": np.datetime_as_string(days.astype("datetime64[D]")),
+        "pnl": day_pnl,
+        "equity": np.cumsum(day_pnl),
+        "open_positions": day_open,
+        "gross_notional": day_open * args.notional,
+    })
+
+    capital = args.budget or (limit or len(panel.pairs)) * args.notional
+    mtm = mtm_metrics(day_pnl, days, capital=capital)
+    metrics = pd.DataFrame([{
+        "pairs": len(panel.pairs), "start": daily["date"].iloc[0], "end": daily["date"].iloc[-1],
+        "capital": capital, "trades": len(trades), "net_pnl_total": float(net.sum()),
+        "CAGR": mtm["CAGR"], "vol_annualized": mtm["vol_annualized"],
+        "Sharpe": mtm["Sharpe"], "MaxDD": mtm["MaxDD"],
+        "hit_rate": float((net > 0).mean()) if len(net) else 0.0,
+        "max_open_seen": int(n_open.max()) if len(n_open) else 0,
+        **counts,
+    }])
+
+    trades_path = os.path.join(args.outdir, "portfolio_trades.csv")
+    daily_path = os.path.join(args.outdir, "portfolio_daily.csv")
+    metrics_path = os.path.join(args.outdir, "portfolio_metrics.csv")
+    trades.to_csv(trades_path, index=False)
+    daily.to_csv(daily_path, index=False)
+    metrics.to_csv(metrics_path, index=False)
+    print(f"[OK] {len(panel.pairs)} pair x {len(panel.d_ns)} barre: {len(trades)} trade, "
+          f"scartati {sum(counts.values())} ({', '.join(f'{k}={v}' for k, v in counts.items() if v)})")
+    print(f"[WROTE] {metrics_path}\n[WROTE] {trades_path}\n[WROTE] {daily_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@ import sys, os, argparse, math
 from pathlib import Path
 import numpy as np
 import pandas as pd
+from feature_cache import FEATURES
 from statsmodels.tsa.stattools import adfuller
 
 BASE_DIR = Path(__file__).parent.parent
@@ -82,9 +83,7 @@ def main():
         g = g.copy()
         s = g["spread_val"]
         # zscore rolling (per completezza/consistenza con resto pipeline)
-        m = s.rolling(win, min_periods=mp).mean()
-        v = s.rolling(win, min_periods=mp).std(ddof=0).replace(0, np.nan)
-        z = (s - m) / v
+        z = pd.Series(FEATURES.get(pair, s, win, mp, zero_std_nan=True).z, index=s.index)
         samples = int(s.notna().sum())
 
         # metriche
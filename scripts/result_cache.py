@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — cache persistente dei risultati del backtest (SQLite)
+
+Ogni risultato (fold walk-forward, combinazione dell'optimizer) è salvato
+sotto una chiave sha256 di:
+  - tipo di task (es. "wf_v1", "wf_v2", "opt")
+  - ENGINE_VERSION di bt_kernel
+  - impronta dei dati che il task legge (byte degli array: slice di spread
+    e timestamp) e dei parametri/contesto (dict JSON ordinato)
+Dati o parametri diversi -> chiave diversa: nessuna invalidazione esplicita,
+le entry vecchie escono per LRU.
+
+  cache = ResultCache("reports/bt_cache.sqlite")
+  key = make_key("wf_v1", arrays=[s[a:b]], params={...})
+  for res in iter_cached(fn, tasks, keys, cache, workers=..., arrays=..., state=...):
+      ...
+
+iter_cached calcola (via wf_parallel) solo i task senza entry e restituisce
+i risultati nell'ordine dei task: l'output coincide con il run senza cache.
+Valori serializzati con pickle (DataFrame dei trade inclusi). Budget su
+disco con eviction LRU: default 512 MB, configurabile con
+ARBISENSE_RESULT_CACHE_MB.
+"""
+from __future__ import annotations
+import hashlib, json, os, pickle, sqlite3, time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+import numpy as np
+
+from bt_kernel import ENGINE_VERSION
+from wf_parallel import iter_tasks
+
+DEFAULT_PATH = Path(__file__).parent.parent / "reports" / "bt_cache.sqlite"
+
+MISS = object()
+
+
+def make_key(kind: str, *, arrays: Sequence[np.ndarray] = (), params: Optional[Dict[str, Any]] = None) -> str:
+    """Chiave sha256 di (tipo, versione engine, array, parametri)."""
+    h = hashlib.sha256()
+    h.update(f"{kind}|{ENGINE_VERSION}|".encode())
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(f"{a.dtype.str}{a.shape}".encode())
+        h.update(a.tobytes())
+    h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Key-value su SQLite con budget in byte ed eviction LRU."""
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes: Optional[int] = None):
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get("ARBISENSE_RESULT_CACHE_MB", "512")) * 2**20)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_bytes)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "key TEXT PRIMARY KEY, kind TEXT, value BLOB, nbytes INTEGER, used REAL)")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, default: Any = MISS) -> Any:
+        row = self.db.execute("SELECT value FROM results WHERE key=?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.db.execute("UPDATE results SET used=? WHERE key=?", (time.time(), key))
+        return pickle.loads(row[0])
+
+    def put(self, key: str, value: Any, kind: str = ""):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?)",
+                            (key, kind, blob, len(blob), time.time()))
+            self._evict(keep=key)
+
+    def _evict(self, keep: str):
+        total = self.db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        drop = []
+        for k, nb in self.db.execute("SELECT key, nbytes FROM results ORDER BY used ASC"):
+            if total <= self.max_bytes:
+                break
+            if k == keep:
+                continue
+            drop.append((k,))
+            total -= nb
+        self.db.executemany("DELETE FROM results WHERE key=?", drop)
+        self.evictions += len(drop)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM results").fetchone()[0])
+
+    def __len__(self) -> int:
+        return int(self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0])
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def summary(self) -> str:
+        return (f"cache {self.path}: hit {self.hits}, miss {self.misses}, evict {self.evictions}, "
+                f"{len(self)} entry / {self.nbytes / 2**20:.1f} MB")
+
+
+def iter_cached(fn: Callable[[Any], Any], tasks: Iterable[Any], keys: Sequence[str],
+                cache: Optional[ResultCache], *, kind: str = "",
+                cacheable: Callable[[Any], bool] = lambda r: True, **run_kw) -> Iterator[Any]:
+    """
+    Come wf_parallel.iter_tasks (risultati nell'ordine dei task), ma i task
+    con una entry in cache non vengono ricalcolati; i nuovi risultati per cui
+    cacheable(res) è vero vengono salvati. cache=None: iter_tasks puro.
+    """
+    tasks = list(tasks)
+    if cache is None:
+        yield from iter_tasks(fn, tasks, **run_kw)
+        return
+    found: List[Any] = [cache.get(k) for k in keys]
+    todo = [t for t, r in zip(tasks, found) if r is MISS]
+    computed = iter_tasks(fn, todo, **run_kw)
+    for key, r in zip(keys, found):
+        if r is MISS:
+            r = next(computed)
+            if cacheable(r):
+                cache.put(key, r, kind)
+        yield r
+    cache.db.commit()
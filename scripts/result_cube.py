@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — cubo dei risultati walk-forward (tutte le combinazioni della griglia)
+
+walkforward_backtest.py --cube salva, per ogni pair e fold, le metriche
+TRAIN e TEST di ogni combinazione valutata (non solo della migliore) in un
+array N-dimensionale compresso su disco:
+
+  pair x fold x z_window x z_enter x z_exit x z_stop x max_hold x latency x metric
+
+metric:
+  train_*  bt_kernel.GRID_METRICS della griglia sul TRAIN (quelle della
+           selezione: Sharpe e MaxDD qui sono per trade, non MTM)
+  sign     segno scelto sul TRAIN, come il walk-forward
+  test_*   trades, net_pnl_total, Sharpe, MaxDD, hit_rate del TEST con le
+           stesse definizioni di wf_metrics.csv (Sharpe e MaxDD dal PnL
+           mark-to-market giornaliero): per la combinazione scelta coincidono
+           con la riga del fold (se il fold non è scartato per pochi trade)
+Le celle non valutate (fold saltati, combinazioni scartate, finestre z
+troppo lunghe per il fold) sono NaN.
+
+File .npz (np.savez_compressed, niente pickle): `data`, le etichette di
+ogni asse (`axis_<nome>`), l'ordine degli assi e i metadati del run (JSON).
+
+API di interrogazione (numpy puro, senza ri-simulare):
+  cube = ResultCube.load("reports/wf_cube.npz")
+  cube.sel(pair="SWDA_L_EUNL_DE", metric="test_net_pnl_total")   # per etichetta
+  cube.isel(fold=slice(0, 5))                                     # per posizione
+  cube.reduce(np.nansum, "fold")                                  # aggrega assi
+  cube.neighborhood("min", radius=1)                              # robustezza sui vicini di griglia
+  cube.to_frame()                                                 # DataFrame lungo (una colonna per metrica)
+
+CLI: riepilogo degli assi e migliori combinazioni per pair (media sui fold
+di una metrica TEST, con il minimo sui vicini di griglia):
+  python scripts/result_cube.py reports/wf_cube.npz --by test_net_pnl_total --top 5
+"""
+from __future__ import annotations
+import argparse, json, warnings
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Sequence
+import numpy as np
+import pandas as pd
+
+from bt_kernel import GRID_METRICS
+from bar_clock import parse_duration, fmt_duration
+
+CUBE_DIMS = ("pair", "fold", "z_window", "z_enter", "z_exit", "z_stop", "max_hold", "latency", "metric")
+PARAM_DIMS = ("z_window", "z_enter", "z_exit", "z_stop", "max_hold", "latency")
+TRAIN_METRICS = tuple(f"train_{m}" for m in GRID_METRICS)
+TEST_METRICS = ("test_trades", "test_net_pnl_total", "test_Sharpe", "test_MaxDD", "test_hit_rate")
+T_TRADES, T_PNL, T_SHARPE, T_MAXDD, T_HIT = range(len(TEST_METRICS))
+CUBE_METRICS = TRAIN_METRICS + ("sign",) + TEST_METRICS
+
+
+def _labels(values: Sequence) -> np.ndarray:
+    """Etichette di un asse: numeri se possibile, altrimenti stringhe (durate, pair)."""
+    a = np.asarray(list(values))
+    return a if a.dtype.kind in "biuf" else a.astype(str)
+
+
+@dataclass
+class ResultCube:
+    data: np.ndarray
+    axes: Dict[str, np.ndarray]   # nome asse -> etichette, nell'ordine delle dimensioni di data
+    meta: Dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def empty(cls, axes: Dict[str, Sequence], meta: Dict[str, Any] = None) -> "ResultCube":
+        ax = {k: _labels(v) for k, v in axes.items()}
+        return cls(np.full(tuple(len(v) for v in ax.values()), np.nan), ax, dict(meta or {}))
+
+    @property
+    def dims(self) -> List[str]:
+        return list(self.axes)
+
+    def __repr__(self) -> str:
+        shape = " x ".join(f"{k}={len(v)}" for k, v in self.axes.items())
+        return f"ResultCube({shape}, {np.isfinite(self.data).sum()} valori)"
+
+    # -------------------- I/O --------------------
+
+    def save(self, path: str):
+        np.savez_compressed(path, data=self.data, dims=np.asarray(self.dims),
+                            meta=np.asarray(json.dumps(self.meta, default=str)),
+                            **{f"axis_{k}": v for k, v in self.axes.items()})
+
+    @classmethod
+    def load(cls, path: str) -> "ResultCube":
+        with np.load(path, allow_pickle=False) as z:
+            dims = [str(d) for d in z["dims"]]
+            return cls(z["data"], {d: z[f"axis_{d}"] for d in dims}, json.loads(str(z["meta"])))
+
+    # -------------------- selezione --------------------
+
+    def _index(self, dim: str, label) -> int:
+        lab = self.axes[dim]
+        hit = np.flatnonzero(lab == (str(label) if lab.dtype.kind == "U" else label))
+        if hit.size == 0 and lab.dtype.kind == "U":
+            try:   # durate scritte in altro modo (60min -> 1h, come fmt_duration)
+                hit = np.flatnonzero(lab == str(fmt_duration(parse_duration(label))))
+            except ValueError:
+                pass
+        if hit.size == 0 and lab.dtype.kind == "f":
+            hit = np.flatnonzero(np.isclose(lab, float(label)))
+        if hit.size == 0:
+            raise KeyError(f"{dim}={label!r} non presente (valori: {lab.tolist()})")
+        return int(hit[0])
+
+    def isel(self, **idx) -> "ResultCube":
+        """Per posizione: intero (asse rimosso), lista o slice (asse tenuto)."""
+        axes = dict(self.axes)
+        key = []
+        for d in self.dims:
+            i = idx.pop(d, slice(None))
+            key.append(i)
+            if isinstance(i, (int, np.integer)):
+                del axes[d]
+            else:
+                axes[d] = self.axes[d][i]
+        if idx:
+            raise KeyError(f"Assi sconosciuti: {sorted(idx)}")
+        # indici misti (liste su più assi): uno alla volta, senza broadcasting
+        data = self.data
+        for ax in reversed(range(len(key))):
+            k = key[ax]
+            if isinstance(k, slice) and k == slice(None):
+                continue
+            data = data[(slice(None),) * ax + (k if not isinstance(k, list) else np.asarray(k),)]
+        return ResultCube(data, axes, self.meta)
+
+    def sel(self, **labels) -> "ResultCube":
+        """Per etichetta: valore (asse rimosso) o lista di valori (asse tenuto)."""
+        idx = {}
+        for d, v in labels.items():
+            if d not in self.axes:
+                raise KeyError(f"Asse sconosciuto: {d}")
+            if isinstance(v, (list, tuple, np.ndarray)):
+                idx[d] = [self._index(d, x) for x in v]
+            else:
+                idx[d] = self._index(d, v)
+        return self.isel(**idx)
+
+    # -------------------- aggregazioni --------------------
+
+    def reduce(self, fn, *dims: str) -> "ResultCube":
+        """fn(array, axis=tuple) sugli assi dati (es. np.nanmean, np.nansum)."""
+        ax = tuple(self.dims.index(d) for d in dims)
+        with np.errstate(all="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)   # slice tutte NaN -> NaN
+            data = fn(self.data, axis=ax)
+        return ResultCube(np.asarray(data), {k: v for k, v in self.axes.items() if k not in dims}, self.meta)
+
+    def neighborhood(self, how: str = "min", radius: int = 1, dims: Sequence[str] = PARAM_DIMS) -> "ResultCube":
+        """
+        Per ogni punto, min / max / mean (NaN esclusi) sui vicini di griglia
+        entro `radius` passi lungo gli assi parametro (box, bordi tagliati):
+        un punto robusto ha buoni valori anche nei dintorni. Filtri box
+        separabili: un passaggio 1-D per asse invece di (2r+1)^d spostamenti.
+        """
+        if how not in ("min", "max", "mean"):
+            raise ValueError(f"how sconosciuto: {how}")
+        r = int(radius)
+        ok = np.isfinite(self.data)
+        if how == "mean":
+            acc, cnt = np.where(ok, self.data, 0.0), ok.astype(np.float64)
+        else:
+            fill = np.inf if how == "min" else -np.inf
+            acc, cnt = np.where(ok, self.data, fill), None
+        op = np.minimum if how == "min" else np.maximum
+        for d in dims:
+            if d not in self.axes:
+                continue
+            ax = self.dims.index(d)
+            n = self.data.shape[ax]
+            def box(a, add):
+                out = a.copy()
+                for s in range(1, r + 1):
+                    if s >= n:
+                        break
+                    lo = [slice(None)] * a.ndim
+                    hi = [slice(None)] * a.ndim
+                    lo[ax], hi[ax] = slice(0, n - s), slice(s, n)
+                    lo, hi = tuple(lo), tuple(hi)
+                    if add:
+                        out[lo] += a[hi]
+                        out[hi] += a[lo]
+                    else:
+                        out[lo] = op(out[lo], a[hi])
+                        out[hi] = op(out[hi], a[lo])
+                return out
+            acc = box(acc, how == "mean")
+            if cnt is not None:
+                cnt = box(cnt, True)
+        if how == "mean":
+            out = np.divide(acc, cnt, out=np.full(acc.shape, np.nan), where=cnt > 0)
+        else:
+            out = np.where(np.isfinite(acc), acc, np.nan)
+        out[~ok] = np.nan   # solo i punti valutati
+        return ResultCube(out, dict(self.axes), self.meta)
+
+    # -------------------- esportazione --------------------
+
+    def to_frame(self, dropna: bool = True) -> pd.DataFrame:
+        """DataFrame lungo: una riga per cella (assi come colonne), una colonna per metrica se c'è l'asse metric."""
+        dims = [d for d in self.dims if d != "metric"]
+        data = self.data
+        metrics = list(self.axes["metric"]) if "metric" in self.axes else ["value"]
+        if "metric" in self.axes:
+            data = np.moveaxis(data, self.dims.index("metric"), -1)
+        else:
+            data = data[..., None]
+        flat = data.reshape(-1, len(metrics))
+        grid = np.meshgrid(*[np.arange(len(self.axes[d])) for d in dims], indexing="ij")
+        df = pd.DataFrame({d: self.axes[d][g.ravel()] for d, g in zip(dims, grid)})
+        for j, m in enumerate(metrics):
+            df[str(m)] = flat[:, j]
+        if dropna:
+            df = df[np.isfinite(flat).any(axis=1)].reset_index(drop=True)
+        return df
+
+
+def main():
+    ap = argparse.ArgumentParser("ArbiSense result cube")
+    ap.add_argument("cube", nargs="?", default="reports/wf_cube.npz")
+    ap.add_argument("--by", default="test_net_pnl_total", help="metrica per la classifica (media sui fold)")
+    ap.add_argument("--top", type=int, default=5, help="combinazioni per pair")
+    ap.add_argument("--radius", type=int, default=1, help="vicini di griglia per la robustezza")
+    ap.add_argument("--pairs", default=None, help="lista separata da virgola")
+    args = ap.parse_args()
+
+    cube = ResultCube.load(args.cube)
+    print(f"[INFO] {cube}")
+    for d in cube.dims:
+        if d not in ("pair", "fold"):
+            print(f"  {d}: {cube.axes[d].tolist()}")
+    pairs = [p.strip() for p in args.pairs.split(",")] if args.pairs else cube.axes["pair"].tolist()
+    m = cube.sel(metric=args.by, pair=pairs).reduce(np.nanmean, "fold")
+    robust = m.neighborhood("min", radius=args.radius)
+    df = m.to_frame().rename(columns={"value": f"{args.by}_mean"})
+    df[f"{args.by}_nbr_min"] = robust.to_frame()["value"].to_numpy()
+    for pair, g in df.groupby("pair", sort=False):
+        print(f"- {pair}")
+        print(g.sort_values(f"{args.by}_mean", ascending=False).head(args.top).drop(columns="pair")
+              .to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
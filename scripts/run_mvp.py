@@ -11,6 +11,7 @@ Funzioni:
 Uso:
   python scripts/run_mvp.py            # esegue tutte le coppie (default)
   python scripts/run_mvp.py --pair CSP1.L:IUSA.DE  # esegui solo una coppia
+  python scripts/run_mvp.py --interval 5m         # barre 5m: CSV e report *_5m (i giornalieri restano)
 """
 
 import logging
@@ -25,6 +26,8 @@ import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 
+from bar_clock import default_period, interval_suffix
+
 # --- CONFIG ---
 DATA_DIR = Path("data_sample")
 REPORTS_DIR = Path("reports")
@@ -199,7 +202,7 @@ def load_pairs_from_file(path: Path):
         return []
 
 # --- Main ---
-def main(run_pair: str = None):
+def main(run_pair: str = None, interval: str = "1d", period: str = None):
     # load blacklist and pairs
     blacklist = load_blacklist(BLACKLIST_FILE)
     pairs = []
@@ -226,11 +229,14 @@ def main(run_pair: str = None):
 
     for t1, t2 in pairs:
         logging.info("Processing pair %s - %s", t1, t2)
-        file1 = DATA_DIR / f"{t1.replace('.', '_')}.csv"
-        file2 = DATA_DIR / f"{t2.replace('.', '_')}.csv"
+        # intraday in file separati: i CSV giornalieri restano quelli letti a valle
+        tag = interval_suffix(interval)
+        file1 = DATA_DIR / f"{t1.replace('.', '_')}{tag}.csv"
+        file2 = DATA_DIR / f"{t2.replace('.', '_')}{tag}.csv"
 
-        ok1 = fetch_and_save(t1, file1, blacklist=blacklist)
-        ok2 = fetch_and_save(t2, file2, blacklist=blacklist)
+        period = period or default_period(interval)
+        ok1 = fetch_and_save(t1, file1, period=period, interval=interval, blacklist=blacklist)
+        ok2 = fetch_and_save(t2, file2, period=period, interval=interval, blacklist=blacklist)
 
         if not ok1 or not ok2:
             logging.info("Skipping pair %s - %s (ok1=%s ok2=%s)", t1, t2, ok1, ok2)
@@ -255,7 +261,7 @@ def main(run_pair: str = None):
             continue
 
         # save report & plot
-        pair_name = pair_name_from(t1, t2)
+        pair_name = pair_name_from(t1, t2) + tag
         try:
             save_report_and_plot(df_spread, pair_name)
             any_written = True
@@ -271,6 +277,9 @@ def main(run_pair: str = None):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run MVP: fetch prices, compute spreads, save reports")
     parser.add_argument("--pair", help="optional single pair to run, format TICKER1:TICKER2", default=None)
+    parser.add_argument("--interval", default="1d",
+                        help="barre yfinance (1d, 1h, 5m, 1m, ...); se diverso da 1d i file hanno il suffisso _{interval}")
+    parser.add_argument("--period", default=None, help="storico yfinance (default in base all'interval)")
     args = parser.parse_args()
-    main(run_pair=args.pair)
+    main(run_pair=args.pair, interval=args.interval, period=args.period)
 
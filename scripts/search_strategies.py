@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — strategie di ricerca a budget per optimize_params
+
+Interfaccia ask/tell (nessuna dipendenza oltre numpy):
+  s = make_strategy("tpe", space, seed=0)   # resume=n: RNG distinto dopo n trial ripresi
+  p = s.ask()            -> dict parametri
+  s.tell(p, score)       -> score più alto = meglio (ordine libero: async)
+
+Strategie:
+  random  campionamento uniforme nello spazio
+  tpe     Tree-structured Parzen Estimator (kernel multivariato): dopo n_startup
+          trial casuali, sceglie tra n_candidates campioni dalla densità dei
+          trial migliori (quantile gamma, al più 25) quello con l(x)/g(x) massimo
+  cmaes   CMA-ES (mu/mu_w, lambda) con rank-one e rank-mu; gli ask oltre la
+          generazione corrente campionano dalla distribuzione attuale e
+          l'update scatta ogni lambda risultati (adatto a valutazioni async)
+
+Lo spazio lavora in coordinate normalizzate [0, 1]^d; le dimensioni intere
+e categoriche vengono arrotondate in decodifica. Le combinazioni invalide
+(z_exit >= z_enter, z_stop <= z_enter) e i parametri già chiesti o ripresi
+dallo storico (--resume) vengono ricampionati.
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+
+@dataclass
+class Dim:
+    name: str
+    kind: str                      # "float" | "int" | "choice"
+    lo: float = 0.0
+    hi: float = 1.0
+    choices: Optional[Sequence[Any]] = None
+
+    def decode(self, u: float) -> Any:
+        u = min(max(float(u), 0.0), 1.0)
+        if self.kind == "choice":
+            return self.choices[min(int(u * len(self.choices)), len(self.choices) - 1)]
+        v = self.lo + u * (self.hi - self.lo)
+        return int(round(v)) if self.kind == "int" else round(v, 6)
+
+    def encode(self, v: Any) -> float:
+        if self.kind == "choice":
+            i = list(self.choices).index(v) if v in self.choices else 0
+            return (i + 0.5) / len(self.choices)
+        return 0.5 if self.hi <= self.lo else (float(v) - self.lo) / (self.hi - self.lo)
+
+
+class Space:
+    def __init__(self, dims: List[Dim]):
+        self.dims = dims
+
+    def decode(self, u: np.ndarray) -> Dict[str, Any]:
+        return {d.name: d.decode(x) for d, x in zip(self.dims, u)}
+
+    def encode(self, p: Dict[str, Any]) -> np.ndarray:
+        return np.array([d.encode(p[d.name]) for d in self.dims])
+
+    def valid(self, p: Dict[str, Any]) -> bool:
+        ze, zx, zs = p.get("z_enter"), p.get("z_exit"), p.get("z_stop")
+        if ze is None:
+            return True
+        return (zx is None or zx < ze) and (zs is None or zs > ze)
+
+
+def parse_axis(name: str, spec: str, kind: str) -> Dim:
+    """
+    "lo:hi" -> intervallo continuo (o intero); "a,b,c" -> intervallo [min, max]
+    per float/int, scelta tra i valori per "choice".
+    """
+    spec = str(spec)
+    cast = int if kind == "int" else float
+    if ":" in spec:
+        lo, hi = (cast(float(x)) for x in spec.split(":", 1))
+        return Dim(name, kind, lo, hi)
+    vals = [float(x) for x in spec.split(",") if x.strip()]
+    if kind == "choice":
+        return Dim(name, "choice", choices=[int(v) if v.is_integer() else v for v in vals])
+    vals = [cast(v) for v in vals]
+    return Dim(name, kind, min(vals), max(vals))
+
+
+class Strategy:
+    def __init__(self, space: Space, seed: int = 0, resume: int = 0):
+        self.space = space
+        # ripresa dopo `resume` trial: stream diverso dallo stesso seed, altrimenti
+        # si riproporrebbero gli stessi punti del run originale
+        self.rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(resume,)) if resume else seed)
+        self.X: List[np.ndarray] = []
+        self.y: List[float] = []
+        self._seen: set = set()   # parametri già chiesti o ripresi dallo storico
+
+    def _key(self, params: Dict[str, Any]) -> Tuple:
+        return tuple(params.get(d.name) for d in self.space.dims)
+
+    def _propose(self) -> np.ndarray:
+        return self.rng.random(len(self.space.dims))
+
+    def ask(self) -> Dict[str, Any]:
+        for _ in range(100):
+            p = self.space.decode(self._propose())
+            if self.space.valid(p) and self._key(p) not in self._seen:
+                break
+        self._seen.add(self._key(p))
+        return p
+
+    def tell(self, params: Dict[str, Any], score: float):
+        self._seen.add(self._key(params))
+        self.X.append(self.space.encode(params))
+        self.y.append(float(score) if np.isfinite(score) else -np.inf)
+
+
+class RandomSearch(Strategy):
+    pass
+
+
+class TPESearch(Strategy):
+    def __init__(self, space: Space, seed: int = 0, n_startup: int = 10, gamma: float = 0.1,
+                 n_candidates: int = 24, resume: int = 0):
+        super().__init__(space, seed, resume)
+        self.n_startup, self.gamma, self.n_candidates = n_startup, gamma, n_candidates
+
+    @staticmethod
+    def _logpdf(x: np.ndarray, mu: np.ndarray, bw: float, prior: float = 0.0) -> np.ndarray:
+        # mistura di kernel gaussiani a prodotto (pesi uguali) + peso `prior` uniforme su [0, 1]^d
+        d = (x[:, None, :] - mu[None, :, :]) / bw
+        k = np.exp(-0.5 * (d * d).sum(axis=2)) / (bw * np.sqrt(2 * np.pi)) ** x.shape[1]
+        return np.log((k.sum(axis=1) + prior) / (len(mu) + prior) + 1e-300)
+
+    @staticmethod
+    def _bandwidth(n_pts: int, d: int) -> float:
+        # regola di Scott sullo spazio unitario (come il TPE multivariato di Optuna)
+        return 0.2 * max(n_pts, 1) ** (-1.0 / (d + 4))
+
+    def _propose(self) -> np.ndarray:
+        n, d = len(self.y), len(self.space.dims)
+        if n < self.n_startup:
+            return self.rng.random(d)
+        X = np.array(self.X)
+        order = np.argsort(-np.array(self.y), kind="stable")
+        n_good = min(max(1, int(np.ceil(self.gamma * n))), 25)
+        good, bad = X[order[:n_good]], X[order[n_good:]]
+        bw_l, bw_g = self._bandwidth(len(good), d), self._bandwidth(len(bad), d)
+        # candidati dalla densità l(x) dei trial migliori (kernel congiunto su tutte le
+        # dimensioni: le correlazioni tra soglie restano) + prior uniforme
+        mu = good[self.rng.integers(0, n_good, self.n_candidates)]
+        cand = np.clip(mu + bw_l * self.rng.standard_normal((self.n_candidates, d)), 0.0, 1.0)
+        prior = self.rng.random(self.n_candidates) < 1.0 / (n_good + 1)
+        cand[prior] = self.rng.random((int(prior.sum()), d))
+        # prior solo in g(x): in l(x) premierebbe le zone vuote (l/g alto lontano da tutto)
+        score = self._logpdf(cand, good, bw_l) - self._logpdf(cand, bad, bw_g, prior=1.0)
+        return cand[int(np.argmax(score))]
+
+
+class CMAESSearch(Strategy):
+    def __init__(self, space: Space, seed: int = 0, popsize: Optional[int] = None, sigma0: float = 0.3,
+                 resume: int = 0):
+        super().__init__(space, seed, resume)
+        n = len(space.dims)
+        self.n = n
+        self.lam = popsize or 4 + int(3 * np.log(max(n, 1)))
+        self.mu = self.lam // 2
+        w = np.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.w = w / w.sum()
+        self.mueff = 1.0 / np.sum(self.w ** 2)
+        self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+        self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+        self.damps = 1 + 2 * max(0, np.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+        self.chin = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n * n))
+        self.mean = np.full(n, 0.5)
+        self.sigma = sigma0
+        self.C = np.eye(n)
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self._buf: List[Tuple[np.ndarray, float]] = []
+        # campioni grezzi degli ask in attesa di tell, per parametri decodificati
+        # (più ask possono decodificare agli stessi parametri: FIFO)
+        self._raw: Dict[Tuple, List[np.ndarray]] = {}
+        self._last: Optional[np.ndarray] = None
+
+    def _propose(self) -> np.ndarray:
+        A = np.linalg.cholesky(self.C + 1e-12 * np.eye(self.n))
+        self._last = self.mean + self.sigma * (A @ self.rng.standard_normal(self.n))
+        return np.clip(self._last, 0.0, 1.0)
+
+    def ask(self) -> Dict[str, Any]:
+        p = super().ask()
+        # solo il campione restituito (quelli ricampionati perché invalidi no)
+        self._raw.setdefault(self._key(p), []).append(self._last)
+        return p
+
+    def tell(self, params: Dict[str, Any], score: float):
+        super().tell(params, score)
+        # punto campionato (se noto) oppure la sua codifica (trial ripresi dallo storico)
+        k = self._key(params)
+        pending = self._raw.get(k)
+        x = pending.pop(0) if pending else self.X[-1]
+        if pending is not None and not pending:
+            del self._raw[k]
+        self._buf.append((x, self.y[-1]))
+        if len(self._buf) >= self.lam:
+            self._update(self._buf[-self.lam:])
+            self._buf = []
+
+    def _update(self, pop: List[Tuple[np.ndarray, float]]):
+        xs = np.array([p[0] for p in pop])
+        ys = np.array([p[1] for p in pop])
+        sel = xs[np.argsort(-ys, kind="stable")[:self.mu]]
+        old = self.mean
+        self.mean = self.w @ sel
+        y = (self.mean - old) / self.sigma
+        Cinv_sqrt = np.linalg.inv(np.linalg.cholesky(self.C + 1e-12 * np.eye(self.n)))
+        self.ps = (1 - self.cs) * self.ps + np.sqrt(self.cs * (2 - self.cs) * self.mueff) * (Cinv_sqrt @ y)
+        hsig = np.linalg.norm(self.ps) / self.chin < 1.4 + 2 / (self.n + 1)
+        self.pc = (1 - self.cc) * self.pc + hsig * np.sqrt(self.cc * (2 - self.cc) * self.mueff) * y
+        ar = (sel - old) / self.sigma
+        self.C = ((1 - self.c1 - self.cmu) * self.C + self.c1 * np.outer(self.pc, self.pc)
+                  + self.cmu * (ar.T * self.w) @ ar)
+        self.C = (self.C + self.C.T) / 2
+        self.sigma = float(np.clip(self.sigma * np.exp((self.cs / self.damps) * (np.linalg.norm(self.ps) / self.chin - 1)),
+                                   1e-4, 1.0))
+
+
+STRATEGIES = {"random": RandomSearch, "tpe": TPESearch, "cmaes": CMAESSearch}
+
+
+def make_strategy(name: str, space: Space, seed: int = 0, resume: int = 0) -> Strategy:
+    if name not in STRATEGIES:
+        raise ValueError(f"Strategia sconosciuta: {name}")
+    return STRATEGIES[name](space, seed=seed, resume=resume)
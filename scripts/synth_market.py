@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — generatore di mercato sintetico cointegrato (load / scale test)
+
+Scrive gli stessi schemi dei dati reali, senza Yahoo:
+  <outdir>/spread_report_all_pairs_long.normalized.csv
+      date, pair, spread_raw, spread_scale     (spread in bps, scala 1e-4)
+  <outdir>/legs_<PAIR>.full.csv
+      date, A_ticker, A_price, B_ticker, B_price   (B già nella valuta di A)
+  <outdir>/synth_pairs.csv
+      parametri veri di ogni pair (half-life, vol, premio, FX, rotture)
+
+Modello per pair (log-prezzi, barra t):
+  B_t   random walk (vol annua --leg-vol), FX_t random walk (--fx-vol) per
+        una quota --fx-share di pair in valuta diversa, altrimenti 1
+  x_t   Ornstein-Uhlenbeck esatto: x_{t+1} = phi x_t + sd eps,
+        phi = 2^(-1/half_life), sd = vol stazionaria * sqrt(1 - phi^2)
+  A_t   = B_t * FX_t * exp(premio + mu_regime + x_t): A e B*FX cointegrate
+  rumore di osservazione indipendente sulle due gambe (--noise-bps)
+  rotture di regime (Poisson, --breaks-per-year): salto della media
+  (--break-bps) e half-life moltiplicata/divisa per --break-hl-factor
+  buchi: barre mancanti a blocchi (--gap-rate, --gap-max): NaN nelle
+  gambe, righe assenti nel file long
+spread_raw = (A_price / B_price - 1) * 1e4, spread_scale = 1e-4:
+Δspread_raw x spread_scale x notional è il PnL della coppia.
+
+Riproducibile: ogni pair ha il suo generatore (SeedSequence(seed).spawn),
+quindi la pair i è identica qualunque sia --pairs o --batch. Le pair sono
+generate e scritte a blocchi (--batch): memoria ~ batch x barre, per
+migliaia di pair e decenni di storia.
+Barre: --freq (B = giorni lavorativi; es. 5min/1h con --session per
+l'intraday); --half-life in barre o come durata (es. 2d, 90min).
+
+Esempio:
+  python scripts/synth_market.py --pairs 2000 --years 30 --outdir data_synth --no-legs
+  python scripts/synth_market.py --pairs 20 --years 1 --freq 5min --half-life 60min,4h
+"""
+from __future__ import annotations
+import argparse, math, time
+from pathlib import Path
+from typing import Tuple
+import numpy as np
+import pandas as pd
+
+from bar_clock import parse_durations, is_time
+
+BARS_PER_YEAR_DAILY = 252
+LONG_NAME = "spread_report_all_pairs_long.normalized.csv"
+
+
+def ar1_filter(eps: np.ndarray, phi: float, x0: float = 0.0, block: int = 256) -> np.ndarray:
+    """
+    x_t = phi * x_{t-1} + eps_t (x_{-1} = x0) senza loop per barra: in ogni
+    blocco x = phi^k * (phi * x_prev + cumsum(eps / phi^k)); blocchi corti
+    per tenere phi^-k in range.
+    """
+    n = eps.shape[0]
+    out = np.empty(n)
+    k = np.arange(min(n, block), dtype=np.float64)
+    prev = float(x0)
+    for a in range(0, n, block):
+        e = eps[a:a + block]
+        p = phi ** k[:e.shape[0]]
+        out[a:a + block] = p * (prev * phi + np.cumsum(e / p))
+        prev = out[a + e.shape[0] - 1]
+    return out
+
+
+def make_calendar(start: str, end: str, freq: str, session: str) -> pd.DatetimeIndex:
+    """Barre UTC: giorni lavorativi, oppure barre intraday nei giorni feriali dentro la sessione."""
+    idx = pd.date_range(start, end, freq=freq, tz="UTC").as_unit("ns")
+    if idx.size > 1 and (idx[1] - idx[0]) < pd.Timedelta(days=1):
+        t0, t1 = session.split("-")
+        idx = idx[idx.dayofweek < 5]
+        idx = idx[(idx.indexer_between_time(t0, t1, include_end=False))]
+    return idx
+
+
+def bars_per_year(cal: pd.DatetimeIndex) -> float:
+    years = max((cal[-1] - cal[0]) / pd.Timedelta(days=365.25), 1e-9)
+    return len(cal) / years if len(cal) > 1 else BARS_PER_YEAR_DAILY
+
+
+def half_life_bars(spec, step_ns: int) -> float:
+    return spec.value / step_ns if is_time(spec) else float(spec)
+
+
+def pair_names(i: int) -> Tuple[str, str, str]:
+    a, b = f"SYN{i:05d}A.L", f"SYN{i:05d}B.DE"
+    return a, b, f"{a.replace('.', '_')}_{b.replace('.', '_')}"
+
+
+def simulate_pair(i: int, seed_seq: np.random.SeedSequence, n: int, bpy: float, step_ns: int, args) -> dict:
+    """Una pair: gambe, spread e parametri veri (tutto dal generatore della pair)."""
+    rng = np.random.default_rng(seed_seq)
+    lo, hi = (half_life_bars(h, step_ns) for h in (args.half_life[0], args.half_life[-1]))
+    hl = float(rng.uniform(lo, hi)) if hi > lo else lo
+    vol = args.spread_vol_bps * 1e-4 * float(rng.uniform(0.5, 1.5))
+    premium = args.premium_bps * 1e-4 * float(rng.uniform(-1.0, 1.0))
+    has_fx = bool(rng.random() < args.fx_share)
+
+    # rotture di regime: tempi uniformi, media che salta, half-life che cambia
+    n_breaks = int(rng.poisson(args.breaks_per_year * n / bpy))
+    cuts = np.sort(rng.integers(1, max(n, 2), size=n_breaks)) if n_breaks else np.zeros(0, dtype=np.int64)
+    bounds = np.r_[0, cuts, n]
+    x = np.empty(n)
+    mu = np.empty(n)
+    level, hl_seg, prev = 0.0, hl, 0.0
+    for s, (a, b) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if s > 0:
+            level += rng.normal(0.0, args.break_bps * 1e-4)
+            hl_seg = hl * args.break_hl_factor ** rng.choice([-1.0, 1.0])
+        if b <= a:
+            continue
+        phi = 2.0 ** (-1.0 / max(hl_seg, 1e-6))
+        x[a:b] = ar1_filter(rng.normal(0.0, vol * math.sqrt(1.0 - phi * phi), b - a), phi, prev)
+        mu[a:b] = level
+        prev = x[b - 1]
+
+    dt = 1.0 / bpy
+    log_b = math.log(rng.uniform(50.0, 150.0)) + np.cumsum(rng.normal(0.0, args.leg_vol * math.sqrt(dt), n))
+    log_fx = (math.log(rng.uniform(0.8, 1.2)) + np.cumsum(rng.normal(0.0, args.fx_vol * math.sqrt(dt), n))
+              if has_fx else np.zeros(n))
+    noise = args.noise_bps * 1e-4
+    b_px = np.exp(log_b + log_fx + rng.normal(0.0, noise, n))           # B nella valuta di A
+    a_px = np.exp(log_b + log_fx + premium + mu + x + rng.normal(0.0, noise, n))
+
+    # buchi: blocchi di barre mancanti (inizio con prob. gap_rate / lunghezza media)
+    miss = np.zeros(n, dtype=bool)
+    if args.gap_rate > 0 and n:
+        mean_len = (1 + args.gap_max) / 2.0
+        starts = np.flatnonzero(rng.random(n) < args.gap_rate / mean_len)
+        for s0, ln in zip(starts, rng.integers(1, args.gap_max + 1, size=starts.size)):
+            miss[s0:s0 + ln] = True
+    a_px[miss] = np.nan
+    b_px[miss] = np.nan
+
+    a_tk, b_tk, pair = pair_names(i)
+    return dict(pair=pair, a_ticker=a_tk, b_ticker=b_tk, a_px=a_px, b_px=b_px, miss=miss,
+                params=dict(pair=pair, A_ticker=a_tk, B_ticker=b_tk, half_life_bars=hl,
+                            spread_vol_bps=vol * 1e4, premium_bps=premium * 1e4, fx=has_fx,
+                            n_breaks=n_breaks, gap_share=float(miss.mean()) if n else 0.0))
+
+
+def main():
+    ap = argparse.ArgumentParser("ArbiSense synthetic market")
+    ap.add_argument("--outdir", default="data_synth")
+    ap.add_argument("--pairs", type=int, default=50)
+    ap.add_argument("--start", default="2000-01-03")
+    ap.add_argument("--years", type=float, default=10.0)
+    ap.add_argument("--end", default=None, help="alternativa a --years")
+    ap.add_argument("--freq", default="B", help="B (giornaliero lavorativo) o barre intraday (es. 5min, 1h)")
+    ap.add_argument("--session", default="08:00-16:30", help="finestra UTC delle barre intraday")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--half-life", type=parse_durations, default="5,30",
+                    help="half-life OU: valore o min,max (barre o durate, es. 2d,10d)")
+    ap.add_argument("--spread-vol-bps", type=float, default=15.0, help="vol stazionaria tipica dello spread (bps)")
+    ap.add_argument("--premium-bps", type=float, default=20.0, help="premio/sconto massimo di A su B (bps)")
+    ap.add_argument("--noise-bps", type=float, default=2.0, help="rumore di osservazione per gamba (bps)")
+    ap.add_argument("--leg-vol", type=float, default=0.18, help="vol annua delle gambe")
+    ap.add_argument("--fx-vol", type=float, default=0.08, help="vol annua del cambio")
+    ap.add_argument("--fx-share", type=float, default=0.5, help="quota di pair con gambe in valute diverse")
+    ap.add_argument("--gap-rate", type=float, default=0.01, help="quota attesa di barre mancanti")
+    ap.add_argument("--gap-max", type=int, default=5, help="lunghezza massima di un buco (barre)")
+    ap.add_argument("--breaks-per-year", type=float, default=0.1)
+    ap.add_argument("--break-bps", type=float, default=25.0, help="dev. std del salto di media a una rottura")
+    ap.add_argument("--break-hl-factor", type=float, default=2.0, help="half-life x/÷ questo fattore a una rottura")
+    ap.add_argument("--no-legs", action="store_true", help="solo il file long (niente legs_*.full.csv)")
+    ap.add_argument("--batch", type=int, default=200, help="pair per blocco di scrittura")
+    args = ap.parse_args()
+
+    end = args.end or str((pd.Timestamp(args.start) + pd.Timedelta(days=365.25 * args.years)).date())
+    cal = make_calendar(args.start, end, args.freq, args.session)
+    n = len(cal)
+    if n < 2:
+        raise SystemExit("Calendario vuoto: controllare --start/--years/--freq")
+    step_ns = int(np.median(np.diff(cal.asi8)))
+    bpy = bars_per_year(cal)
+    dates = np.asarray(cal.astype(str))   # stesso formato dei CSV reali (2019-01-02 00:00:00+00:00)
+
+    out = Path(args.outdir)
+    out.mkdir(parents=True, exist_ok=True)
+    long_path = out / LONG_NAME
+    seeds = np.random.SeedSequence(args.seed).spawn(args.pairs)
+
+    t0 = time.perf_counter()
+    rows, params = 0, []
+    with open(long_path, "w") as f:
+        f.write("date,pair,spread_raw,spread_scale\n")
+        for a in range(0, args.pairs, args.batch):
+            parts = []
+            for i in range(a, min(a + args.batch, args.pairs)):
+                p = simulate_pair(i, seeds[i], n, bpy, step_ns, args)
+                params.append(p["params"])
+                keep = ~p["miss"]
+                parts.append(pd.DataFrame({"date": dates[keep], "pair": p["pair"],
+                                           "spread_raw": (p["a_px"][keep] / p["b_px"][keep] - 1.0) * 1e4,
+                                           "spread_scale": 1e-4}))
+                if not args.no_legs:
+                    pd.DataFrame({"date": dates, "A_ticker": p["a_ticker"], "A_price": p["a_px"],
+                                  "B_ticker": p["b_ticker"], "B_price": p["b_px"]}).to_csv(
+                        out / f"legs_{p['pair']}.full.csv", index=False)
+            chunk = pd.concat(parts, ignore_index=True)
+            chunk.to_csv(f, header=False, index=False)
+            rows += len(chunk)
+    pd.DataFrame(params).to_csv(out / "synth_pairs.csv", index=False)
+
+    dt_s = time.perf_counter() - t0
+    print(f"[OK] {args.pairs} pair x {n} barre ({cal[0]} -> {cal[-1]}), {rows} righe in {dt_s:.1f}s")
+    print(f"[WROTE] {long_path}")
+    if not args.no_legs:
+        print(f"[WROTE] {out}/legs_<PAIR>.full.csv ({args.pairs} file)")
+    print(f"[WROTE] {out / 'synth_pairs.csv'}")
+
+
+if __name__ == "__main__":
+    main()
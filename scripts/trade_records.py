@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — trade colonnari (array strutturati numpy)
+
+Gli engine accumulano i trade in blocchi: un array strutturato
+preallocato per simulazione (un record per trade, direction/reason come
+codici int8 di bt_kernel, entry/exit come int64 ns UTC) più le costanti
+del blocco (pair, fold, parametri, notional...) tenute una volta sola
+invece che ripetute su ogni riga. Metriche e aggregati leggono le
+colonne numpy; la conversione a pandas (nomi, date, costanti espanse)
+avviene solo in scrittura, con TradeLog.to_frame.
+
+  blk = trade_block(kt, t_ns, entry_px, exit_px, gross, cost, net, z,
+                    const={"pair": pair, "fold": 3})
+  log = TradeLog(); log.append(blk)
+  log.to_frame(WF_V1_COLUMNS, when="date").to_csv(...)
+
+Colonne di output: nomi dei campi del record, delle costanti, oppure
+derivate: entry_date/exit_date (da entry_ns/exit_ns, come data o
+timestamp), direction/reason_exit (nomi), days_held (barre, o giorni
+trascorsi sulle barre intraday). mae/mfe/bars_to_mfe/trade_dd vengono
+dal prezzo di esecuzione per barra (path_px) in un passaggio vettoriale.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence
+import numpy as np
+import pandas as pd
+
+from bt_kernel import DAY_NS, DIRECTION_NAMES, PATH_METRICS, REASON_NAMES, KernelTrades, path_analytics
+
+TRADE_FIELDS = [
+    ("entry_ns", np.int64), ("exit_ns", np.int64),
+    ("entry_spread_eff", np.float64), ("exit_spread_eff", np.float64),
+    ("direction", np.int8), ("held", np.int64),
+    ("gross_pnl", np.float64), ("cost", np.float64), ("net_pnl", np.float64),
+    ("entry_z", np.float64), ("exit_z", np.float64),
+    ("reason", np.int8),
+    # percorso intra-trade (bt_kernel.path_analytics), in valuta come gross_pnl
+    ("mae", np.float64), ("mfe", np.float64), ("bars_to_mfe", np.int64), ("trade_dd", np.float64),
+]
+TRADE_DTYPE = np.dtype(TRADE_FIELDS)
+# backtest_signals: spread grezzo oltre a quello di esecuzione
+RAW_DTYPE = np.dtype(TRADE_FIELDS + [("entry_spread_raw", np.float64), ("exit_spread_raw", np.float64)])
+
+# ordine delle colonne dei CSV storici (wf_trades.csv / backtest_trades.csv)
+WF_V1_COLUMNS = ["entry_date", "exit_date", "entry_spread_eff", "exit_spread_eff", "direction", "days_held",
+                 "net_pnl", "entry_z", "exit_z", "reason_exit", "pair", "fold", "sign", "z_enter", "z_exit",
+                 "z_stop", "max_hold", "latency", "spread_scale", "gross_pnl", "cost", "notional", "cost_legs",
+                 "mae", "mfe", "bars_to_mfe", "trade_dd"]
+WF_V2_COLUMNS = ["pair", "fold", "entry_date", "exit_date", "entry_spread_eff", "exit_spread_eff", "direction",
+                 "days_held", "gross_pnl", "cost", "net_pnl", "entry_z", "exit_z", "reason_exit", "spread_scale",
+                 "sign", "notional", "cost_legs", "mae", "mfe", "bars_to_mfe", "trade_dd"]
+SIGNALS_COLUMNS = ["pair", "entry_date", "exit_date", "entry_spread_raw", "exit_spread_raw", "entry_spread_eff",
+                   "exit_spread_eff", "direction", "days_held", "gross_pnl", "cost", "net_pnl", "entry_z", "exit_z",
+                   "reason_exit", "spread_scale", "notional", "cost_legs", "mae", "mfe", "bars_to_mfe",
+                   "trade_dd"]
+
+
+@dataclass
+class TradeBlock:
+    """Trade di una simulazione: record (n,) + costanti comuni a tutte le righe."""
+    rec: np.ndarray
+    const: Dict[str, Any] = field(default_factory=dict)
+    intraday: bool = False   # days_held in giorni trascorsi (barre intraday)
+
+    def __len__(self) -> int:
+        return int(self.rec.shape[0])
+
+    @property
+    def net(self) -> np.ndarray:
+        return self.rec["net_pnl"]
+
+
+def trade_block(kt: KernelTrades, t_ns: np.ndarray, entry_px: np.ndarray, exit_px: np.ndarray,
+                gross: np.ndarray, cost: float, net: np.ndarray, z: np.ndarray, *,
+                const: Optional[Dict[str, Any]] = None, intraday: bool = False,
+                raw: Optional[np.ndarray] = None, path_px: Optional[np.ndarray] = None,
+                pnl_mult: float = 1.0) -> TradeBlock:
+    """
+    Riempie il blocco preallocato dai trade del kernel (z: z-score di segnale
+    per barra; path_px: prezzo di esecuzione per barra per MAE/MFE, senza
+    restano NaN / -1).
+    """
+    rec = np.empty(len(kt), dtype=TRADE_DTYPE if raw is None else RAW_DTYPE)
+    rec["entry_ns"] = t_ns[kt.entry_i]
+    rec["exit_ns"] = t_ns[kt.exit_i]
+    rec["entry_spread_eff"] = entry_px
+    rec["exit_spread_eff"] = exit_px
+    rec["direction"] = kt.direction
+    rec["held"] = kt.held
+    rec["gross_pnl"] = gross
+    rec["cost"] = cost
+    rec["net_pnl"] = net
+    rec["entry_z"] = z[kt.entry_i]
+    rec["exit_z"] = z[kt.exit_i]
+    rec["reason"] = kt.reason
+    if path_px is not None:
+        path = path_analytics(kt.entry_i, kt.exit_i, kt.direction, path_px, pnl_mult=pnl_mult)
+        for k in PATH_METRICS:
+            rec[k] = path[k]
+    else:
+        for k in PATH_METRICS:
+            rec[k] = -1 if k == "bars_to_mfe" else np.nan
+    if raw is not None:
+        rec["entry_spread_raw"] = raw[kt.entry_i]
+        rec["exit_spread_raw"] = raw[kt.exit_i]
+    return TradeBlock(rec, dict(const or {}), intraday)
+
+
+def decode_when(t_ns: np.ndarray, when: str) -> np.ndarray:
+    """int64 ns -> date (when="date") o Timestamp UTC (when="timestamp")."""
+    t = pd.to_datetime(t_ns, utc=True)
+    return t.date if when == "date" else t
+
+
+class TradeLog:
+    """Blocchi di trade nell'ordine di arrivo; pandas solo in to_frame."""
+
+    def __init__(self, blocks: Sequence[TradeBlock] = ()):
+        self.blocks: List[TradeBlock] = [b for b in blocks if len(b)]
+
+    def append(self, block: Optional[TradeBlock]):
+        if block is not None and len(block):
+            self.blocks.append(block)
+
+    def __len__(self) -> int:
+        return sum(len(b) for b in self.blocks)
+
+    def column(self, name: str) -> np.ndarray:
+        """Campo del record concatenato sui blocchi."""
+        if not self.blocks:
+            return np.zeros(0)
+        return np.concatenate([b.rec[name] for b in self.blocks])
+
+    def to_frame(self, columns: Sequence[str], when: str = "date") -> pd.DataFrame:
+        """
+        DataFrame con le colonne richieste, nell'ordine dato. when: formato
+        di entry_date/exit_date sulle barre giornaliere ("date" o
+        "timestamp"); intraday sempre timestamp.
+        """
+        if not self.blocks:
+            return pd.DataFrame(columns=list(columns))
+        return pd.DataFrame({c: self._column(c, when) for c in columns})
+
+    def _column(self, name: str, when: str):
+        blocks = self.blocks
+        mixed = len({b.intraday for b in blocks}) > 1
+        if name in ("entry_date", "exit_date"):
+            field_ns = name[:-5] + "_ns"
+            if not mixed:
+                return decode_when(self.column(field_ns), "timestamp" if blocks[0].intraday else when)
+            return np.concatenate([np.asarray(decode_when(b.rec[field_ns], "timestamp" if b.intraday else when),
+                                              dtype=object) for b in blocks])
+        if name == "direction":
+            return DIRECTION_NAMES[self.column("direction").astype(np.int64) + 1]
+        if name == "reason_exit":
+            return REASON_NAMES[self.column("reason").astype(np.int64)]
+        if name == "days_held":
+            return np.concatenate([(b.rec["exit_ns"] - b.rec["entry_ns"]) / DAY_NS if b.intraday else b.rec["held"]
+                                   for b in blocks])
+        if name in blocks[0].rec.dtype.names:
+            return self.column(name)
+        # costante di blocco: espansa sulle righe solo qui
+        return np.concatenate([np.repeat(np.asarray(b.const.get(name, np.nan)), len(b)) for b in blocks])
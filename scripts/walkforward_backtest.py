@@ -7,17 +7,25 @@ ArbiSense — Walk-Forward Backtest (full replacement)
 - Filtri minimi di trade su TRAIN/TEST
 - Gestione robusta dello spread (raw/pct + heuristics bps)
 - Date tz-aware (UTC) per evitare errori tz-naive/aware
+- Metriche TEST (vol, Sharpe, MaxDD, CAGR) dal PnL mark-to-market giornaliero
+- --train-mode expanding: TRAIN ancorato all'inizio, statistiche TRAIN
+  riportate da un fold al successivo (fold_plan.TrainCarry)
+- Barre intraday: --z-window/--grid-max-hold come durate (es. 60min, 4h),
+  fold semiaperti, days_held in giorni trascorsi (bar_clock)
+- Trade colonnari (trade_records): DataFrame solo alla scrittura di wf_trades.csv
 - Output:
     reports/wf_best_params.csv
     reports/wf_metrics.csv
     reports/wf_trades.csv
+    reports/wf_portfolio_daily.csv  (PnL MTM giornaliero di portafoglio, TEST)
     reports/wf_equity.png
+    reports/wf_cube.npz  (--cube: metriche TRAIN/TEST di tutte le combinazioni, result_cube)
 
 Dipendenze: pandas, numpy, matplotlib (Agg)
 """
 from __future__ import annotations
-import argparse, os, sys, math
-from dataclasses import dataclass
+import argparse, itertools, os, sys, math
+from dataclasses import dataclass, replace
 from typing import List, Tuple, Dict, Any, Optional
 import numpy as np
 import pandas as pd
@@ -25,6 +33,19 @@ import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 
+from bt_kernel import (run_kernel, shift_array, as_f64, evaluate_grid, grid_combos,
+                       valid_combo_mask, successive_halving, trades_after, mtm_pnl, daily_pnl, mtm_metrics,
+                       portfolio_daily, days_to_dates, run_kernel_paths, mtm_pnl_paths, mtm_metrics_paths,
+                       GridState, GRID_METRICS, G_TRADES, G_PNL, G_SHARPE_TRADE, G_HIT)
+from feature_cache import FEATURES, RollingFeatures, ts_ns, rolling_features
+from fold_plan import build_plan, rolling_windows, expanding_windows, TrainCarry
+from bar_clock import (parse_duration, parse_durations, parse_days, is_time, is_intraday, fmt_duration,
+                       bar_ns, window_bars, hold_deadline)
+from trade_records import TradeBlock, TradeLog, trade_block, WF_V1_COLUMNS
+from wf_parallel import STATE
+from result_cache import ResultCache, DEFAULT_PATH, make_key, iter_cached
+from result_cube import ResultCube, CUBE_METRICS, TEST_METRICS, T_TRADES, T_PNL, T_SHARPE, T_MAXDD, T_HIT
+
 # -------------------- CLI --------------------
 
 def parse_args():
@@ -38,28 +59,56 @@ def parse_args():
     ap.add_argument("--side", choices=["both","long","short"], default="short")
     ap.add_argument("--start", default=None, help="YYYY-MM-DD inclusiva")
     ap.add_argument("--end",   default=None, help="YYYY-MM-DD inclusiva")
-    ap.add_argument("--train-days", type=int, default=240)
-    ap.add_argument("--test-days",  type=int, default=60)
-    ap.add_argument("--step-days",  type=int, default=60,
+    ap.add_argument("--train-days", type=parse_days, default=240,
+                    help="giorni (o durata, es. 36h, per fold su barre intraday)")
+    ap.add_argument("--test-days",  type=parse_days, default=60)
+    ap.add_argument("--step-days",  type=parse_days, default=60,
                     help="di quanto far scorrere la finestra")
+    ap.add_argument("--train-mode", choices=["rolling","expanding"], default="rolling",
+                    help="rolling: TRAIN di --train-days che scorre; expanding: TRAIN ancorato all'inizio che "
+                         "cresce di --step-days (--train-days = primo TRAIN), simulato in modo incrementale")
 
     ap.add_argument("--notional", type=float, default=250_000.0)
     ap.add_argument("--fee-bps", type=float, default=0.0)
     ap.add_argument("--slippage-bps", type=float, default=0.0)
-    ap.add_argument("--z-window", type=int, default=60)
+    ap.add_argument("--z-window", type=parse_duration, default=60,
+                    help="barre (intero) o durata per barre intraday (es. 120min)")
     ap.add_argument("--spread-scale", default="auto", help="auto o numero (fattore)")
 
     ap.add_argument("--grid-z-enter", default="2.6,2.8,3.0,3.2,3.4")
     ap.add_argument("--grid-z-exit",  default="2.4,2.6,2.8")
     ap.add_argument("--grid-z-stop",  default="4.0,99")
-    ap.add_argument("--grid-max-hold", default="5,7")
+    ap.add_argument("--grid-max-hold", default="5,7", help="barre o durate (es. 30min,2h)")
     ap.add_argument("--latency-days",  default="0")
+    ap.add_argument("--grid-z-window", default=None,
+                    help="Finestre z da cercare (es. 40,60,90); default solo --z-window")
+    ap.add_argument("--z-mode", choices=["fold","full"], default="fold",
+                    help="fold: z ricalcolato su ogni TRAIN/TEST (warm-up a inizio fold); "
+                         "full: z causale sull'intera storia, tagliato per fold")
+
+    ap.add_argument("--search", choices=["grid","halving"], default="grid",
+                    help="grid: griglia completa; halving: successive halving su prefissi del TRAIN "
+                         "(+ scarto combinazioni invalide)")
+    ap.add_argument("--halving-eta", type=int, default=3,
+                    help="Fattore di riduzione per rung (tiene il miglior 1/eta)")
+    ap.add_argument("--prune-invalid", action="store_true",
+                    help="Scarta z_exit >= z_enter e z_stop <= z_enter senza simularle (implicito con --search halving)")
 
     ap.add_argument("--min-trades-train", type=int, default=2,
                     help="Scarta combinazioni con pochi trade sul TRAIN")
     ap.add_argument("--min-trades-test", type=int, default=1,
                     help="Scarta fold TEST con meno di N trade")
 
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Processi per i task (pair, fold); output identico al seriale")
+    ap.add_argument("--cache", nargs="?", const=str(DEFAULT_PATH), default=None,
+                    help="Cache persistente dei risultati per fold (SQLite): ricalcola solo i fold "
+                         "con dati/parametri nuovi; senza valore usa reports/bt_cache.sqlite")
+
+    ap.add_argument("--cube", action="store_true",
+                    help="Salva in <outdir>/wf_cube.npz le metriche TRAIN e TEST di ogni combinazione "
+                         "per pair e fold (result_cube.py per le interrogazioni)")
+
     ap.add_argument("--outdir", default="reports")
     return ap.parse_args()
 
@@ -118,7 +167,7 @@ class BTParams:
     z_enter: float
     z_exit: float
     z_stop: float
-    max_hold: int
+    max_hold: int          # barre, o pd.Timedelta (max_hold a tempo)
     latency: int
 
 @dataclass
@@ -129,78 +178,60 @@ class BTContext:
     fee_bps: float
     slippage_bps: float
     side: str
-    z_window: int
+    z_window: int          # barre, o pd.Timedelta (finestra a tempo)
+    intraday: bool = False
 
 # -------------------- backtest engine --------------------
 
-def backtest_on_series(dates: pd.Series, spread: pd.Series, params: BTParams, ctx: BTContext) -> Tuple[pd.DataFrame, Dict[str, Any]]:
-    """Ritorna (trades_df, metrics_dict) per una singola serie."""
-    z = zscore(spread.astype(float), ctx.z_window)
-    z_lag = z.shift(params.latency) if params.latency > 0 else z
-    s_lag = spread.shift(params.latency) if params.latency > 0 else spread
-
-    in_pos = False
-    direction: Optional[str] = None
-    entry_i: Optional[int] = None
-    rows = []
-
-    def try_open(i):
-        nonlocal in_pos, direction, entry_i
-        zi = z_lag.iat[i]
-        if np.isnan(zi):
-            return
-        if not in_pos and ctx.side in ("short","both") and zi >= params.z_enter:
-            in_pos, direction, entry_i = True, "SHORT_SPREAD", i
-        elif not in_pos and ctx.side in ("long","both") and zi <= -params.z_enter:
-            in_pos, direction, entry_i = True, "LONG_SPREAD", i
-
-    def must_exit(i) -> Tuple[bool,str]:
-        if not in_pos:
-            return False, ""
-        zi = z_lag.iat[i]
-        if np.isnan(zi):
-            return False, ""
-        if direction == "SHORT_SPREAD" and zi <= params.z_exit:
-            return True, "MEAN_REVERT"
-        if direction == "LONG_SPREAD" and zi >= -params.z_exit:
-            return True, "MEAN_REVERT"
-        if direction == "SHORT_SPREAD" and zi >= params.z_stop:
-            return True, "STOP"
-        if direction == "LONG_SPREAD" and zi <= -params.z_stop:
-            return True, "STOP"
-        if entry_i is not None and (i - entry_i) >= params.max_hold:
-            return True, "TIMEOUT"
-        return False, ""
-
-    n = len(spread)
-    for i in range(n):
-        if not in_pos:
-            try_open(i)
-        if in_pos:
-            exit_now, reason = must_exit(i)
-            if exit_now:
-                entry_spread = float(s_lag.iat[entry_i] if not np.isnan(s_lag.iat[entry_i]) else spread.iat[entry_i])
-                exit_spread  = float(s_lag.iat[i] if not np.isnan(s_lag.iat[i]) else spread.iat[i])
-                net = compute_pnl(direction, entry_spread, exit_spread,
-                                   is_pct=ctx.is_pct, spread_scale=ctx.spread_scale,
-                                   notional=ctx.notional, fee_bps=ctx.fee_bps,
-                                   slippage_bps=ctx.slippage_bps)
-                rows.append({
-                    "entry_date": pd.to_datetime(dates.iat[entry_i]).date(),
-                    "exit_date":  pd.to_datetime(dates.iat[i]).date(),
-                    "entry_spread_eff": float(entry_spread),
-                    "exit_spread_eff":  float(exit_spread),
-                    "direction": direction,
-                    "days_held": int(i - entry_i),
-                    "net_pnl": float(net),
-                    "entry_z": float(z_lag.iat[entry_i]),
-                    "exit_z":  float(z_lag.iat[i]),
-                    "reason_exit": reason,
-                })
-                in_pos, direction, entry_i = False, None, None
-
-    trades = pd.DataFrame(rows)
-    if trades.empty:
+def backtest_on_series(dates, spread, params: BTParams, ctx: BTContext,
+                       z: Optional[np.ndarray] = None, *, mtm: bool = True,
+                       paths: bool = True) -> Tuple[TradeBlock, Dict[str, Any], Optional[Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Ritorna (trades, metrics_dict, (giorni, pnl_giornaliero)) per una singola serie
+    (trades: blocco colonnare di trade_records, DataFrame solo in scrittura).
+    dates/spread: Series oppure array (int64 ns UTC / float, es. viste di un fold);
+    z: z-score precalcolato (es. da FEATURES).
+    Vol, Sharpe, MaxDD e CAGR dal PnL mark-to-market giornaliero
+    (posizione x variazione dello spread di esecuzione, bt_kernel.mtm_pnl).
+    mtm=False: niente PnL giornaliero (None) né metriche MTM, solo trades,
+    net_pnl_total e hit_rate; paths=False: niente MAE/MFE per trade (NaN / -1).
+    Per chi usa solo i trade costa una frazione (il kernel è la parte minore).
+    """
+    d_ns = ts_ns(dates)
+    if z is None:
+        if is_time(ctx.z_window):
+            z = rolling_features(spread, ctx.z_window, ts=d_ns).z
+        else:
+            z = zscore(pd.Series(as_f64(spread)), ctx.z_window).to_numpy(dtype=np.float64)
+    s = as_f64(spread)
+    z_lag = shift_array(z, params.latency)
+    s_lag = shift_array(s, params.latency)
+
+    timed = is_time(params.max_hold)
+    kt = run_kernel(z_lag, side=ctx.side, z_enter=params.z_enter, z_exit=params.z_exit,
+                    z_stop=params.z_stop, max_hold=0 if timed else params.max_hold,
+                    hold_until=hold_deadline(d_ns, params.max_hold) if timed else None)
+
+    # prezzo di esecuzione: spread laggato, fallback allo spread corrente se NaN
+    px = np.where(np.isnan(s_lag), s, s_lag)
+    entry_spread = px[kt.entry_i]
+    exit_spread  = px[kt.exit_i]
+    mult = ctx.notional if ctx.is_pct else (ctx.spread_scale * ctx.notional)
+    gross = kt.direction * (exit_spread - entry_spread) * mult
+    costs = (ctx.fee_bps + ctx.slippage_bps) * 1e-4 * ctx.notional
+    net = gross - costs
+    daily = daily_pnl(mtm_pnl(kt, px, pnl_mult=mult, cost=costs), d_ns) if mtm else None
+
+    # intraday: timestamp completo e giorni trascorsi invece di date e barre;
+    # per cost_sweep: gross lineare nel notional, costo = cost_legs * (fee+slip) bps * notional
+    trades = trade_block(kt, d_ns, entry_spread, exit_spread, gross, costs, net, z_lag,
+                         path_px=px if paths else None, pnl_mult=mult,
+                         const={"notional": ctx.notional, "cost_legs": 1}, intraday=ctx.intraday)
+    if not mtm:
+        n_tr = len(trades)
+        return trades, {"trades": n_tr, "net_pnl_total": float(net.sum()),
+                        "hit_rate": float((net > 0).mean()) if n_tr else 0.0}, None
+    if not len(trades):
         metrics = {
             "trades": 0,
             "net_pnl_total": 0.0,
@@ -210,34 +241,302 @@ def backtest_on_series(dates: pd.Series, spread: pd.Series, params: BTParams, ct
             "MaxDD": 0.0,
             "hit_rate": 0.0,
         }
-        return trades, metrics
-
-    eq = trades["net_pnl"].cumsum()
-    ret = trades["net_pnl"]
-    vol_ann = ret.std(ddof=0) * np.sqrt(252 / max(1, params.max_hold)) if len(ret) > 1 else 0.0
-    sharpe = (ret.mean() / ret.std(ddof=0)) * np.sqrt(252 / max(1, params.max_hold)) if ret.std(ddof=0) > 0 else 0.0
-    roll_max = eq.cummax(); dd = (eq - roll_max); maxdd = float(dd.min()) if len(dd) else 0.0
-    hit = float((trades["net_pnl"] > 0).mean())
+        return trades, metrics, daily
+
+    mtm = mtm_metrics(daily[1], daily[0], capital=ctx.notional)
     metrics = {
         "trades": int(len(trades)),
-        "net_pnl_total": float(ret.sum()),
-        "CAGR": 0.0,
-        "vol_annualized": float(vol_ann),
-        "Sharpe": float(sharpe),
-        "MaxDD": maxdd,
-        "hit_rate": hit,
+        "net_pnl_total": float(trades.net.sum()),
+        "CAGR": mtm["CAGR"],
+        "vol_annualized": mtm["vol_annualized"],
+        "Sharpe": mtm["Sharpe"],
+        "MaxDD": mtm["MaxDD"],
+        "hit_rate": float((trades.net > 0).mean()),
     }
-    return trades, metrics
+    return trades, metrics, daily
 
 # -------------------- WF core --------------------
 
-def choose_sign_on_train(dates: pd.Series, spread: pd.Series, params: BTParams, ctx: BTContext) -> int:
-    # prova +spread e -spread e sceglie quello con PnL TRAIN maggiore
-    t_pos, m_pos = backtest_on_series(dates,  spread, params, ctx)
-    t_neg, m_neg = backtest_on_series(dates, -spread, params, ctx)
-    pnl_pos = m_pos.get("net_pnl_total", 0.0)
-    pnl_neg = m_neg.get("net_pnl_total", 0.0)
-    return 1 if pnl_pos >= pnl_neg else -1
+def select_best_on_train(f_tr: RollingFeatures, combos: np.ndarray, combo_params: List[BTParams], ctx: BTContext,
+                         min_trades: int, idx: Optional[np.ndarray] = None,
+                         hold_time: bool = False,
+                         states: Optional[Tuple[GridState, GridState]] = None,
+                         keep: Optional[list] = None) -> Optional[Tuple[BTParams, int, Dict[str, Any]]]:
+    """
+    idx: sottoinsieme (indici crescenti) delle combinazioni da valutare.
+    hold_time: max_hold a tempo (colonna in ns, timestamp da f_tr.ts).
+    states: GridState (+spread, -spread) del TRAIN precedente (espandente).
+    keep: se data, vi aggiunge (idx, metriche del segno scelto, segno) di
+    tutte le combinazioni valutate (--cube).
+    Valuta tutta la griglia sul TRAIN (evaluate_grid, +spread e -spread,
+    il secondo dalla simmetria delle feature rolling) e
+    ritorna (params, sign, metriche TRAIN) del miglior candidato, o None.
+    Stesse regole del loop per combinazione: segno con PnL TRAIN maggiore
+    (+1 a parità), scarto sotto min_trades, score = PnL + tie-breaker su
+    Sharpe_trade (per trade, non MTM) e trades, a parità vince la prima
+    combinazione della griglia.
+    """
+    mult = ctx.notional if ctx.is_pct else (ctx.spread_scale * ctx.notional)
+    cost = (ctx.fee_bps + ctx.slippage_bps) * 1e-4 * ctx.notional
+    if idx is None:
+        idx = np.arange(len(combos))
+    f_neg = f_tr.signed(-1)
+    ts = f_tr.ts if hold_time else None
+    st_pos, st_neg = states if states is not None else (None, None)
+    m_pos = evaluate_grid(f_tr.z, f_tr.x, combos[idx], side=ctx.side, pnl_mult=mult, cost=cost, ts=ts, state=st_pos)
+    m_neg = evaluate_grid(f_neg.z, f_neg.x, combos[idx], side=ctx.side, pnl_mult=mult, cost=cost, ts=ts, state=st_neg)
+
+    pos = m_pos[:, G_PNL] >= m_neg[:, G_PNL]
+    m = np.where(pos[:, None], m_pos, m_neg)
+    if keep is not None:
+        keep.append((idx, m, np.where(pos, 1, -1)))
+    ok = np.flatnonzero(m[:, G_TRADES] >= min_trades)
+    if ok.size == 0:
+        return None
+    # tie-breaker su Sharpe_trade e trades
+    score = m[ok, G_PNL] + 1e-6 * m[ok, G_SHARPE_TRADE] + 1e-9 * m[ok, G_TRADES]
+    b = int(ok[np.argmax(score)])
+    m_train = {k: float(m[b, j]) for j, k in enumerate(GRID_METRICS)}
+    m_train["trades"] = int(m_train["trades"])
+    return combo_params[idx[b]], (1 if pos[b] else -1), m_train
+
+
+def grid_on_test(f_te: RollingFeatures, d_te: np.ndarray, combos: np.ndarray, idx: np.ndarray, sign: np.ndarray,
+                 ctx: BTContext, hold_time: bool = False) -> np.ndarray:
+    """
+    Metriche TEST (result_cube.TEST_METRICS) delle combinazioni idx, ciascuna
+    col segno scelto sul TRAIN (--cube), come backtest_on_series: trades, PnL
+    e hit rate dai trade (evaluate_grid), Sharpe e MaxDD dal PnL mark-to-market
+    giornaliero (run_kernel_paths con una combinazione per colonna, una
+    passata per segno e coppia max_hold/latency).
+    """
+    mult = ctx.notional if ctx.is_pct else (ctx.spread_scale * ctx.notional)
+    cost = (ctx.fee_bps + ctx.slippage_bps) * 1e-4 * ctx.notional
+    out = np.full((len(idx), len(TEST_METRICS)), np.nan)
+    n = len(d_te)
+    step = max(1, (1 << 22) // max(n, 1))   # colonne per passata (memoria barre x colonne)
+    for sg in (1, -1):
+        sel = np.flatnonzero(sign == sg)
+        if not sel.size:
+            continue
+        f = f_te.signed(sg)
+        sub = combos[idx[sel]]
+        m = evaluate_grid(f.z, f.x, sub, side=ctx.side, pnl_mult=mult, cost=cost, ts=d_te if hold_time else None)
+        out[sel, T_TRADES], out[sel, T_PNL], out[sel, T_HIT] = m[:, G_TRADES], m[:, G_PNL], m[:, G_HIT]
+        for mh, lat in np.unique(sub[:, 3:5], axis=0):
+            cols = np.flatnonzero((sub[:, 3] == mh) & (sub[:, 4] == lat))
+            z_lag = shift_array(f.z, int(lat))
+            s_lag = shift_array(f.x, int(lat))
+            px = np.where(np.isnan(s_lag), f.x, s_lag)
+            until = hold_deadline(d_te, pd.Timedelta(int(mh))) if hold_time else None
+            for a in range(0, len(cols), step):
+                c = cols[a:a + step]
+                pos, exits = run_kernel_paths(np.broadcast_to(z_lag[:, None], (n, len(c))), side=ctx.side,
+                                              z_enter=sub[c, 0], z_exit=sub[c, 1], z_stop=sub[c, 2],
+                                              max_hold=0 if hold_time else int(mh), hold_until=until)
+                pnl = mtm_pnl_paths(pos, exits, np.broadcast_to(px[:, None], (n, len(c))), pnl_mult=mult, cost=cost)
+                mtm = mtm_metrics_paths(pnl, d_te, capital=ctx.notional)
+                out[sel[c], T_SHARPE], out[sel[c], T_MAXDD] = mtm["Sharpe"], mtm["MaxDD"]
+    return out
+
+
+def halving_on_train(f_tr: RollingFeatures, combos: np.ndarray, idx: np.ndarray, ctx: BTContext,
+                     min_trades: int, eta: int, hold_time: bool = False, step_ns: int = 0) -> Tuple[np.ndarray, int]:
+    """
+    Successive halving sul TRAIN: score = PnL del segno migliore sul prefisso.
+    Ritorna (sopravvissuti, barre simulate per segno nei rung intermedi).
+    """
+    mult = ctx.notional if ctx.is_pct else (ctx.spread_scale * ctx.notional)
+    cost = (ctx.fee_bps + ctx.slippage_bps) * 1e-4 * ctx.notional
+    f_neg = f_tr.signed(-1)
+
+    def eval_prefix(m: int, sub: np.ndarray):
+        kw = dict(side=ctx.side, pnl_mult=mult, cost=cost, ts=f_tr.ts[:m] if hold_time else None)
+        m_pos = evaluate_grid(f_tr.z[:m], f_tr.x[:m], combos[sub], **kw)
+        m_neg = evaluate_grid(f_neg.z[:m], f_neg.x[:m], combos[sub], **kw)
+        pos = m_pos[:, G_PNL] >= m_neg[:, G_PNL]
+        # trade massimi sul TRAIN intero, per il segno che li può raggiungere
+        max_trades = np.maximum(m_pos[:, G_TRADES] + trades_after(f_tr.z, combos[sub], m, side=ctx.side),
+                                m_neg[:, G_TRADES] + trades_after(f_neg.z, combos[sub], m, side=ctx.side))
+        return np.where(pos, m_pos[:, G_PNL], m_neg[:, G_PNL]), max_trades
+
+    return successive_halving(eval_prefix, len(f_tr.z), idx, eta=eta,
+                              min_bars=max(30, 2 * window_bars(ctx.z_window, step_ns)), min_trades=min_trades)
+
+
+def run_fold(task: Tuple[int, int], carry: Optional[TrainCarry] = None):
+    """
+    Un fold (pair, k) del walk-forward: grid search sul TRAIN, TEST coi best
+    params. Legge array e stato da wf_parallel.STATE (seriale o worker).
+    carry: TRAIN espandente, feature e stato della griglia dai fold precedenti.
+    Ritorna None (fold saltato) o (metrics_row, TradeBlock|None, best_row|None, sim_stats,
+    (giorni, pnl) MTM del TEST | None) e, con --cube, la lista delle celle
+    (indice z_window, idx, metriche TRAIN, segno, metriche TEST).
+    """
+    pi, k = task
+    st = STATE
+    args = st["args"]
+    z_method, z_full = st["z_method"], st["z_full"]
+    pair, is_pct, auto_scale, plan = st["pair_meta"][pi]
+    s_vals = st["arrays"][f"s{pi}"]
+    d_ns = st["arrays"][f"d{pi}"]
+
+    fold_id = k + 1
+    tr_start, tr_end, te_start, te_end = plan.windows[k]
+    fmt_day = str if plan.intraday else (lambda t: str(t.date()))
+    span_tr = plan.tr(k)
+    span_te = plan.te(k)
+    n_tr = span_tr[1] - span_tr[0]
+    d_te = d_ns[span_te[0]:span_te[1]]
+
+    # finestre z compatibili con la lunghezza del TRAIN (in modalità full
+    # il warm-up viene dalla storia precedente)
+    step_ns = bar_ns(d_ns) if st["time_windows"] else 0
+    fold_windows = [w for w in st["grid_z_window"]
+                    if n_tr >= (30 if z_full else max(30, window_bars(w, step_ns)//2))]
+    if not fold_windows or span_te[1] == span_te[0]:
+        return None
+
+    # contesto
+    ctx = BTContext(
+        is_pct=is_pct,
+        spread_scale=auto_scale,
+        notional=args.notional,
+        fee_bps=args.fee_bps,
+        slippage_bps=args.slippage_bps,
+        side=args.side,
+        z_window=args.z_window,
+        intraday=plan.intraday,
+    )
+
+    # grid search su TRAIN: tutte le combinazioni in un solo passaggio, per entrambi i segni
+    # (per ogni z_window; a parità di score vince la prima finestra)
+    # (halving: candidati ridotti su prefissi del TRAIN; sim = simulazioni
+    # combo x segno in equivalenti a TRAIN intero, rispetto alla griglia piena)
+    sim = dict(full=0.0, done=0.0)
+    cells = [] if args.cube else None
+    out = (lambda *r: r + (cells,)) if args.cube else (lambda *r: r)
+    best_candidate, best_score = None, -np.inf
+    for w in fold_windows:
+        ctx_w = replace(ctx, z_window=w)
+        kw = dict(method=z_method, full_history=z_full, ts=d_ns)
+        f_tr = carry.features(pair, s_vals, w, span_tr, **kw) if carry else FEATURES.get(pair, s_vals, w, span=span_tr, **kw)
+        idx = st["cand_idx"]
+        if args.search == "halving":
+            idx, bars = halving_on_train(f_tr, st["combos"], idx, ctx_w, args.min_trades_train, args.halving_eta,
+                                         st["hold_time"], step_ns)
+            sim["done"] += 2 * bars / n_tr
+        sim["full"] += 2 * len(st["combos"])
+        sim["done"] += 2 * len(idx)
+        if idx.size == 0:
+            continue
+        states = (carry.state((w, 1), idx.size), carry.state((w, -1), idx.size)) if carry else None
+        keep = [] if args.cube else None
+        cand = select_best_on_train(f_tr, st["combos"], st["combo_params"], ctx_w, args.min_trades_train, idx,
+                                    st["hold_time"], states, keep)
+        if keep:
+            # cubo: TEST di tutte le combinazioni col segno scelto sul TRAIN
+            c_idx, c_train, c_sign = keep[0]
+            f_cube = FEATURES.get(pair, s_vals, w, span=span_te, **kw)
+            c_test = grid_on_test(f_cube, d_te, st["combos"], c_idx, c_sign, ctx_w, st["hold_time"])
+            cells.append((st["grid_z_window"].index(w), c_idx, c_train, c_sign, c_test))
+        if cand is None:
+            continue
+        m = cand[2]
+        score = m["net_pnl_total"] + 1e-6 * m["Sharpe_trade"] + 1e-9 * m["trades"]
+        if best_candidate is None or score > best_score:
+            best_candidate, best_score, ctx = cand, score, ctx_w
+
+    skip_row = {
+        "pair": pair, "fold": fold_id,
+        "test_start": fmt_day(te_start), "test_end": fmt_day(te_end),
+        "trades": 0, "net_pnl_total": 0.0,
+        "CAGR": 0.0, "vol_annualized": 0.0,
+        "Sharpe": 0.0, "MaxDD": 0.0, "hit_rate": 0.0,
+    }
+    if best_candidate is None:
+        # nessun candidato valido per questo fold
+        return out({**skip_row, "reason": "SKIP_NO_VALID_PARAM"}, None, None, sim, None)
+
+    params, sign, m_train = best_candidate
+
+    # TEST con i best params + segno fisso
+    f_te = FEATURES.get(pair, s_vals, ctx.z_window, span=span_te, sign=sign, method=z_method,
+                        full_history=z_full, ts=d_ns)
+    t_test, m_test, daily = backtest_on_series(d_te, f_te.x, params, ctx, z=f_te.z)
+    te_trades = int(m_test.get("trades", 0))
+    if te_trades < args.min_trades_test:
+        return out({**skip_row, "reason": "SKIP_MIN_TRADES_TEST"}, None, None, sim, None)
+
+    # annota trades (TEST) con fold/pair
+    if len(t_test):
+        t_test.const.update(pair=pair, fold=fold_id, sign=sign, z_enter=params.z_enter, z_exit=params.z_exit,
+                            z_stop=params.z_stop, max_hold=fmt_duration(params.max_hold),
+                            latency=params.latency, spread_scale=ctx.spread_scale)
+    else:
+        t_test = None
+
+    # metrics TEST
+    metrics_row = {
+        "pair": pair, "fold": fold_id,
+        "test_start": fmt_day(te_start), "test_end": fmt_day(te_end),
+        **m_test
+    }
+
+    # best params row (per fold & pair)
+    best_row = {
+        "pair": pair, "fold": fold_id,
+        "z_enter": params.z_enter, "z_exit": params.z_exit, "z_stop": params.z_stop,
+        "max_hold": fmt_duration(params.max_hold), "latency": params.latency,
+        "notional": args.notional, "start": fmt_day(tr_start), "end": fmt_day(te_end),
+        "train_days": fmt_duration(args.train_days), "test_days": fmt_duration(args.test_days),
+        "step_days": fmt_duration(args.step_days),
+        "spread_scale": ctx.spread_scale, "side": args.side, "sign": sign, "z_window": fmt_duration(ctx.z_window), **({"z_mode": args.z_mode} if z_full else {}),
+        **({"train_mode": args.train_mode} if args.train_mode != "rolling" else {}),
+    }
+    return out(metrics_row, t_test, best_row, sim, daily)
+
+
+def run_pair_expanding(task: Tuple[int, Tuple[int, ...]]):
+    """Fold ks (in ordine) di una pair con TRAIN espandente: un solo passaggio sulle barre TRAIN."""
+    pi, ks = task
+    carry = TrainCarry(STATE["pair_meta"][pi][3], ks)
+    return [run_fold((pi, k), carry) for k in ks]
+
+
+# opzioni che non cambiano il risultato di un fold (I/O, parallelismo, cache);
+# start/end contano tramite finestre e dati del fold
+CACHE_IGNORE = ("input", "pairs", "pairs_file", "start", "end", "outdir", "workers", "cache", "cube")
+
+def fold_cache_key(args, meta, s_vals: np.ndarray, d_ns: np.ndarray, k: int) -> str:
+    """Chiave della cache del fold k: barre e timestamp letti dal fold + parametri e contesto."""
+    pair, is_pct, auto_scale, plan = meta
+    (a_tr, b_tr), (a_te, b_te) = plan.tr(k), plan.te(k)
+    if args.z_mode == "full":
+        # z causale sulla storia: contano tutte le barre fino a fine TEST
+        # (con --grid-z-window i momenti sono centrati sulla serie intera)
+        hi = len(s_vals) if args.grid_z_window else b_te
+        data = [s_vals[:hi], d_ns[:hi]]
+    else:
+        data = [s_vals[a_tr:b_tr], d_ns[a_tr:b_tr], s_vals[a_te:b_te], d_ns[a_te:b_te]]
+    params = {name: v for name, v in vars(args).items() if name not in CACHE_IGNORE}
+    if args.cube:
+        params["cube"] = True   # i risultati portano anche le celle del cubo
+    params.update(pair=pair, is_pct=is_pct, auto_scale=auto_scale, fold=k,
+                  window=[str(w) for w in plan.windows[k]])
+    return make_key("wf_v1", arrays=data, params=params)
+
+
+def pair_cache_key(args, meta, s_vals: np.ndarray, d_ns: np.ndarray, ks: Tuple[int, ...]) -> str:
+    """Chiave della cache di una pair con TRAIN espandente: tutte le barre fino all'ultimo TEST."""
+    pair, is_pct, auto_scale, plan = meta
+    hi = len(s_vals) if args.z_mode == "full" and args.grid_z_window else max(plan.te(k)[1] for k in ks)
+    params = {name: v for name, v in vars(args).items() if name not in CACHE_IGNORE}
+    if args.cube:
+        params["cube"] = True   # i risultati portano anche le celle del cubo
+    params.update(pair=pair, is_pct=is_pct, auto_scale=auto_scale, folds=list(ks),
+                  windows=[[str(w) for w in plan.windows[k]] for k in ks])
+    return make_key("wf_v1", arrays=[s_vals[:hi], d_ns[:hi]], params=params)
 
 
 def parse_grid_floats(s: str) -> List[float]:
@@ -251,6 +550,8 @@ def parse_grid_ints(s: str) -> List[int]:
 
 def main():
     args = parse_args()
+    if args.train_mode == "expanding" and args.search == "halving":
+        sys.exit("--train-mode expanding richiede --search grid (halving valuta prefissi diversi a ogni fold)")
     ensure_dir(args.outdir)
 
     # carica input
@@ -295,16 +596,26 @@ def main():
     grid_z_enter = parse_grid_floats(args.grid_z_enter)
     grid_z_exit  = parse_grid_floats(args.grid_z_exit)
     grid_z_stop  = parse_grid_floats(args.grid_z_stop)
-    grid_maxhold = parse_grid_ints(args.grid_max_hold)
+    grid_maxhold = parse_durations(args.grid_max_hold)
     grid_latency = parse_grid_ints(args.latency_days)
 
-    best_rows = []
-    metrics_rows = []
-    trades_rows = []
-
-    # per ogni pair, esegui WF
+    # z_window come dimensione di griglia: momenti a somme prefisse (una
+    # cumsum per fold, O(1) a barra per finestra) invece del rolling pandas
+    grid_z_window = parse_durations(args.grid_z_window) if args.grid_z_window else [args.z_window]
+    z_method = "prefix" if args.grid_z_window else "rolling"
+    z_full = args.z_mode == "full"
+
+    # max_hold a tempo: colonna della griglia in ns (evaluate_grid con ts)
+    hold_time = is_time(grid_maxhold[0])
+    combos = grid_combos(grid_z_enter, grid_z_exit, grid_z_stop,
+                         [v.value if hold_time else v for v in grid_maxhold], grid_latency)
+    combo_params = [BTParams(*c) for c in itertools.product(grid_z_enter, grid_z_exit, grid_z_stop, grid_maxhold, grid_latency)]
+
+    # per ogni pair: scala, fold e array (spread float64, date int64 ns)
+    pair_meta = []
+    arrays: Dict[str, np.ndarray] = {}
+    tasks = []
     for pair, g in df.groupby("pair"):
-        g = g.copy()
         dates = g[date_col]
         s = pd.to_numeric(g[spread_col], errors="coerce")
 
@@ -333,140 +644,94 @@ def main():
         else:
             end_ts = dates.max()
 
-        # rolling window
-        cur = pd.to_datetime(start_ts, utc=True)
-        fold_id = 0
-        while cur + pd.Timedelta(days=args.train_days + args.test_days) <= pd.to_datetime(end_ts, utc=True) + pd.Timedelta(days=1):
-            fold_id += 1
-            tr_start = cur
-            tr_end   = cur + pd.Timedelta(days=args.train_days - 1)
-            te_start = tr_end + pd.Timedelta(days=1)
-            te_end   = tr_end + pd.Timedelta(days=args.test_days)
-
-            mask_tr = (dates >= tr_start) & (dates <= tr_end)
-            mask_te = (dates >= te_start) & (dates <= te_end)
-            s_tr = s[mask_tr].reset_index(drop=True)
-            s_te = s[mask_te].reset_index(drop=True)
-            d_tr = dates[mask_tr].reset_index(drop=True)
-            d_te = dates[mask_te].reset_index(drop=True)
-
-            if len(s_tr) < max(30, args.z_window//2) or len(s_te) == 0:
-                cur += pd.Timedelta(days=args.step_days)
-                continue
-
-            # contesto
-            ctx = BTContext(
-                is_pct=is_pct,
-                spread_scale=auto_scale,
-                notional=args.notional,
-                fee_bps=args.fee_bps,
-                slippage_bps=args.slippage_bps,
-                side=args.side,
-                z_window=args.z_window,
-            )
-
-            # grid search su TRAIN
-            best_score = -1e18
-            best_candidate: Optional[Tuple[BTParams, int, Dict[str, Any]]] = None
-
-            for ze in grid_z_enter:
-                for zx in grid_z_exit:
-                    for zs in grid_z_stop:
-                        for mh in grid_maxhold:
-                            for lt in grid_latency:
-                                params = BTParams(ze, zx, zs, mh, lt)
-                                # scegli segno su TRAIN
-                                sign = choose_sign_on_train(d_tr, s_tr, params, ctx)
-                                t_train, m_train = backtest_on_series(d_tr, sign * s_tr, params, ctx)
-                                tr_trades = int(m_train.get("trades", 0))
-                                if tr_trades < args.min_trades_train:
-                                    continue  # scarta combinazione povera di trade
-                                score = float(m_train.get("net_pnl_total", 0.0))
-                                # tie-breaker su Sharpe e trades
-                                score += 1e-6 * float(m_train.get("Sharpe", 0.0))
-                                score += 1e-9 * tr_trades
-                                if score > best_score:
-                                    best_score = score
-                                    best_candidate = (params, sign, m_train)
-
-            if best_candidate is None:
-                # nessun candidato valido per questo fold
-                metrics_rows.append({
-                    "pair": pair, "fold": fold_id,
-                    "test_start": str(te_start.date()), "test_end": str(te_end.date()),
-                    "trades": 0, "net_pnl_total": 0.0,
-                    "CAGR": 0.0, "vol_annualized": 0.0,
-                    "Sharpe": 0.0, "MaxDD": 0.0, "hit_rate": 0.0,
-                    "reason": "SKIP_NO_VALID_PARAM"
-                })
-                cur += pd.Timedelta(days=args.step_days)
-                continue
-
-            params, sign, m_train = best_candidate
-
-            # TEST con i best params + segno fisso
-            t_test, m_test = backtest_on_series(d_te, sign * s_te, params, ctx)
-            te_trades = int(m_test.get("trades", 0))
-            if te_trades < args.min_trades_test:
-                metrics_rows.append({
-                    "pair": pair, "fold": fold_id,
-                    "test_start": str(te_start.date()), "test_end": str(te_end.date()),
-                    "trades": 0, "net_pnl_total": 0.0,
-                    "CAGR": 0.0, "vol_annualized": 0.0,
-                    "Sharpe": 0.0, "MaxDD": 0.0, "hit_rate": 0.0,
-                    "reason": "SKIP_MIN_TRADES_TEST"
-                })
-                cur += pd.Timedelta(days=args.step_days)
-                continue
-
-            # annota trades (TEST) con fold/pair
-            if not t_test.empty:
-                t_test = t_test.copy()
-                t_test["pair"] = pair
-                t_test["fold"] = fold_id
-                t_test["sign"] = sign
-                t_test["z_enter"] = params.z_enter
-                t_test["z_exit"]  = params.z_exit
-                t_test["z_stop"]  = params.z_stop
-                t_test["max_hold"] = params.max_hold
-                t_test["latency"] = params.latency
-                t_test["spread_scale"] = ctx.spread_scale
-                trades_rows.append(t_test)
-
-            # metrics TEST
-            metrics_row = {
-                "pair": pair, "fold": fold_id,
-                "test_start": str(te_start.date()), "test_end": str(te_end.date()),
-                **m_test
-            }
-            metrics_rows.append(metrics_row)
-
-            # best params row (per fold & pair)
-            best_rows.append({
-                "pair": pair, "fold": fold_id,
-                "z_enter": params.z_enter, "z_exit": params.z_exit, "z_stop": params.z_stop,
-                "max_hold": params.max_hold, "latency": params.latency,
-                "notional": args.notional, "start": str(tr_start.date()), "end": str(te_end.date()),
-                "train_days": args.train_days, "test_days": args.test_days, "step_days": args.step_days,
-                "spread_scale": ctx.spread_scale, "side": args.side, "sign": sign, "z_window": args.z_window,
-            })
-
-            cur += pd.Timedelta(days=args.step_days)
+        # rolling window (date inclusive; barre intraday: finestre semiaperte)
+        pi = len(pair_meta)
+        arrays[f"s{pi}"] = as_f64(s)
+        arrays[f"d{pi}"] = ts_ns(dates)
+        intraday = is_intraday(arrays[f"d{pi}"])
+        make_windows = expanding_windows if args.train_mode == "expanding" else rolling_windows
+        windows = make_windows(start_ts, end_ts, train=args.train_days, test=args.test_days,
+                               step=args.step_days, inclusive_end=not intraday)
+
+        # piano dei fold: offset interi [a, b) via searchsorted, slice = viste
+        plan = build_plan(arrays[f"d{pi}"], windows, inclusive_end=not intraday, intraday=intraday)
+        pair_meta.append((pair, is_pct, auto_scale, plan))
+        tasks += [(pi, k) for k in range(len(plan))]
+
+    # combinazioni invalide (z_exit >= z_enter, z_stop <= z_enter) scartate prima di simulare
+    prune = args.prune_invalid or args.search == "halving"
+    cand_idx = np.flatnonzero(valid_combo_mask(combos)) if prune else np.arange(len(combos))
+
+    state = dict(args=args, pair_meta=pair_meta, combos=combos, combo_params=combo_params,
+                 grid_z_window=grid_z_window, z_method=z_method, z_full=z_full, cand_idx=cand_idx,
+                 hold_time=hold_time, time_windows=any(is_time(w) for w in grid_z_window))
+    cache = ResultCache(args.cache) if args.cache else None
+    if args.train_mode == "expanding":
+        # un task per pair: i fold si passano lo stato del TRAIN in ordine
+        ptasks = [(pi, tuple(k for p, k in tasks if p == pi)) for pi in dict.fromkeys(p for p, _ in tasks)]
+        keys = [pair_cache_key(args, pair_meta[pi], arrays[f"s{pi}"], arrays[f"d{pi}"], ks)
+                for pi, ks in ptasks] if cache is not None else []
+        results = [r for rs in iter_cached(run_pair_expanding, ptasks, keys, cache, kind="wf_v1",
+                                           workers=args.workers, arrays=arrays, state=state) for r in rs]
+    else:
+        keys = [fold_cache_key(args, pair_meta[pi], arrays[f"s{pi}"], arrays[f"d{pi}"], k)
+                for pi, k in tasks] if cache is not None else []
+        results = list(iter_cached(run_fold, tasks, keys, cache, kind="wf_v1",
+                                   workers=args.workers, arrays=arrays, state=state))
+    if cache is not None:
+        print(f"[INFO] {cache.summary()}")
+        cache.close()
+
+    # merge nell'ordine dei task (pair, fold): identico al run seriale
+    best_rows = [r[2] for r in results if r is not None and r[2] is not None]
+    metrics_rows = [r[0] for r in results if r is not None]
+    trades_log = TradeLog([r[1] for r in results if r is not None and r[1] is not None])
+    if prune:
+        full = sum(r[3]["full"] for r in results if r is not None)
+        done = sum(r[3]["done"] for r in results if r is not None)
+        print(f"[INFO] search={args.search}: {len(combos) - len(cand_idx)}/{len(combos)} combinazioni invalide scartate; "
+              f"simulazioni TRAIN (combo x segno, equivalenti a finestra intera) {done:.0f}/{full:.0f}, "
+              f"evitate {full - done:.0f}")
+
+    out_cube = None
+    if args.cube:
+        # cubo pair x fold x z_window x griglia x metric (NaN = non valutato)
+        cube = ResultCube.empty(dict(
+            pair=[m[0] for m in pair_meta], fold=range(1, max((len(m[3]) for m in pair_meta), default=0) + 1),
+            z_window=[fmt_duration(w) for w in grid_z_window], z_enter=grid_z_enter, z_exit=grid_z_exit,
+            z_stop=grid_z_stop, max_hold=[fmt_duration(h) for h in grid_maxhold], latency=grid_latency,
+            metric=CUBE_METRICS), meta=dict(source="walkforward_backtest", args=vars(args)))
+        flat = cube.data.reshape(len(pair_meta), -1, len(grid_z_window), len(combos), len(CUBE_METRICS))
+        nm = len(GRID_METRICS)
+        for (pi, k), r in zip(tasks, results):
+            for wi, c_idx, c_train, c_sign, c_test in (r[5] if r is not None else ()):
+                cell = flat[pi, k, wi]
+                cell[c_idx, :nm] = c_train
+                cell[c_idx, nm] = c_sign
+                cell[c_idx, nm + 1:] = c_test
+        out_cube = os.path.join(args.outdir, "wf_cube.npz")
 
     # salva output
     best_df    = pd.DataFrame(best_rows)
     metrics_df = pd.DataFrame(metrics_rows)
-    trades_df  = pd.concat(trades_rows, ignore_index=True) if trades_rows else pd.DataFrame(columns=["pair","net_pnl","fold"])
+    trades_df  = trades_log.to_frame(WF_V1_COLUMNS) if len(trades_log) else pd.DataFrame(columns=["pair","net_pnl","fold"])
+    # curva di portafoglio: PnL MTM giornaliero dei TEST sommato su pair e fold
+    days, pnl = portfolio_daily(r[4] for r in results if r is not None)
+    port_df = pd.DataFrame({"date": days_to_dates(days), "pnl": pnl, "equity": np.cumsum(pnl)})
 
     out_best = os.path.join(args.outdir, "wf_best_params.csv")
     out_metr = os.path.join(args.outdir, "wf_metrics.csv")
     out_trad = os.path.join(args.outdir, "wf_trades.csv")
     out_png  = os.path.join(args.outdir, "wf_equity.png")
+    out_port = os.path.join(args.outdir, "wf_portfolio_daily.csv")
 
     ensure_dir(args.outdir)
     best_df.to_csv(out_best, index=False)
     metrics_df.to_csv(out_metr, index=False)
     trades_df.to_csv(out_trad, index=False)
+    port_df.to_csv(out_port, index=False)
+    if out_cube:
+        cube.save(out_cube)
 
     # equity plot (cum PnL TEST ordinato per data di uscita)
     plt.figure(figsize=(10,4))
@@ -479,7 +744,9 @@ def main():
     plt.tight_layout()
     plt.savefig(out_png, dpi=120)
 
-    print(f"[WROTE] {out_best}\n[WROTE] {out_metr}\n[WROTE] {out_trad}\n[WROTE] {out_png}")
+    print(f"[WROTE] {out_best}\n[WROTE] {out_metr}\n[WROTE] {out_trad}\n[WROTE] {out_port}\n[WROTE] {out_png}")
+    if out_cube:
+        print(f"[WROTE] {out_cube}  ({cube})")
 
 
 if __name__ == "__main__":
@@ -1,8 +1,19 @@
 #!/usr/bin/env python3
-import argparse, itertools, math, os, datetime as dt
+import argparse, itertools, os, pickle, datetime as dt
 import pandas as pd
 import numpy as np
 
+from bt_kernel import (run_kernel, as_f64, evaluate_grid, grid_combos, valid_combo_mask, successive_halving,
+                       trades_after, mtm_pnl, daily_pnl, mtm_metrics, portfolio_daily, days_to_dates,
+                       GridState, DIR_SHORT, G_TRADES, G_PNL)
+from feature_cache import FEATURES, ts_ns, rolling_features
+from fold_plan import build_plan, rolling_windows, expanding_windows, TrainCarry
+from bar_clock import (parse_duration, parse_durations, parse_days, is_time, is_intraday, fmt_duration,
+                       bar_ns, window_bars, hold_deadline)
+from trade_records import TradeLog, trade_block, WF_V2_COLUMNS
+from wf_parallel import STATE
+from result_cache import ResultCache, DEFAULT_PATH, make_key, iter_cached
+
 # ---------------------------
 # util
 # ---------------------------
@@ -25,26 +36,23 @@ def ensure_cols(df, cols):
 # backtest semplice short/long spread su zscore
 # ---------------------------
 def simulate_trades(df, side, z_enter, z_exit, z_stop, max_hold, latency_days,
-                    notional, fee_bps, slippage_bps, fold_id, pair, sign, z_window):
+                    notional, fee_bps, slippage_bps, fold_id, pair, sign, z_window, z=None, intraday=False):
     """
     df: DataFrame ordinato per timestamp con colonne: ts, spread_eff
-    Ritorna: trades list[dict], pnl_series (serie giornaliera)
+    z:  z-score già orientato dal sign (opzionale, es. da FEATURES)
+    max_hold/z_window: barre o pd.Timedelta (barre intraday); intraday:
+    days_held in giorni trascorsi invece che in barre
+    Ritorna: trades (TradeBlock colonnare), pnl_series (PnL mark-to-market per barra:
+    posizione x variazione di spread_eff, costi sulla barra di exit)
     """
     # z-score sullo spread "orientato" dal sign (scelto sul TRAIN)
-    z = zscore(df["spread_eff"] * sign, z_window)
-    df = df.copy()
-    df["z"] = z
-
-    in_pos = False
-    pos_dir = None
-    entry_idx = None
-    entry_eff = None
-    entry_z = None
-    age = 0
-
-    trades = []
-    equity = 0.0
-    pnl_by_day = []
+    t_ns = ts_ns(df["ts"])
+    if z is None:
+        if is_time(z_window):
+            z = rolling_features(df["spread_eff"] * sign, z_window, ts=t_ns).z
+        else:
+            z = zscore(df["spread_eff"] * sign, z_window).to_numpy(dtype=np.float64)
+    eff = as_f64(df["spread_eff"])
 
     fee = notional * (fee_bps/10_000.0)
     slip = notional * (slippage_bps/10_000.0)
@@ -52,123 +60,219 @@ def simulate_trades(df, side, z_enter, z_exit, z_stop, max_hold, latency_days,
     # latenza: quante barre dopo il segnale si esegue
     lat = int(latency_days)
 
-    for i, r in df.iterrows():
-        ts = r["ts"]
-        eff = float(r["spread_eff"])
-        zz  = float(r["z"]) if not math.isnan(r["z"]) else None
+    timed = is_time(max_hold)
+    kt = run_kernel(z, side=side, z_enter=z_enter, z_exit=z_exit, z_stop=z_stop,
+                    max_hold=1 if timed else max_hold, exec_delay=lat, deferred=True,
+                    hold_until=hold_deadline(t_ns, max_hold) if timed else None)
+
+    entry_eff = eff[kt.entry_i]
+    exit_eff  = eff[kt.exit_i]
+    gross = np.where(kt.direction == DIR_SHORT, notional * (entry_eff - exit_eff), notional * (exit_eff - entry_eff))
+    cost = 2*(fee+slip)
+    net  = gross - cost
+
+    trades = trade_block(kt, t_ns, entry_eff, exit_eff, gross, cost, net, z, intraday=intraday,
+                         path_px=eff, pnl_mult=notional,
+                         const={"pair": pair, "fold": fold_id, "spread_scale": "auto", "sign": sign,
+                                "notional": notional,
+                                "cost_legs": 2})   # fee+slippage su entry e su exit
+    ts = df["ts"]
+
+    # serie PnL per barra (flat = 0), somma = somma dei net_pnl dei trade
+    pnl_series = pd.DataFrame({"ts": ts.reset_index(drop=True),
+                               "pnl": mtm_pnl(kt, eff, pnl_mult=notional, cost=cost)})
+    return trades, pnl_series
 
-        # registra PnL giornaliero (flat = 0) — per Sharpe/vol opzionali
-        pnl_by_day.append((ts, 0.0))
+def grid_kw(args):
+    return dict(side=args.side, pnl_mult=args.notional, deferred=True,
+                cost=2*(args.notional*(args.fee_bps/10_000.0) + args.notional*(args.slippage_bps/10_000.0)))
 
-        if zz is None:
+def halving_on_train(f_tr, combos, idx, args, z_window, hold_time=False, step_ns=0):
+    """
+    Successive halving sul TRAIN (prefissi crescenti, score = PnL del segno
+    migliore). Ritorna (sopravvissuti, barre simulate per segno).
+    """
+    kw = grid_kw(args)
+    z_neg = f_tr.signed(-1).z
+
+    def eval_prefix(m, sub):
+        ts = f_tr.ts[:m] if hold_time else None
+        m_pos = evaluate_grid(f_tr.z[:m], f_tr.x[:m], combos[sub], ts=ts, **kw)
+        m_neg = evaluate_grid(z_neg[:m], f_tr.x[:m], combos[sub], ts=ts, **kw)
+        neg = m_neg[:, G_PNL] > m_pos[:, G_PNL]
+        max_trades = np.maximum(m_pos[:, G_TRADES] + trades_after(f_tr.z, combos[sub], m, side=args.side, deferred=True),
+                                m_neg[:, G_TRADES] + trades_after(z_neg, combos[sub], m, side=args.side, deferred=True))
+        return np.where(neg, m_neg[:, G_PNL], m_pos[:, G_PNL]), max_trades
+
+    return successive_halving(eval_prefix, len(f_tr.z), idx, eta=args.halving_eta,
+                              min_bars=max(20, 2*window_bars(z_window, step_ns)), min_trades=args.min_trades_train)
+
+def select_best_fold(te, f_tr, f_te, combos, combo_params, args, fold_id, pair, idx=None,
+                     hold_time=False, intraday=False, states=None):
+    """
+    idx: sottoinsieme (indici crescenti) delle combinazioni da valutare.
+    hold_time: max_hold a tempo (colonna in ns, timestamp da f_tr/f_te.ts).
+    states: GridState (segno +1, -1) del TRAIN precedente (espandente).
+    Griglia valutata in batch (evaluate_grid) sulle feature rolling in
+    cache (f_tr/f_te, segno -1 per simmetria): segno scelto sul TRAIN
+    (-1 solo se PnL strettamente maggiore), filtro min-trades-train,
+    poi TEST col segno scelto e filtro min-trades-test. Vince il PnL OOS
+    più alto (a parità la prima combinazione). Ritorna
+    (oos_pnl, params, sign, te_trades, (giorni, pnl) MTM del TEST) o None.
+    """
+    kw = grid_kw(args)
+    eff_tr, eff_te = f_tr.x, f_te.x
+    sub = np.arange(len(combos)) if idx is None else idx
+    combos = combos[sub]
+
+    ts_tr, ts_te = (f_tr.ts, f_te.ts) if hold_time else (None, None)
+    st_pos, st_neg = states if states is not None else (None, None)
+    m_pos = evaluate_grid(f_tr.z, eff_tr, combos, ts=ts_tr, state=st_pos, **kw)
+    m_neg = evaluate_grid(f_tr.signed(-1).z, eff_tr, combos, ts=ts_tr, state=st_neg, **kw)
+    neg = m_neg[:, G_PNL] > m_pos[:, G_PNL]
+    tr_trades = np.where(neg, m_neg[:, G_TRADES], m_pos[:, G_TRADES])
+    keep = tr_trades >= args.min_trades_train
+
+    te_trades = np.zeros(len(combos))
+    oos = np.zeros(len(combos))
+    for sign, sel in ((1, keep & ~neg), (-1, keep & neg)):
+        idx = np.flatnonzero(sel)
+        if idx.size:
+            m = evaluate_grid(f_te.signed(sign).z, eff_te, combos[idx], ts=ts_te, **kw)
+            te_trades[idx] = m[:, G_TRADES]
+            oos[idx] = m[:, G_PNL]
+
+    ok = np.flatnonzero(keep & (te_trades >= args.min_trades_test))
+    if ok.size == 0:
+        return None
+    b = int(ok[np.argmax(oos[ok])])
+    params = combo_params[sub[b]]
+    sign = -1 if neg[b] else 1
+    trades, pnl_series = simulate_trades(te, side=args.side, z_enter=params["z_enter"], z_exit=params["z_exit"],
+                                         z_stop=params["z_stop"], max_hold=params["max_hold"],
+                                         latency_days=params["latency"], notional=args.notional, fee_bps=args.fee_bps,
+                                         slippage_bps=args.slippage_bps, fold_id=fold_id, pair=pair,
+                                         sign=sign, z_window=args.z_window, z=f_te.signed(sign).z,
+                                         intraday=intraday)
+    daily = daily_pnl(pnl_series["pnl"].to_numpy(), ts_ns(te["ts"]))
+    return float(oos[b]), params, sign, trades, daily
+
+def run_fold(task, carry=None):
+    """
+    Un fold (pair, k): griglia per ogni z_window (a parità di PnL OOS vince
+    la prima finestra). Legge array e stato da wf_parallel.STATE.
+    carry: TrainCarry del TRAIN espandente (feature e stato della griglia
+    dai fold precedenti della pair).
+    Ritorna (esito, sim): esito = motivo di skip (str) o
+    (oos_pnl, params, sign, te_trades, daily); sim = simulazioni TRAIN (combo x
+    segno, equivalenti a finestra intera) fatte e della griglia piena.
+    """
+    pi, k = task
+    st = STATE
+    args = st["args"]
+    z_method, z_full = st["z_method"], st["z_full"]
+    pair, plan = st["pair_meta"][pi]
+    eff = st["arrays"][f"e{pi}"]
+    ts = st["arrays"][f"t{pi}"]
+    fold_id = k + 1
+    span_tr, span_te = plan.tr(k), plan.te(k)
+    n_tr, n_te = span_tr[1] - span_tr[0], span_te[1] - span_te[0]
+
+    # finestre z compatibili con la lunghezza del fold (in modalità full
+    # il warm-up viene dalla storia precedente: basta un fold non vuoto)
+    step_ns = bar_ns(ts) if st["time_windows"] else 0
+    if z_full:
+        fold_windows = st["z_windows"] if n_tr>=20 and n_te>0 else []
+    else:
+        fold_windows = [w for w in st["z_windows"]
+                        if n_tr>=max(20, window_bars(w, step_ns)*2) and n_te>=window_bars(w, step_ns)]
+    sim = dict(full=0.0, done=0.0)
+    if not fold_windows:
+        return "SKIP_TOO_SHORT", sim
+
+    te = pd.DataFrame({"ts": pd.to_datetime(ts[span_te[0]:span_te[1]], utc=True),
+                       "spread_eff": eff[span_te[0]:span_te[1]]})
+    best_fold = None
+    for w in fold_windows:
+        kw = dict(method=z_method, full_history=z_full, ts=ts)
+        f_tr = carry.features(pair, eff, w, span_tr, **kw) if carry else FEATURES.get(pair, eff, w, span=span_tr, **kw)
+        f_te = FEATURES.get(pair, eff, w, span=span_te, method=z_method, full_history=z_full, ts=ts)
+        idx = st["cand_idx"]
+        if args.search == "halving":
+            idx, bars = halving_on_train(f_tr, st["combos"], idx, args, w, st["hold_time"], step_ns)
+            sim["done"] += 2 * bars / n_tr
+        sim["full"] += 2 * len(st["combos"])
+        sim["done"] += 2 * len(idx)
+        if idx.size == 0:
             continue
+        states = (carry.state((w, 1), idx.size), carry.state((w, -1), idx.size)) if carry else None
+        cand = select_best_fold(te, f_tr, f_te, st["combos"], st["combo_params"], args, fold_id, pair, idx,
+                                st["hold_time"], plan.intraday, states)
+        if cand is not None and (best_fold is None or cand[0] > best_fold[0]):
+            best_fold = (cand[0], dict(cand[1], z_window=w)) + tuple(cand[2:])
 
-        # ENTRY
-        if not in_pos:
-            if side in ("short","both") and zz >= z_enter:
-                # applica latenza
-                j = min(i+lat, df.index[-1])
-                eff_entry = float(df.loc[j, "spread_eff"])
-                z_entry   = float(df.loc[j, "z"])
-                in_pos = True
-                pos_dir = "SHORT_SPREAD"
-                entry_idx = j
-                entry_eff = eff_entry
-                entry_z = z_entry
-                age = 0
-                continue
-            if side in ("long","both") and zz <= -z_enter:
-                j = min(i+lat, df.index[-1])
-                eff_entry = float(df.loc[j, "spread_eff"])
-                z_entry   = float(df.loc[j, "z"])
-                in_pos = True
-                pos_dir = "LONG_SPREAD"
-                entry_idx = j
-                entry_eff = eff_entry
-                entry_z = z_entry
-                age = 0
-                continue
-
-        # EXIT (se in posizione)
-        else:
-            age += 1
-            exit_reason = None
-            do_exit = False
-
-            if pos_dir == "SHORT_SPREAD":
-                if zz <= z_exit:
-                    do_exit = True; exit_reason = "MEAN_REVERT"
-                elif zz >= z_stop:
-                    do_exit = True; exit_reason = "STOP"
-                elif age >= max_hold:
-                    do_exit = True; exit_reason = "TIMEOUT"
-
-            elif pos_dir == "LONG_SPREAD":
-                if zz >= -z_exit:
-                    do_exit = True; exit_reason = "MEAN_REVERT"
-                elif zz <= -z_stop:
-                    do_exit = True; exit_reason = "STOP"
-                elif age >= max_hold:
-                    do_exit = True; exit_reason = "TIMEOUT"
-
-            if do_exit:
-                j = min(i+lat, df.index[-1])
-                eff_exit = float(df.loc[j, "spread_eff"])
-                z_exitv  = float(df.loc[j, "z"])
-                gross = 0.0
-                if pos_dir == "SHORT_SPREAD":
-                    gross = notional * (entry_eff - eff_exit)
-                else:
-                    gross = notional * (eff_exit - entry_eff)
-                cost = 2*(fee+slip)
-                net  = gross - cost
-                equity += net
-                trades.append({
-                    "pair": pair,
-                    "fold": fold_id,
-                    "entry_date": df.loc[entry_idx, "ts"],
-                    "exit_date":  df.loc[j, "ts"],
-                    "entry_spread_eff": entry_eff,
-                    "exit_spread_eff":  eff_exit,
-                    "direction": pos_dir,
-                    "days_held": age,
-                    "gross_pnl": gross,
-                    "cost": cost,
-                    "net_pnl": net,
-                    "entry_z": entry_z,
-                    "exit_z": z_exitv,
-                    "reason_exit": exit_reason,
-                    "spread_scale": "auto",
-                    "sign": sign,
-                })
-                in_pos=False
-                pos_dir=None
-                entry_idx=None
-                entry_eff=None
-                entry_z=None
-                age=0
-
-    # ricava serie PnL giornaliera (netto per giorno, qui semplificato = equity jumps solo a exit)
-    # per ora lasciamo solo cumulata via trades; Sharpe opzionale
-    pnl_series = pd.DataFrame(pnl_by_day, columns=["ts","pnl"])
-    return trades, pnl_series
+    return ("SKIP_MIN_TRADES_TEST" if best_fold is None else best_fold), sim
 
-def eval_sign_on_train(train_df, side, params, notional, fee_bps, slippage_bps, pair, z_window):
-    best = None
-    for sign in (+1, -1):
-        tr, _ = simulate_trades(train_df, side=side, z_enter=params["z_enter"], z_exit=params["z_exit"],
-                                z_stop=params["z_stop"], max_hold=params["max_hold"],
-                                latency_days=params["latency"], notional=notional,
-                                fee_bps=fee_bps, slippage_bps=slippage_bps,
-                                fold_id=-1, pair=pair, sign=sign, z_window=z_window)
-        pnl = sum(x["net_pnl"] for x in tr) if tr else 0.0
-        if (best is None) or (pnl > best[0]):
-            best = (pnl, sign)
-    return best[1] if best else 1
+def run_pair_expanding(task):
+    """Fold ks (in ordine) di una pair con TRAIN espandente: un solo passaggio sulle barre TRAIN."""
+    pi, ks = task
+    carry = TrainCarry(STATE["pair_meta"][pi][1], ks)
+    return [run_fold((pi, k), carry) for k in ks]
 
 # ---------------------------
 # main WF
 # ---------------------------
+# opzioni che non cambiano il risultato di un fold (I/O, parallelismo, cache)
+CACHE_IGNORE = ("input", "pairs_file", "start", "end", "workers", "cache", "incremental", "checkpoint")
+
+def fold_cache_key(args, meta, eff, ts, k):
+    """Chiave della cache del fold k: barre lette dal fold + parametri."""
+    pair, plan = meta
+    (a_tr, b_tr), (a_te, b_te) = plan.tr(k), plan.te(k)
+    if args.z_mode == "full":
+        # z causale sulla storia (con --grid-z-window momenti centrati sulla serie intera)
+        hi = len(eff) if args.grid_z_window else b_te
+        data = [eff[:hi], ts[a_te:b_te]]
+    else:
+        data = [eff[a_tr:b_tr], eff[a_te:b_te], ts[a_te:b_te]]
+    params = {name: v for name, v in vars(args).items() if name not in CACHE_IGNORE}
+    params.update(pair=pair, fold=k, window=[str(w) for w in plan.windows[k]])
+    return make_key("wf_v2", arrays=data, params=params)
+
+def pair_cache_key(args, meta, eff, ts, ks):
+    """Chiave della cache di una pair con TRAIN espandente: tutte le barre fino all'ultimo TEST."""
+    pair, plan = meta
+    hi = len(eff) if args.z_mode == "full" and args.grid_z_window else max(plan.te(k)[1] for k in ks)
+    params = {name: v for name, v in vars(args).items() if name not in CACHE_IGNORE}
+    params.update(pair=pair, folds=list(ks), windows=[[str(w) for w in plan.windows[k]] for k in ks])
+    return make_key("wf_v2", arrays=[eff[:hi], ts[:hi]], params=params)
+
+def checkpoint_config(args):
+    """Impronta delle opzioni del run: checkpoint riusabile solo a parità di config."""
+    params = {name: v for name, v in vars(args).items() if name not in CACHE_IGNORE}
+    return make_key("wf_v2_checkpoint", params=dict(params, input=os.path.abspath(args.input)))
+
+def load_checkpoint(path, config):
+    """Esiti per (pair, finestra) del checkpoint, o {} se assente/di un'altra config."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "rb") as f:
+        ck = pickle.load(f)
+    if ck.get("config") != config:
+        print(f"[INFO] checkpoint {path}: opzioni diverse, ricalcolo completo")
+        return {}
+    return ck["folds"]
+
+def save_checkpoint(path, config, folds):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(dict(config=config, folds=folds), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)   # atomico: un run interrotto non corrompe il checkpoint
+
+def fold_window_key(pair, window):
+    return pair, tuple(str(w) for w in window)
+
 def main():
     ap = argparse.ArgumentParser("ArbiSense WF v2 (true PnL + sign per fold)")
     ap.add_argument("--input", default="data_sample/spread_report_all_pairs_long.normalized.csv")
@@ -176,22 +280,44 @@ def main():
     ap.add_argument("--side", choices=["both","long","short"], default="short")
     ap.add_argument("--start", default=None)
     ap.add_argument("--end", default=None)
-    ap.add_argument("--train-days", type=int, default=240)
-    ap.add_argument("--test-days", type=int, default=60)
-    ap.add_argument("--step-days", type=int, default=45)
+    ap.add_argument("--train-days", type=parse_days, default=240, help="giorni (o durata, es. 36h)")
+    ap.add_argument("--test-days", type=parse_days, default=60)
+    ap.add_argument("--step-days", type=parse_days, default=45)
+    ap.add_argument("--train-mode", choices=["rolling","expanding"], default="rolling",
+                    help="rolling: TRAIN di --train-days che scorre; expanding: TRAIN ancorato all'inizio che "
+                         "cresce di --step-days (--train-days = primo TRAIN), simulato in modo incrementale")
     ap.add_argument("--notional", type=float, default=250000.0)
     ap.add_argument("--fee-bps", type=float, default=0.0)
     ap.add_argument("--slippage-bps", type=float, default=0.0)
-    ap.add_argument("--z-window", type=int, default=40)
+    ap.add_argument("--z-window", type=parse_duration, default=40, help="barre o durata (es. 120min) per barre intraday")
     ap.add_argument("--spread-scale", default="auto")
     ap.add_argument("--grid-z-enter", default="2.4,2.6,2.8,3.0")
     ap.add_argument("--grid-z-exit",  default="1.6,1.8,2.0")
     ap.add_argument("--grid-z-stop",  default="3.6,4.0,99")
-    ap.add_argument("--grid-max-hold", default="5,7,9")
+    ap.add_argument("--grid-max-hold", default="5,7,9", help="barre o durate (es. 30min,2h)")
     ap.add_argument("--latency-days",  default="0,1")
+    ap.add_argument("--grid-z-window", default=None, help="finestre z da cercare (es. 30,40,60); default solo --z-window")
+    ap.add_argument("--z-mode", choices=["fold","full"], default="fold",
+                    help="fold: z ricalcolato per fold; full: z causale su tutta la storia, tagliato per fold")
     ap.add_argument("--min-trades-train", type=int, default=2)
     ap.add_argument("--min-trades-test",  type=int, default=1)
+    ap.add_argument("--workers", type=int, default=1, help="processi per i task (pair, fold); output identico al seriale")
+    ap.add_argument("--search", choices=["grid","halving"], default="grid",
+                    help="grid: griglia completa; halving: successive halving su prefissi del TRAIN (+ scarto combinazioni invalide)")
+    ap.add_argument("--halving-eta", type=int, default=3, help="fattore di riduzione per rung (tiene il miglior 1/eta)")
+    ap.add_argument("--prune-invalid", action="store_true",
+                    help="scarta z_exit >= z_enter e z_stop <= z_enter senza simularle (implicito con --search halving)")
+    ap.add_argument("--cache", nargs="?", const=str(DEFAULT_PATH), default=None,
+                    help="cache persistente dei risultati per fold (SQLite): ricalcola solo i fold con dati/parametri "
+                         "nuovi; senza valore usa reports/bt_cache.sqlite")
+    ap.add_argument("--incremental", action="store_true",
+                    help="riusa gli esiti per (pair, fold) del checkpoint e valuta solo i fold nuovi "
+                         "(finestre che terminano dopo l'ultimo checkpoint); riscrive gli output wf_*")
+    ap.add_argument("--checkpoint", default="reports/wf_v2_checkpoint.pkl",
+                    help="checkpoint per (pair, fold), aggiornato a ogni run --incremental")
     args = ap.parse_args()
+    if args.train_mode == "expanding" and args.search == "halving":
+        raise SystemExit("--train-mode expanding richiede --search grid (halving valuta prefissi diversi a ogni fold)")
 
     # carica input normalizzato
     df = pd.read_csv(args.input)
@@ -223,14 +349,30 @@ def main():
         z_enter=[float(x) for x in str(args.grid_z_enter).split(",") if x],
         z_exit =[float(x) for x in str(args.grid_z_exit).split(",") if x],
         z_stop =[float(x) for x in str(args.grid_z_stop).split(",") if x],
-        max_hold=[int(x) for x in str(args.grid_max_hold).split(",") if x],
+        max_hold=parse_durations(args.grid_max_hold),
         latency=[int(x) for x in str(args.latency_days).split(",") if x],
+        z_window=parse_durations(args.grid_z_window) if args.grid_z_window else [args.z_window],
     )
-
-    all_trades = []
+    # con --grid-z-window: momenti a somme prefisse (O(1) a barra per finestra)
+    z_method = "prefix" if args.grid_z_window else "rolling"
+    z_full = args.z_mode == "full"
+
+    # max_hold a tempo: colonna della griglia in ns (evaluate_grid con ts)
+    hold_time = is_time(grid["max_hold"][0])
+    combos = grid_combos(grid["z_enter"], grid["z_exit"], grid["z_stop"],
+                         [v.value if hold_time else v for v in grid["max_hold"]], grid["latency"])
+    combo_params = [dict(z_enter=zE, z_exit=zX, z_stop=zS, max_hold=mH, latency=lat)
+                    for zE,zX,zS,mH,lat in itertools.product(grid["z_enter"], grid["z_exit"], grid["z_stop"], grid["max_hold"], grid["latency"])]
+
+    all_trades = TradeLog()
+    dailies = []
     rows_metrics = []
     rows_best = []
 
+    # per pair: array (spread_eff float64, ts int64 ns) e piano dei fold
+    pair_meta = []
+    arrays = {}
+    tasks = []
     for pair in pairs:
         g = df[df["pair"]==pair].copy()
         if g.empty: 
@@ -245,65 +387,80 @@ def main():
         if args.start: ts_min = max(ts_min, parse_date(args.start))
         if args.end:   ts_max = min(ts_max, parse_date(args.end))
 
-        folds = []
-        cur_start = ts_min
-        td = pd.Timedelta(days=int(args.train_days))
-        vd = pd.Timedelta(days=int(args.test_days))
-        sd = pd.Timedelta(days=int(args.step_days))
-        while cur_start + td + vd <= ts_max:
-            train_start = cur_start
-            train_end   = cur_start + td
-            test_start  = train_end
-            test_end    = train_end + vd
-            folds.append((train_start, train_end, test_start, test_end))
-            cur_start += sd
-
+        make_windows = expanding_windows if args.train_mode == "expanding" else rolling_windows
+        folds = make_windows(ts_min, ts_max, train=args.train_days, test=args.test_days,
+                             step=args.step_days, inclusive_end=False)
+
+        # piano dei fold: offset interi [a, b) via searchsorted
+        pi = len(pair_meta)
+        arrays[f"e{pi}"] = as_f64(g["spread_eff"])
+        arrays[f"t{pi}"] = ts_ns(g["ts"])
+        plan = build_plan(arrays[f"t{pi}"], folds, inclusive_end=False, intraday=is_intraday(arrays[f"t{pi}"]))
+        pair_meta.append((pair, plan))
+        tasks += [(pi, k) for k in range(len(plan))]
+
+    # combinazioni invalide (z_exit >= z_enter, z_stop <= z_enter) scartate prima di simulare
+    prune = args.prune_invalid or args.search == "halving"
+    cand_idx = np.flatnonzero(valid_combo_mask(combos)) if prune else np.arange(len(combos))
+
+    state = dict(args=args, pair_meta=pair_meta, combos=combos, combo_params=combo_params,
+                 z_windows=grid["z_window"], z_method=z_method, z_full=z_full, cand_idx=cand_idx,
+                 hold_time=hold_time, time_windows=any(is_time(w) for w in grid["z_window"]))
+    # incrementale: i fold già nel checkpoint (stessa pair, finestra e config)
+    # non vengono ricalcolati; la storia passata è considerata immutata
+    # (per dati rivisti: run completo o --cache, che confronta i byte)
+    config = checkpoint_config(args)
+    done_folds = load_checkpoint(args.checkpoint, config) if args.incremental else {}
+    wkeys = [fold_window_key(pair_meta[pi][0], pair_meta[pi][1].windows[k]) for pi, k in tasks]
+    todo = [(t, wk) for t, wk in zip(tasks, wkeys) if wk not in done_folds]
+    if args.incremental:
+        print(f"[INFO] incremental: {len(tasks) - len(todo)} fold dal checkpoint, {len(todo)} da valutare")
+
+    cache = ResultCache(args.cache) if args.cache else None
+    if args.train_mode == "expanding":
+        # un task per pair: i fold da valutare si passano lo stato del TRAIN in ordine
+        ptasks = [(pi, tuple(k for (p, k), _ in todo if p == pi)) for pi in dict.fromkeys(p for (p, _), _ in todo)]
+        keys = [pair_cache_key(args, pair_meta[pi], arrays[f"e{pi}"], arrays[f"t{pi}"], ks)
+                for pi, ks in ptasks] if cache is not None else []
+        computed = (r for rs in iter_cached(run_pair_expanding, ptasks, keys, cache, kind="wf_v2",
+                                            workers=args.workers, arrays=arrays, state=state) for r in rs)
+    else:
+        keys = [fold_cache_key(args, pair_meta[pi], arrays[f"e{pi}"], arrays[f"t{pi}"], k)
+                for (pi, k), _ in todo] if cache is not None else []
+        computed = iter_cached(run_fold, [t for t, _ in todo], keys, cache, kind="wf_v2",
+                               workers=args.workers, arrays=arrays, state=state)
+    new_folds = dict(zip([wk for _, wk in todo], computed))
+    if cache is not None:
+        print(f"[INFO] {cache.summary()}")
+        cache.close()
+    results = [new_folds[wk] if wk in new_folds else done_folds[wk] for wk in wkeys]
+    if args.incremental:
+        save_checkpoint(args.checkpoint, config, {**done_folds, **dict(zip(wkeys, results))})
+    if prune:
+        full = sum(r[1]["full"] for r in results)
+        done = sum(r[1]["done"] for r in results)
+        print(f"[INFO] search={args.search}: {len(combos)-len(cand_idx)}/{len(combos)} combinazioni invalide scartate; "
+              f"simulazioni TRAIN (combo x segno, equivalenti a finestra intera) {done:.0f}/{full:.0f}, evitate {full-done:.0f}")
+
+    # merge nell'ordine (pair, fold): identico al run seriale
+    by_pair = {}
+    for (pi, k), (res, _) in zip(tasks, results):
+        by_pair.setdefault(pi, []).append((k + 1, res))
+
+    for pi, (pair, _) in enumerate(pair_meta):
         best_for_pair = None  # (oos_pnl, params_dict)
-
-        for fold_id,(tr_s,tr_e,te_s,te_e) in enumerate(folds, start=1):
-            tr = g[(g["ts"]>=tr_s)&(g["ts"]<tr_e)].copy()
-            te = g[(g["ts"]>=te_s)&(g["ts"]<te_e)].copy()
-            if len(tr)<max(20, args.z_window*2) or len(te)<args.z_window:
-                rows_metrics.append({"pair":pair,"fold":fold_id,"net_pnl_total":0.0,"trades":0,"hit_rate":0.0,"reason":"SKIP_TOO_SHORT"})
-                continue
-
-            best_fold = None  # (oos_pnl, params, sign)
-
-            for zE,zX,zS,mH,lat in itertools.product(grid["z_enter"], grid["z_exit"], grid["z_stop"], grid["max_hold"], grid["latency"]):
-                params = dict(z_enter=zE, z_exit=zX, z_stop=zS, max_hold=mH, latency=lat)
-                # scegli segno sul TRAIN
-                sign = eval_sign_on_train(tr, side=args.side, params=params,
-                                          notional=args.notional, fee_bps=args.fee_bps, slippage_bps=args.slippage_bps,
-                                          pair=pair, z_window=args.z_window)
-                # simula TRAIN per conteggio trade (filtro min-trades-train)
-                tr_trades,_ = simulate_trades(tr, side=args.side, z_enter=zE, z_exit=zX, z_stop=zS, max_hold=mH,
-                                              latency_days=lat, notional=args.notional, fee_bps=args.fee_bps,
-                                              slippage_bps=args.slippage_bps, fold_id=fold_id, pair=pair,
-                                              sign=sign, z_window=args.z_window)
-                if len(tr_trades) < args.min_trades_train:
-                    continue
-
-                # simula TEST
-                te_trades,_ = simulate_trades(te, side=args.side, z_enter=zE, z_exit=zX, z_stop=zS, max_hold=mH,
-                                              latency_days=lat, notional=args.notional, fee_bps=args.fee_bps,
-                                              slippage_bps=args.slippage_bps, fold_id=fold_id, pair=pair,
-                                              sign=sign, z_window=args.z_window)
-                if len(te_trades) < args.min_trades_test:
-                    continue
-
-                oos = sum(x["net_pnl"] for x in te_trades)
-                if (best_fold is None) or (oos > best_fold[0]):
-                    best_fold = (oos, params, sign, te_trades)
-
-            if best_fold is None:
-                rows_metrics.append({"pair":pair,"fold":fold_id,"net_pnl_total":0.0,"trades":0,"hit_rate":0.0,"reason":"SKIP_MIN_TRADES_TEST"})
+        for fold_id, res in by_pair.get(pi, []):
+            if isinstance(res, str):
+                rows_metrics.append({"pair":pair,"fold":fold_id,"net_pnl_total":0.0,"trades":0,"hit_rate":0.0,"reason":res})
                 continue
 
-            oos_pnl, params, sign, te_trades = best_fold
-            wins = sum(1 for x in te_trades if x["net_pnl"]>0)
+            oos_pnl, params, sign, te_trades, daily = res
+            wins = int((te_trades.net > 0).sum())
             rows_metrics.append({"pair":pair,"fold":fold_id,"net_pnl_total":oos_pnl,"trades":len(te_trades),
-                                 "hit_rate": wins/len(te_trades) if te_trades else 0.0})
-            all_trades.extend(te_trades)
+                                 "hit_rate": wins/len(te_trades) if len(te_trades) else 0.0,
+                                 **mtm_metrics(daily[1], daily[0], capital=args.notional)})
+            dailies.append(daily)
+            all_trades.append(te_trades)
 
             # tieni best params globali per pair (somma sui fold)
             if best_for_pair is None:
@@ -318,9 +475,11 @@ def main():
                 "z_enter": best_for_pair["params"]["z_enter"],
                 "z_exit":  best_for_pair["params"]["z_exit"],
                 "z_stop":  best_for_pair["params"]["z_stop"],
-                "max_hold":best_for_pair["params"]["max_hold"],
+                "max_hold":fmt_duration(best_for_pair["params"]["max_hold"]),
                 "latency": best_for_pair["params"]["latency"],
-                "z_window": args.z_window,
+                "z_window": fmt_duration(best_for_pair["params"]["z_window"]),
+                **({"z_mode": args.z_mode} if z_full else {}),
+                **({"train_mode": args.train_mode} if args.train_mode != "rolling" else {}),
                 "side": args.side,
                 "notional": args.notional,
                 "spread_scale": "auto",
@@ -331,12 +490,13 @@ def main():
     # Scrivi output
     os.makedirs("reports", exist_ok=True)
     # trades
-    if all_trades:
-        trades_df = pd.DataFrame(all_trades)
+    if len(all_trades):
+        trades_df = all_trades.to_frame(WF_V2_COLUMNS, when="timestamp")
     else:
         trades_df = pd.DataFrame(columns=[
             "pair","fold","entry_date","exit_date","entry_spread_eff","exit_spread_eff","direction",
-            "days_held","gross_pnl","cost","net_pnl","entry_z","exit_z","reason_exit","spread_scale","sign"
+            "days_held","gross_pnl","cost","net_pnl","entry_z","exit_z","reason_exit","spread_scale","sign",
+            "notional","cost_legs"
         ])
     trades_df.to_csv("reports/wf_trades.csv", index=False)
     trades_df.to_csv("reports/wf_trades.true.csv", index=False)  # compat export TRUE
@@ -346,10 +506,15 @@ def main():
     # best params
     best_df = pd.DataFrame(rows_best) if rows_best else pd.DataFrame(columns=["pair","z_enter","z_exit","z_stop","max_hold","latency","z_window","side","notional","spread_scale","sign","oos_total_pnl"])
     best_df.to_csv("reports/wf_best_params.csv", index=False)
+    # curva di portafoglio: PnL MTM giornaliero dei TEST sommato su pair e fold
+    days, pnl = portfolio_daily(dailies)
+    pd.DataFrame({"date": days_to_dates(days), "pnl": pnl, "equity": np.cumsum(pnl)}).to_csv(
+        "reports/wf_portfolio_daily.csv", index=False)
 
     print("[WROTE] reports/wf_best_params.csv")
     print("[WROTE] reports/wf_metrics.csv")
     print("[WROTE] reports/wf_trades.csv")
+    print("[WROTE] reports/wf_portfolio_daily.csv")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+ArbiSense — esecuzione parallela dei task walk-forward (pair, fold)
+
+- Gli array per pair (spread, timestamp int64 ns) vengono copiati UNA volta
+  in un blocco multiprocessing.shared_memory; i worker ci si agganciano
+  nell'initializer e lavorano su viste NumPy (niente pickle per task).
+- Lo stato comune (args, griglia, ...) passa una volta per worker.
+- I risultati tornano nell'ordine dei task (Pool.imap), quindi il merge è
+  deterministico e l'output coincide byte per byte con il run seriale.
+- workers <= 1: stesso codice, in-process, senza pool né shared memory.
+
+Le funzioni task leggono `STATE` (arrays + stato comune) del modulo.
+Usato dai walk-forward (run_tasks) e da optimize_params (iter_tasks, per
+scrivere i risultati in streaming; TaskPool per le strategie ask/tell
+asincrone, risultati nell'ordine di completamento).
+"""
+from __future__ import annotations
+import multiprocessing as mp
+import queue
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+
+# stato del processo corrente: {"arrays": {nome: ndarray}, ...stato comune}
+STATE: Dict[str, Any] = {}
+
+_SHM: Optional[shared_memory.SharedMemory] = None
+
+Layout = List[Tuple[str, str, int, int]]   # (nome, dtype, offset byte, lunghezza)
+
+
+class SharedArrays:
+    """Array 1-D impacchettati in un unico blocco di shared memory."""
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        layout: Layout = []
+        off = 0
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            off = (off + 7) // 8 * 8   # allineamento a 8 byte
+            layout.append((name, a.dtype.str, off, a.shape[0]))
+            off += a.nbytes
+        self.shm = shared_memory.SharedMemory(create=True, size=max(off, 1))
+        self.layout = layout
+        for (name, dt, o, n), a in zip(layout, arrays.values()):
+            np.ndarray((n,), dtype=dt, buffer=self.shm.buf, offset=o)[:] = a
+
+    @property
+    def spec(self) -> Tuple[str, Layout]:
+        return self.shm.name, self.layout
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach(spec: Tuple[str, Layout]) -> Dict[str, np.ndarray]:
+    """Viste (read-only) sugli array di un blocco SharedArrays."""
+    global _SHM
+    name, layout = spec
+    # track=False: il blocco è del processo padre, il worker non lo deve rimuovere
+    try:
+        _SHM = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:   # Python < 3.13
+        _SHM = shared_memory.SharedMemory(name=name)
+    out = {}
+    for n, dt, o, ln in layout:
+        v = np.ndarray((ln,), dtype=dt, buffer=_SHM.buf, offset=o)
+        v.flags.writeable = False
+        out[n] = v
+    return out
+
+
+def _init_worker(spec, state):
+    STATE.clear()
+    STATE.update(state)
+    STATE["arrays"] = attach(spec)
+
+
+def iter_tasks(fn: Callable[[Any], Any], tasks: Iterable[Any], *, workers: int,
+               arrays: Dict[str, np.ndarray], state: Dict[str, Any]) -> Iterator[Any]:
+    """Come run_tasks, ma restituisce i risultati (in ordine) man mano che arrivano."""
+    tasks = list(tasks)
+    if workers <= 1 or len(tasks) <= 1:
+        STATE.clear()
+        STATE.update(state)
+        STATE["arrays"] = arrays
+        for t in tasks:
+            yield fn(t)
+        return
+
+    shm = SharedArrays(arrays)
+    try:
+        ctx = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+        with ctx.Pool(processes=min(int(workers), len(tasks)), initializer=_init_worker,
+                      initargs=(shm.spec, state)) as pool:
+            chunk = max(1, len(tasks) // (int(workers) * 4))
+            yield from pool.imap(fn, tasks, chunksize=chunk)
+    finally:
+        shm.close()
+
+
+def run_tasks(fn: Callable[[Any], Any], tasks: Iterable[Any], *, workers: int,
+              arrays: Dict[str, np.ndarray], state: Dict[str, Any]) -> List[Any]:
+    """Esegue fn(task) per ogni task; risultati nell'ordine dei task."""
+    return list(iter_tasks(fn, tasks, workers=workers, arrays=arrays, state=state))
+
+
+class TaskPool:
+    """
+    Pool persistente per valutazioni asincrone (ricerca ask/tell): `submit`
+    accoda un task, `done` restituisce (task, risultato) del primo che
+    termina. Stessa shared memory/initializer di iter_tasks; con
+    workers <= 1 i task girano in-process al submit.
+
+      with TaskPool(fn, workers=4, arrays=..., state=...) as pool:
+          pool.submit(t); task, res = pool.done()
+    """
+
+    def __init__(self, fn: Callable[[Any], Any], *, workers: int,
+                 arrays: Dict[str, np.ndarray], state: Dict[str, Any]):
+        self.fn, self.workers = fn, int(workers)
+        self.arrays, self.state = arrays, state
+        self.pending = 0
+        self._done: "queue.Queue" = queue.Queue()
+        self._pool = None
+        self._shm: Optional[SharedArrays] = None
+
+    def __enter__(self) -> "TaskPool":
+        if self.workers <= 1:
+            STATE.clear()
+            STATE.update(self.state)
+            STATE["arrays"] = self.arrays
+            return self
+        self._shm = SharedArrays(self.arrays)
+        ctx = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+        self._pool = ctx.Pool(processes=self.workers, initializer=_init_worker,
+                              initargs=(self._shm.spec, self.state))
+        return self
+
+    def __exit__(self, *exc):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        if self._shm is not None:
+            self._shm.close()
+
+    def submit(self, task: Any):
+        self.pending += 1
+        if self._pool is None:
+            self._done.put((task, self.fn(task), None))
+            return
+        self._pool.apply_async(self.fn, (task,),
+                               callback=lambda r, t=task: self._done.put((t, r, None)),
+                               error_callback=lambda e, t=task: self._done.put((t, None, e)))
+
+    def resolve(self, task: Any, result: Any):
+        """Accoda un risultato già noto (es. dalla cache) senza eseguire il task."""
+        self.pending += 1
+        self._done.put((task, result, None))
+
+    def done(self) -> Tuple[Any, Any]:
+        task, res, err = self._done.get()
+        self.pending -= 1
+        if err is not None:
+            raise err
+        return task, res